@@ -0,0 +1,454 @@
+"""Read, transform and write BGZF compressed VCF files without external tools.
+
+Replaces `zcat | sed | bgzip -c` style pipelines used to rename chromosomes in
+prepared variation files:
+
+  - BgzfWriter -- write BGZF blocks, compressing batches of blocks in threads.
+  - transform_vcf -- rename chromosomes and inject ##contig headers, writing
+    BGZF output plus a tabix index. When the input is already BGZF only the
+    blocks containing affected records are recompressed, all others are copied.
+  - concat_bgzf -- join BGZF files at the block level without recompressing.
+
+Also usable from the command line for GGD recipes and preparation scripts:
+
+  python -m cloudbio.biodata.bgzf --ucsc --ref hg19.fa in.vcf.gz out.vcf.gz
+"""
+from __future__ import print_function
+import argparse
+import bisect
+import gzip
+import io
+import os
+import struct
+import sys
+import zlib
+from multiprocessing.pool import ThreadPool
+
+BLOCK_SIZE = 0xff00
+EOF_BLOCK = (b"\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00BC"
+             b"\x02\x00\x1b\x00\x03\x00\x00\x00\x00\x00\x00\x00\x00\x00")
+_HEADER = struct.Struct("<4BI2BH2BHH")
+
+# -- Low level block handling
+
+def compress_block(data, level=6):
+    """Compress data into a single BGZF block.
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15, zlib.DEF_MEM_LEVEL, 0)
+    cdata = compressor.compress(data) + compressor.flush()
+    header = _HEADER.pack(31, 139, 8, 4, 0, 0, 255, 6, 66, 67, 2, len(cdata) + 25)
+    trailer = struct.pack("<2I", zlib.crc32(data) & 0xffffffff, len(data) & 0xffffffff)
+    return header + cdata + trailer
+
+def read_blocks(in_handle):
+    """Iterate over BGZF blocks in a file, yielding raw compressed and uncompressed data.
+    """
+    while True:
+        fixed = in_handle.read(12)
+        if not fixed:
+            break
+        if len(fixed) < 12 or fixed[:4] != b"\x1f\x8b\x08\x04":
+            raise ValueError("Not a BGZF block at offset %s" % (in_handle.tell() - len(fixed)))
+        xlen = struct.unpack("<H", fixed[10:12])[0]
+        extra = in_handle.read(xlen)
+        bsize = None
+        pos = 0
+        while pos < xlen:
+            si1, si2, slen = struct.unpack("<2BH", extra[pos:pos + 4])
+            if (si1, si2) == (66, 67):
+                bsize = struct.unpack("<H", extra[pos + 4:pos + 6])[0]
+            pos += 4 + slen
+        if bsize is None:
+            raise ValueError("gzip block missing BGZF size field")
+        rest = in_handle.read(bsize - xlen - 11)
+        data = zlib.decompress(rest[:-8], -15)
+        yield fixed + extra + rest, data
+
+def is_bgzf(fname):
+    """Check if a file starts with a BGZF block header.
+    """
+    if fname == "-" or not os.path.exists(fname):
+        return False
+    with open(fname, "rb") as in_handle:
+        header = in_handle.read(16)
+    return len(header) == 16 and header[:4] == b"\x1f\x8b\x08\x04" and header[12:14] == b"BC"
+
+def concat_bgzf(in_files, out_file, chunk_size=16 * 1024 * 1024):
+    """Concatenate BGZF files at the block level, adding a single EOF marker.
+    """
+    with open(out_file, "wb") as out_handle:
+        for in_file in in_files:
+            size = os.path.getsize(in_file)
+            with open(in_file, "rb") as in_handle:
+                if size >= len(EOF_BLOCK):
+                    in_handle.seek(size - len(EOF_BLOCK))
+                    if in_handle.read() == EOF_BLOCK:
+                        size -= len(EOF_BLOCK)
+                    in_handle.seek(0)
+                while size > 0:
+                    chunk = in_handle.read(min(chunk_size, size))
+                    out_handle.write(chunk)
+                    size -= len(chunk)
+        out_handle.write(EOF_BLOCK)
+    return out_file
+
+class BgzfWriter:
+    """Write BGZF compressed output, compressing batches of blocks in threads.
+
+    eof controls writing the empty end-of-file marker block on close, which is
+    left off for files that will be joined with concat_bgzf. The start of each
+    written block is tracked in `blocks` as (uncompressed, compressed) offsets
+    so record positions can be converted into virtual offsets for indexing.
+    """
+    def __init__(self, out_file, threads=1, level=6, eof=True):
+        self._handle = out_file if hasattr(out_file, "write") else open(out_file, "wb")
+        self._threads = max(1, threads)
+        self._pool = ThreadPool(self._threads) if self._threads > 1 else None
+        self._level = level
+        self._eof = eof
+        self._buffer = []
+        self._buffer_size = 0
+        self._pending = []
+        self._uoffset = 0
+        self._coffset = 0
+        self.blocks = []
+
+    def tell(self):
+        """Uncompressed offset of the next byte written.
+        """
+        return self._uoffset + self._buffer_size + sum(len(x) for x in self._pending)
+
+    def write(self, data):
+        self._buffer.append(data)
+        self._buffer_size += len(data)
+        if self._buffer_size >= BLOCK_SIZE:
+            self._split_buffer(final=False)
+
+    def write_block(self, raw, data):
+        """Copy an already compressed block, flushing any pending output first.
+        """
+        self.flush()
+        self.blocks.append((self._uoffset, self._coffset))
+        self._handle.write(raw)
+        self._uoffset += len(data)
+        self._coffset += len(raw)
+
+    def flush(self):
+        """Write all buffered data, ending the current block early if needed.
+        """
+        self._split_buffer(final=True)
+        self._compress_pending()
+
+    def _split_buffer(self, final):
+        data = b"".join(self._buffer)
+        while len(data) >= BLOCK_SIZE or (final and data):
+            self._pending.append(data[:BLOCK_SIZE])
+            data = data[BLOCK_SIZE:]
+        self._buffer = [data] if data else []
+        self._buffer_size = len(data)
+        if len(self._pending) >= self._threads * 4:
+            self._compress_pending()
+
+    def _compress_pending(self):
+        if not self._pending:
+            return
+        if self._pool:
+            raws = self._pool.map(lambda x: compress_block(x, self._level), self._pending)
+        else:
+            raws = [compress_block(x, self._level) for x in self._pending]
+        for data, raw in zip(self._pending, raws):
+            self.blocks.append((self._uoffset, self._coffset))
+            self._handle.write(raw)
+            self._uoffset += len(data)
+            self._coffset += len(raw)
+        self._pending = []
+
+    def close(self):
+        self.flush()
+        self.blocks.append((self._uoffset, self._coffset))
+        if self._eof:
+            self._handle.write(EOF_BLOCK)
+        self._handle.close()
+        if self._pool:
+            self._pool.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+# -- Tabix index
+
+_TBI_SHIFT = 14
+
+def _reg2bin(beg, end):
+    """UCSC/tabix binning scheme for a zero-based, half-open interval.
+    """
+    end -= 1
+    for shift, offset in [(14, 4681), (17, 585), (20, 73), (23, 9), (26, 1)]:
+        if beg >> shift == end >> shift:
+            return offset + (beg >> shift)
+    return 0
+
+class TabixIndexer:
+    """Build a tabix (.tbi) index for VCF output while it is being written.
+
+    Positions are tracked as uncompressed offsets and converted into BGZF
+    virtual offsets using the block list of the BgzfWriter on write.
+    """
+    def __init__(self):
+        self._names = []
+        self._refs = {}
+        self._cur = None
+        self._last_pos = None
+        self._partial = b""
+        self._partial_start = 0
+
+    def feed(self, data, start):
+        """Index output text written at the given uncompressed offset.
+        """
+        if self._partial:
+            data = self._partial + data
+            start = self._partial_start
+        lines = data.split(b"\n")
+        self._partial = lines.pop()
+        for line in lines:
+            end = start + len(line) + 1
+            if line and not line.startswith(b"#"):
+                self._add_record(line, start, end)
+            start = end
+        self._partial_start = start
+
+    def _add_record(self, line, ustart, uend):
+        parts = line.split(b"\t", 8)
+        chrom = parts[0]
+        beg = int(parts[1]) - 1
+        end = beg + max(len(parts[3]), 1)
+        if len(parts) > 7 and b"END=" in parts[7]:
+            for item in parts[7].split(b";"):
+                if item.startswith(b"END="):
+                    end = max(end, int(item[4:]))
+        if chrom != self._cur:
+            if chrom in self._refs:
+                raise ValueError("VCF not sorted, chromosome %s appears in multiple blocks" % chrom)
+            self._refs[chrom] = {"bins": {}, "linear": [], "start": ustart, "end": uend, "n": 0}
+            self._names.append(chrom)
+            self._cur = chrom
+            self._last_pos = beg
+        elif beg < self._last_pos:
+            raise ValueError("VCF not sorted at %s:%s" % (chrom, beg + 1))
+        self._last_pos = beg
+        ref = self._refs[chrom]
+        ref["end"] = uend
+        ref["n"] += 1
+        chunks = ref["bins"].setdefault(_reg2bin(beg, end), [])
+        if chunks and chunks[-1][1] == ustart:
+            chunks[-1][1] = uend
+        else:
+            chunks.append([ustart, uend])
+        linear = ref["linear"]
+        last_window = (end - 1) >> _TBI_SHIFT
+        if len(linear) <= last_window:
+            linear.extend([None] * (last_window + 1 - len(linear)))
+        for window in range(beg >> _TBI_SHIFT, last_window + 1):
+            if linear[window] is None:
+                linear[window] = ustart
+
+    def write(self, out_file, blocks):
+        """Write the index given (uncompressed, compressed) block starts of the indexed file.
+        """
+        ustarts = [u for u, _ in blocks]
+        def voffset(uoffset):
+            i = max(bisect.bisect_right(ustarts, uoffset) - 1, 0)
+            u, c = blocks[i]
+            return (c << 16) | (uoffset - u)
+        names = b"".join(x + b"\x00" for x in self._names)
+        out = [b"TBI\x01", struct.pack("<8i", len(self._names), 2, 1, 2, 0, ord("#"), 0, len(names)),
+               names]
+        for name in self._names:
+            ref = self._refs[name]
+            bins = sorted(ref["bins"].items())
+            out.append(struct.pack("<i", len(bins) + 1))
+            for bin_id, chunks in bins:
+                out.append(struct.pack("<Ii", bin_id, len(chunks)))
+                for ubeg, uend in chunks:
+                    out.append(struct.pack("<2Q", voffset(ubeg), voffset(uend)))
+            out.append(struct.pack("<Ii4Q", 37450, 2, voffset(ref["start"]), voffset(ref["end"]),
+                                   ref["n"], 0))
+            linear = ref["linear"]
+            prev = next((x for x in linear if x is not None), ref["start"])
+            out.append(struct.pack("<i", len(linear)))
+            for x in linear:
+                prev = x if x is not None else prev
+                out.append(struct.pack("<Q", voffset(prev)))
+        out.append(struct.pack("<Q", 0))
+        with BgzfWriter(out_file) as out_handle:
+            out_handle.write(b"".join(out))
+        return out_file
+
+# -- VCF record transforms
+
+def ucsc_chrom_map(max_chromosomes=50):
+    """Map GRC style chromosome names (1, X, MT) to UCSC style (chr1, chrX, chrM).
+    """
+    out = dict((str(x).encode(), ("chr%s" % x).encode()) for x in range(1, max_chromosomes))
+    out.update({b"X": b"chrX", b"Y": b"chrY", b"MT": b"chrM"})
+    return out
+
+def fai_contigs(ref_file):
+    """Retrieve (name, length) of contigs from a reference FASTA index.
+    """
+    fai_file = ref_file if ref_file.endswith(".fai") else ref_file + ".fai"
+    out = []
+    with open(fai_file) as in_handle:
+        for line in in_handle:
+            parts = line.split("\t")
+            out.append((parts[0], int(parts[1])))
+    return out
+
+class _VcfTransform:
+    """Per-line chromosome renaming and ##contig header replacement.
+    """
+    def __init__(self, chrom_map=None, contigs=None):
+        self.chrom_map = dict((_to_bytes(k), _to_bytes(v)) for k, v in (chrom_map or {}).items())
+        self.contig_lines = None
+        if contigs is not None:
+            self.contig_lines = b"".join(b"##contig=<ID=" + _to_bytes(name) + b",length=" +
+                                         str(size).encode() + b">\n" for name, size in contigs)
+
+    def needs_rewrite(self, segment, complete):
+        """Check if the line starting with this segment may be changed.
+        """
+        if segment.startswith(b"#"):
+            return (not complete or
+                    (segment.startswith(b"#CHROM") and self.contig_lines is not None) or
+                    (segment.startswith(b"##contig=") and
+                     (self.contig_lines is not None or self.chrom_map)))
+        tab = segment.find(b"\t")
+        if tab < 0:
+            return not complete or segment in self.chrom_map
+        return segment[:tab] in self.chrom_map
+
+    def line(self, line):
+        """Transform a complete line, without trailing newline.
+        """
+        if line.startswith(b"#"):
+            if line.startswith(b"##contig="):
+                if self.contig_lines is not None:
+                    return b""
+                elif self.chrom_map and line.startswith(b"##contig=<ID="):
+                    rest = line[len(b"##contig=<ID="):]
+                    end = min(x for x in (rest.find(b","), rest.find(b">"), len(rest)) if x >= 0)
+                    name = rest[:end]
+                    return b"##contig=<ID=" + self.chrom_map.get(name, name) + rest[end:] + b"\n"
+            elif line.startswith(b"#CHROM") and self.contig_lines is not None:
+                return self.contig_lines + line + b"\n"
+            return line + b"\n"
+        if not line:
+            return b"\n"
+        tab = line.find(b"\t")
+        if tab > 0:
+            chrom = line[:tab]
+            new_chrom = self.chrom_map.get(chrom)
+            if new_chrom is not None:
+                return new_chrom + line[tab:] + b"\n"
+        return line + b"\n"
+
+def _to_bytes(x):
+    return x if isinstance(x, bytes) else x.encode()
+
+def _write(out_handle, indexer, data):
+    if indexer:
+        indexer.feed(data, out_handle.tell())
+    out_handle.write(data)
+
+def _transform_stream(in_handle, out_handle, transform, indexer):
+    """Transform every record of an uncompressed or gzipped input stream.
+    """
+    for line in in_handle:
+        _write(out_handle, indexer, transform.line(line.rstrip(b"\r\n")))
+
+def _transform_blocks(in_handle, out_handle, transform, indexer):
+    """Transform a BGZF input, recompressing only blocks with changed lines.
+
+    Blocks where no line starting in the block needs a change are copied
+    verbatim. A line split over a block boundary is carried into the next
+    block, which is then rewritten.
+    """
+    carry = b""
+    at_line_start = True
+    for raw, data in read_blocks(in_handle):
+        if not data:
+            continue
+        if not carry:
+            segments = data.split(b"\n")
+            starts = segments if at_line_start else segments[1:]
+            last = len(starts) - 1
+            if not any(transform.needs_rewrite(x, i < last or data.endswith(b"\n"))
+                       for i, x in enumerate(starts) if x or i < last):
+                if indexer:
+                    indexer.feed(data, out_handle.tell())
+                out_handle.write_block(raw, data)
+                at_line_start = data.endswith(b"\n")
+                continue
+            if not at_line_start:
+                _write(out_handle, indexer, segments[0] + b"\n")
+                data = data[len(segments[0]) + 1:]
+        lines = (carry + data).split(b"\n")
+        carry = lines.pop()
+        _write(out_handle, indexer, b"".join(transform.line(x) for x in lines))
+        at_line_start = not carry
+    if carry:
+        _write(out_handle, indexer, transform.line(carry))
+
+def transform_vcf(in_file, out_file, chrom_map=None, contigs=None, threads=1, index=True):
+    """Rename chromosomes and replace ##contig headers, writing indexed BGZF output.
+
+    in_file can be BGZF, gzip, uncompressed or `-` for standard input. contigs
+    is a list of (name, length) as from `fai_contigs`; when provided existing
+    ##contig lines are replaced. Returns the output file, with a tabix index
+    written alongside unless index is False.
+    """
+    transform = _VcfTransform(chrom_map, contigs)
+    indexer = TabixIndexer() if index else None
+    tx_out_file = out_file + ".tmp"
+    writer = BgzfWriter(tx_out_file, threads=threads)
+    with writer:
+        if is_bgzf(in_file):
+            with open(in_file, "rb") as in_handle:
+                _transform_blocks(in_handle, writer, transform, indexer)
+        elif in_file == "-":
+            stdin = getattr(sys.stdin, "buffer", sys.stdin)
+            _transform_stream(stdin, writer, transform, indexer)
+        else:
+            with open(in_file, "rb") as test_handle:
+                is_gzip = test_handle.read(2) == b"\x1f\x8b"
+            with (gzip.open(in_file) if is_gzip else io.open(in_file, "rb")) as in_handle:
+                _transform_stream(in_handle, writer, transform, indexer)
+    os.rename(tx_out_file, out_file)
+    if indexer:
+        indexer.write(out_file + ".tbi", writer.blocks)
+    return out_file
+
+def main(args):
+    chrom_map = ucsc_chrom_map() if args.ucsc else {}
+    for rename in args.rename:
+        orig, new = rename.split(":")
+        chrom_map[orig.encode()] = new.encode()
+    contigs = fai_contigs(args.ref) if args.ref else None
+    transform_vcf(args.in_file, args.out_file, chrom_map, contigs, args.threads,
+                  index=not args.noindex)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Rename chromosomes and add contig headers to "
+                                     "a VCF, writing bgzipped and tabix indexed output.")
+    parser.add_argument("in_file", help="Input VCF: bgzipped, gzipped, plain or - for stdin")
+    parser.add_argument("out_file", help="Output bgzipped VCF")
+    parser.add_argument("--ucsc", action="store_true", help="Rename GRC chromosomes to UCSC style")
+    parser.add_argument("--rename", action="append", default=[],
+                        help="Additional chromosome renames as original:new")
+    parser.add_argument("--ref", help="Reference FASTA with .fai index to add ##contig headers from")
+    parser.add_argument("-t", "--threads", type=int, default=1, help="Compression threads")
+    parser.add_argument("--noindex", action="store_true", help="Do not write a tabix index")
+    main(parser.parse_args())
@@ -4,9 +4,11 @@ http://wiki.galaxyproject.org/Admin/Data%20Integration
 """
 from __future__ import print_function
 
+import json
 import os
 import shutil
 import subprocess
+from multiprocessing.pool import ThreadPool
 from xml.etree import ElementTree
 
 from cloudbio.custom import shared
@@ -48,27 +50,37 @@ class LocCols(object):
         self.dbkey1 = config.get('index', dbkey)
         self.dbkey2 = config.get('index', dbkey)
 
-def _get_tool_conf(env, tool_name):
+def _read_tool_confs(conf_file):
+    """Parse all tables in a tool_data_table_conf.xml into column and file details.
+    """
+    tables = []
+    tdtc = ElementTree.parse(conf_file)
+    for t in tdtc.iter('table'):
+        tables.append((t.attrib.get('name', ''),
+                       {'columns': t.find('columns').text.replace(' ', '').split(','),
+                        'file': t.find('file').attrib.get('path', '')}))
+    return tables
+
+def _get_tool_conf(env, tool_name, tables=None):
     """
     Parse the tool_data_table_conf.xml from installed_files subfolder and extract
     values for the 'columns' tag and 'path' parameter for the 'file' tag, returning
     those as a dict.
     """
     tool_conf = {}
-    tdtc = ElementTree.parse(env.tool_data_table_conf_file)
-    tables = tdtc.getiterator('table')
-    for t in tables:
-        if tool_name in t.attrib.get('name', ''):
-            tool_conf['columns'] = t.find('columns').text.replace(' ', '').split(',')
-            tool_conf['file'] = t.find('file').attrib.get('path', '')
+    if tables is None:
+        tables = _read_tool_confs(env.tool_data_table_conf_file)
+    for name, conf in tables:
+        if tool_name in name:
+            tool_conf = conf
     return tool_conf
 
-def _build_galaxy_loc_line(env, dbkey, file_path, config, prefix, tool_name):
+def _build_galaxy_loc_line(env, dbkey, file_path, config, prefix, tool_name, tables=None):
     """Prepare genome information to write to a Galaxy *.loc config file.
     """
     if tool_name:
         str_parts = []
-        tool_conf = _get_tool_conf(env, tool_name)
+        tool_conf = _get_tool_conf(env, tool_name, tables)
         loc_cols = LocCols(config, dbkey, file_path)
         # Compose the .loc file line as str_parts list by looking for column values
         # from the retrieved tool_conf (as defined in tool_data_table_conf.xml).
@@ -82,32 +94,89 @@ def _build_galaxy_loc_line(env, dbkey, file_path, config, prefix, tool_name):
         str_parts.insert(0, prefix)
     return str_parts
 
-def update_loc_file(env, ref_file, line_parts):
-    """Add a reference to the given genome to the base index file.
+class LocRegistry(object):
+    """Accumulate additions to Galaxy .loc files, writing each file once.
+
+    tool_data_table_conf.xml is parsed once, each .loc file is read into a set
+    on first use and all new lines across genomes are written by `write`,
+    replacing each changed .loc file atomically.
     """
-    if getattr(env, "galaxy_home", None) is not None:
-        tools_dir = os.path.join(env.galaxy_home, "tool-data")
+    def __init__(self, env):
+        self.env = env
+        self._tables = None
+        self._locs = {}
+
+    @property
+    def tables(self):
+        if self._tables is None:
+            self._tables = _read_tool_confs(self.env.tool_data_table_conf_file)
+        return self._tables
+
+    def _tools_dir(self):
+        return os.path.join(self.env.galaxy_home, "tool-data")
+
+    def add(self, ref_file, line_parts):
+        """Register a line for a .loc file, ignoring lines already present.
+        """
+        if getattr(self.env, "galaxy_home", None) is None:
+            return
+        if ref_file not in self._locs:
+            existing = set([])
+            loc_path = os.path.join(self._tools_dir(), ref_file)
+            if os.path.exists(loc_path):
+                with open(loc_path) as in_handle:
+                    existing = set(line.strip() for line in in_handle)
+            self._locs[ref_file] = (existing, [])
+        existing, new = self._locs[ref_file]
+        add_str = "\t".join(line_parts)
+        if add_str.strip() not in existing:
+            existing.add(add_str.strip())
+            new.append(add_str)
+
+    def write(self):
+        """Write all accumulated additions, rewriting each changed .loc file once.
+        """
+        if getattr(self.env, "galaxy_home", None) is None:
+            return
+        tools_dir = self._tools_dir()
         if not os.path.exists(tools_dir):
-            subprocess.check_call("mkdir -p %s" % tools_dir, shell=True)
-        dt_file = os.path.join(env.galaxy_home, "tool_data_table_conf.xml")
+            os.makedirs(tools_dir)
+        dt_file = os.path.join(self.env.galaxy_home, "tool_data_table_conf.xml")
         if not os.path.exists(dt_file):
-            shutil.copy(env.tool_data_table_conf_file, dt_file)
-        add_str = "\t".join(line_parts)
-        with shared.chdir(tools_dir):
-            if not os.path.exists(ref_file):
-                subprocess.check_call("touch %s" % ref_file, shell=True)
-            has_line = False
-            with open(ref_file) as in_handle:
-                for line in in_handle:
-                    if line.strip() == add_str.strip():
-                        has_line = True
-            if not has_line:
-                with open(ref_file, "a") as out_handle:
+            shutil.copy(self.env.tool_data_table_conf_file, dt_file)
+        for ref_file, (_, new) in self._locs.items():
+            loc_path = os.path.join(tools_dir, ref_file)
+            if not new and os.path.exists(loc_path):
+                continue
+            tx_loc_path = loc_path + ".tmp"
+            with open(tx_loc_path, "w") as out_handle:
+                if os.path.exists(loc_path):
+                    with open(loc_path) as in_handle:
+                        shutil.copyfileobj(in_handle, out_handle)
+                for add_str in new:
                     out_handle.write(add_str + "\n")
+            os.rename(tx_loc_path, loc_path)
+            del new[:]
+
+def update_loc_file(env, ref_file, line_parts, registry=None):
+    """Add a reference to the given genome to the base index file.
+
+    With a LocRegistry the addition is accumulated for a later single write.
+    """
+    if registry is not None:
+        registry.add(ref_file, line_parts)
+    else:
+        registry = LocRegistry(env)
+        registry.add(ref_file, line_parts)
+        registry.write()
 
-def prep_locs(env, gid, indexes, config):
+def prep_locs(env, gid, indexes, config, registry=None):
     """Prepare Galaxy location files for all available indexes.
+
+    Additions are accumulated in the supplied LocRegistry, or written
+    immediately if none is provided.
     """
+    cur_registry = registry if registry is not None else LocRegistry(env)
     for ref_index_file, cur_index, prefix, tool_name in [
             ("alignseq.loc", indexes.get("ucsc", None), "seq", None),
             ("bismark_indices.loc", indexes.get("bismark", None), "", 'bismark_indexes'),
@@ -121,8 +190,11 @@ def prep_locs(env, gid, indexes, config):
             ("sam_fa_indices.loc", indexes.get("seq", None), "", 'sam_fa_indexes'),
             ("twobit.loc", indexes.get("ucsc", None), "", None)]:
         if cur_index:
-            str_parts = _build_galaxy_loc_line(env, gid, cur_index, config, prefix, tool_name)
-            update_loc_file(env, ref_index_file, str_parts)
+            str_parts = _build_galaxy_loc_line(env, gid, cur_index, config, prefix, tool_name,
+                                               cur_registry.tables if tool_name else None)
+            cur_registry.add(ref_index_file, str_parts)
+    if registry is None:
+        cur_registry.write()
 
 # ## Finalize downloads
 
@@ -155,65 +227,113 @@ def _finalize_index(idx, fname):
 
 # ## Retrieve data from Galaxy
 
-def rsync_genomes(genome_dir, genomes, genome_indexes):
+# Index files which gain nothing from rsync compression in transit
+compressed_exts = ["2bit", "bgz", "bz2", "gz", "xz", "zip"]
+
+def rsync_genomes(genome_dir, genomes, genome_indexes, env=None, connections=4):
     """Top level entry point to retrieve rsync'ed indexes from Galaxy.
+
+    Available indexes for each genome are listed once and cached in genome_dir,
+    then all genome indexes are retrieved with up to `connections` simultaneous
+    rsync transfers.
     """
-    for gid in (x[1] for x in genomes):
-        galaxy_gid = org_remap.get(gid, gid)
-        indexes = _get_galaxy_genomes(galaxy_gid, genome_dir, genomes, genome_indexes)
-        _finalize_index("ucsc", indexes["ucsc"])
-        for idx, fname in indexes.iteritems():
+    listing = RsyncListing(os.path.join(genome_dir, "galaxy-rsync-listing.json"))
+    galaxy_gids = [org_remap.get(gid, gid) for gid in (x[1] for x in genomes)]
+    pool = ThreadPool(max(1, connections))
+    try:
+        pool.map(listing.genome, galaxy_gids)
+        listing.save()
+        jobs = [(gid, idx, genome_dir, listing) for gid in galaxy_gids for idx in genome_indexes]
+        index_files = pool.map(_rsync_genome_index_job, jobs)
+    finally:
+        pool.close()
+    registry = LocRegistry(env) if env is not None else None
+    for gid in galaxy_gids:
+        indexes = dict((idx, fname) for (cur_gid, idx, _, _), fname in zip(jobs, index_files)
+                       if cur_gid == gid and fname)
+        if "ucsc" in indexes:
+            _finalize_index("ucsc", indexes["ucsc"])
+        for idx, fname in indexes.items():
             _finalize_index(idx, fname)
-        prep_locs(galaxy_gid, indexes, {})
+        if registry is not None:
+            prep_locs(env, gid, indexes, {}, registry)
+    if registry is not None:
+        registry.write()
+
+class RsyncListing(object):
+    """Index files available for genomes on the Galaxy rsync server, cached on disk.
 
-def _get_galaxy_genomes(gid, genome_dir, genomes, genome_indexes):
-    """Retrieve the provided genomes and indexes from Galaxy rsync.
+    Each genome is listed with a single recursive rsync call, which identifies
+    the server subdirectory, available indexes and their files.
     """
-    out = {}
-    org_dir = os.path.join(genome_dir, gid)
-    if not os.path.exists(org_dir):
-        subprocess.check_call('mkdir -p %s' % org_dir, shell=True)
-    for idx in genome_indexes:
-        galaxy_index_name = index_map.get(idx)
-        index_file = None
-        if galaxy_index_name:
-            index_file = _rsync_genome_index(gid, galaxy_index_name, org_dir)
-        if index_file:
-            out[idx] = index_file
-        else:
-            print("Galaxy does not support {0} for {1}".format(idx, gid))
-    return out
-
-def _rsync_genome_index(gid, idx, org_dir):
+    def __init__(self, cache_file):
+        self._cache_file = cache_file
+        self._genomes = {}
+        if os.path.exists(cache_file):
+            with open(cache_file) as in_handle:
+                self._genomes = json.load(in_handle)
+
+    def genome(self, gid):
+        if gid not in self._genomes:
+            self._genomes[gid] = self._list_genome(gid)
+        return self._genomes[gid]
+
+    def _list_genome(self, gid):
+        for subdir in galaxy_subdirs:
+            url = "{server}/indexes{subdir}/{gid}/".format(server=server, subdir=subdir, gid=gid)
+            try:
+                with open(os.devnull, "w") as devnull:
+                    out = subprocess.check_output(["rsync", "--list-only", "-r", url], stderr=devnull)
+            except subprocess.CalledProcessError:
+                continue
+            indexes = {}
+            for line in out.decode().splitlines():
+                parts = line.split(None, 4)
+                if len(parts) == 5 and not parts[0].startswith("d") and "/" in parts[4]:
+                    idx, fname = parts[4].split("/", 1)
+                    indexes.setdefault(idx, []).append(fname)
+            return {"url": url, "indexes": indexes}
+        return None
+
+    def save(self):
+        tx_cache_file = self._cache_file + ".tmp"
+        with open(tx_cache_file, "w") as out_handle:
+            # genomes missing from the server are checked again on the next run
+            json.dump(dict((k, v) for k, v in self._genomes.items() if v), out_handle,
+                      indent=1, sort_keys=True)
+        os.rename(tx_cache_file, self._cache_file)
+
+def _rsync_genome_index_job(args):
+    gid, idx, genome_dir, listing = args
+    galaxy_index_name = index_map.get(idx)
+    index_file = None
+    if galaxy_index_name:
+        index_file = _rsync_genome_index(gid, galaxy_index_name, os.path.join(genome_dir, gid), listing)
+    if not index_file:
+        print("Galaxy does not support {0} for {1}".format(idx, gid))
+    return index_file
+
+def _rsync_genome_index(gid, idx, org_dir, listing):
     """Retrieve index for a genome from rsync server, returning path to files.
     """
+    genome = listing.genome(gid)
+    if genome is None:
+        raise ValueError("Could not find genome %s on Galaxy rsync" % gid)
+    files = genome["indexes"].get(idx)
+    if not files:
+        return None
     idx_dir = os.path.join(org_dir, idx)
     if not os.path.exists(idx_dir):
-        org_rsync = None
-        for subdir in galaxy_subdirs:
-            test_rsync = "{server}/indexes{subdir}/{gid}/{idx}/".format(
-                server=server, subdir=subdir, gid=gid, idx=idx)
-            try:
-                subprocess.check_output("rsync --list-only {server}".format(server=test_rsync))
-                org_rsync = test_rsync
-            except subprocess.CalledProcessError:
-                pass
-        if org_rsync is None:
-            raise ValueError("Could not find genome %s on Galaxy rsync" % gid)
-        try:
-            subprocess.check_call("rsync --list-only {server}".format(server=org_rsync), shell=True)
-            if not os.path.exists(idx_dir):
-                subprocess.check_call('mkdir -p %s' % idx_dir, shell=True)
-            with cd(idx_dir):
-                subprocess.check_call("rsync -avzP {server} {idx_dir}".format(server=org_rsync,
-                                                                              idx_dir=idx_dir), shell=True)
-        except subprocess.CalledProcessError:
-            pass
-    if os.path.exists(idx_dir):
+        cmd = ["rsync", "-avP"]
+        if any(os.path.splitext(x)[-1][1:] not in compressed_exts for x in files):
+            cmd += ["-z", "--skip-compress=%s" % "/".join(compressed_exts)]
+        os.makedirs(idx_dir)
         try:
-            subprocess.check_call("ls {idx_dir}/{gid}.fa*".format(idx_dir=idx_dir,
-                                                                  gid=gid), shell=True)
-            ext = ".fa" if (has_fa_ext.succeeded and idx not in ["seq"]) else ""
+            subprocess.check_call(cmd + ["{url}{idx}/".format(url=genome["url"], idx=idx), idx_dir])
         except subprocess.CalledProcessError:
-            pass
-        return os.path.join(idx_dir, gid + ext)
+            # remove partial downloads so they are retried
+            shutil.rmtree(idx_dir)
+            return None
+    has_fa_ext = any(x.startswith(gid + ".fa") for x in files)
+    ext = ".fa" if (has_fa_ext and idx not in ["seq"]) else ""
+    return os.path.join(idx_dir, gid + ext)
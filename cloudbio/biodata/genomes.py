@@ -12,13 +12,24 @@ The main targets are fabric functions:
 """
 from __future__ import print_function
 import collections
+import contextlib
+import ftplib
+import gzip
+import json
 import os
-import operator
+import queue
+import shutil
 import socket
 import subprocess
 import sys
+import tempfile
+import threading
+import time
 import traceback
 from math import log
+from multiprocessing.pool import ThreadPool
+from urllib.request import urlopen
+from urllib.error import HTTPError, URLError
 
 try:
     import yaml
@@ -29,7 +40,7 @@ try:
 except ImportError:
     boto = None
 
-from cloudbio.biodata import galaxy, ggd, rnaseq
+from cloudbio.biodata import galaxy, ggd, rnaseq, telemetry
 from cloudbio.custom import shared
 
 # -- Configuration for genomes to download and prepare
@@ -327,11 +338,13 @@ def install_data(config_source, approaches=None):
     from fabric.api import env
     _check_version(env)
     install_data_local(config_source, env.system_install, env.data_files,
-                       env.galaxy_home, env.tool_data_table_conf_file, env.cores, approaches)
+                       env.galaxy_home, env.tool_data_table_conf_file, env.cores, approaches,
+                       env.get("index_scratch"), env.get("index_scratch_factor"))
 
 def install_data_local(config_source, system_installdir, data_filedir,
                        galaxy_home=None, tool_data_table_conf_file=None,
-                       cores=None, approaches=None):
+                       cores=None, approaches=None, index_scratch=None,
+                       index_scratch_factor=None):
     """Local installation of biological data, avoiding fabric usage.
     """
     if not cores:
@@ -341,8 +354,10 @@ def install_data_local(config_source, system_installdir, data_filedir,
                 "raw": _prep_raw_index}
     if approaches is None: approaches = ["ggd", "s3", "raw"]
     ready_approaches = []
-    Env = collections.namedtuple("Env", "system_install, galaxy_home, tool_data_table_conf_file, cores")
-    env = Env(system_installdir, galaxy_home, tool_data_table_conf_file, cores)
+    Env = collections.namedtuple("Env", "system_install, galaxy_home, tool_data_table_conf_file, cores, "
+                                        "index_scratch, index_scratch_factor")
+    env = Env(system_installdir, galaxy_home, tool_data_table_conf_file, cores,
+              index_scratch, index_scratch_factor)
     for approach in approaches:
         ready_approaches.append((approach, PREP_FNS[approach]))
     # Append a potentially custom system install path to PATH so tools are found
@@ -378,7 +393,8 @@ def install_data_rsync(config_source):
     if "ucsc" not in genome_indexes:
         genome_indexes.append("ucsc")
     genome_dir = _make_genome_dir(env.data_files)
-    galaxy.rsync_genomes(genome_dir, genomes, genome_indexes)
+    galaxy.rsync_genomes(genome_dir, genomes, genome_indexes, env,
+                         config.get("rsync_connections", 4))
 
 def upload_s3(config_source):
     """Upload prepared genome files by identifier to Amazon s3 buckets.
@@ -402,7 +418,7 @@ def _install_additional_data(env, genomes, genome_indexes, config):
         lift_over_genomes = [g.ucsc_name() for (_, _, g) in genomes if g.ucsc_name()]
         _data_liftover(env, lift_over_genomes)
     if config.get("install_uniref", False):
-        _data_uniref(env)
+        _data_uniref(env, config.get("uniref_shards", 1))
 
 def _get_genomes(config_source):
     if isinstance(config_source, dict):
@@ -464,40 +480,46 @@ def _prep_genomes(env, genomes, genome_indexes, retrieve_fns, data_filedir):
     """Prepare genomes with the given indexes, supporting multiple retrieval methods.
     """
     genome_dir = _make_genome_dir(data_filedir)
-    for (orgname, gid, manager) in genomes:
-        org_dir = os.path.join(genome_dir, orgname, gid)
-        if not os.path.exists(org_dir):
-            subprocess.check_call('mkdir -p %s' % org_dir, shell=True)
-        ggd_recipes = manager.config.get("annotations", []) + manager.config.get("validation", [])
-        ggd_recipes += [x for x in manager.config.get("indexes", []) if x in genome_indexes]
-        for idx in genome_indexes + ggd_recipes:
-            with shared.chdir(org_dir):
-                if idx in ggd_recipes or not os.path.exists(idx):
-                    finished = False
-                    last_exc = None
-                    for method, retrieve_fn in retrieve_fns:
-                        try:
-                            retrieve_fn(env, manager, gid, idx)
-                            finished = True
-                            break
-                        except KeyboardInterrupt:
-                            raise
-                        except BaseException as e:
-                            # Fail on incorrect GGD recipes
-                            if idx in ggd_recipes and method == "ggd":
+    registry = galaxy.LocRegistry(env)
+    try:
+        for (orgname, gid, manager) in genomes:
+            org_dir = os.path.join(genome_dir, orgname, gid)
+            if not os.path.exists(org_dir):
+                subprocess.check_call('mkdir -p %s' % org_dir, shell=True)
+            ggd_recipes = manager.config.get("annotations", []) + manager.config.get("validation", [])
+            ggd_recipes += [x for x in manager.config.get("indexes", []) if x in genome_indexes]
+            for idx in genome_indexes + ggd_recipes:
+                with shared.chdir(org_dir):
+                    if idx in ggd_recipes or not os.path.exists(idx):
+                        finished = False
+                        last_exc = None
+                        for method, retrieve_fn in retrieve_fns:
+                            try:
+                                with telemetry.recording(_telemetry_file(org_dir), genome=gid):
+                                    with telemetry.step("%s:%s" % (method, idx)):
+                                        retrieve_fn(env, manager, gid, idx)
+                                finished = True
+                                break
+                            except KeyboardInterrupt:
                                 raise
-                            else:
-                                last_exc = traceback.format_exc()
-                                print("Moving on to next genome prep method after trying {0}\n{1}".format(
-                                      method, str(e)))
-                    if not finished:
-                        raise IOError("Could not prepare index {0} for {1} by any method\n{2}"
-                                      .format(idx, gid, last_exc))
-        ref_file = os.path.join(org_dir, "seq", "%s.fa" % gid)
-        if not os.path.exists(ref_file):
-            ref_file = os.path.join(org_dir, "seq", "%s.fa" % manager._name)
-        assert os.path.exists(ref_file), ref_file
-        _index_to_galaxy(env, org_dir, ref_file, gid, genome_indexes, manager.config)
+                            except BaseException as e:
+                                # Fail on incorrect GGD recipes
+                                if idx in ggd_recipes and method == "ggd":
+                                    raise
+                                else:
+                                    last_exc = traceback.format_exc()
+                                    print("Moving on to next genome prep method after trying {0}\n{1}".format(
+                                          method, str(e)))
+                        if not finished:
+                            raise IOError("Could not prepare index {0} for {1} by any method\n{2}"
+                                          .format(idx, gid, last_exc))
+            ref_file = os.path.join(org_dir, "seq", "%s.fa" % gid)
+            if not os.path.exists(ref_file):
+                ref_file = os.path.join(org_dir, "seq", "%s.fa" % manager._name)
+            assert os.path.exists(ref_file), ref_file
+            _index_to_galaxy(env, org_dir, ref_file, gid, genome_indexes, manager.config, registry)
+    finally:
+        registry.write()
 
 # ## Genomes index for next-gen sequencing tools
 
@@ -522,6 +544,7 @@ def _data_ngs_genomes(env, genomes, genome_indexes):
     """Download and create index files for next generation genomes.
     """
     genome_dir = _make_genome_dir(env.data_files)
+    registry = galaxy.LocRegistry(env)
     for organism, genome, manager in genomes:
         cur_dir = os.path.join(genome_dir, organism, genome)
         print("Processing genome {0} and putting it to {1}".format(organism, cur_dir))
@@ -534,18 +557,134 @@ def _data_ngs_genomes(env, genomes, genome_indexes):
             ref_file, base_zips = manager.download(seq_dir)
             ref_file = _move_seq_files(ref_file, base_zips, seq_dir)
         cur_indexes = manager.config.get("indexes", genome_indexes)
-        _index_to_galaxy(env, cur_dir, ref_file, genome, cur_indexes, manager.config)
+        _index_to_galaxy(env, cur_dir, ref_file, genome, cur_indexes, manager.config, registry)
+    registry.write()
 
-def _index_to_galaxy(env, work_dir, ref_file, gid, genome_indexes, config):
+def _index_to_galaxy(env, work_dir, ref_file, gid, genome_indexes, config, registry=None):
     """Index sequence files and update associated Galaxy loc files.
+
+    Loc file updates are accumulated in registry, if provided, for writing once
+    all genomes are processed. Resource usage of each index build is logged to
+    telemetry.jsonl in the genome directory.
     """
     indexes = {}
-    with shared.chdir(work_dir):
-        for idx in genome_indexes:
-            index_file = get_index_fn(idx)(env, ref_file)
-            if index_file:
-                indexes[idx] = os.path.join(work_dir, index_file)
-    galaxy.prep_locs(env, gid, indexes, config)
+    with _staged_genome_dir(env, work_dir, ref_file) as (build_dir, build_ref_file, unstage):
+        with shared.chdir(build_dir), telemetry.recording(_telemetry_file(work_dir), genome=gid):
+            for idx in genome_indexes:
+                with telemetry.step(idx):
+                    index_file = get_index_fn(idx)(env, build_ref_file)
+                unstage()
+                if index_file:
+                    index_file = os.path.relpath(os.path.join(build_dir, index_file), build_dir)
+                    indexes[idx] = os.path.join(work_dir, index_file)
+    galaxy.prep_locs(env, gid, indexes, config, registry)
+
+def _telemetry_file(work_dir):
+    return os.path.join(os.path.abspath(work_dir), "telemetry.jsonl")
+
+@contextlib.contextmanager
+def _staged_genome_dir(env, work_dir, ref_file):
+    """Provide a directory and reference file for building genome indexes.
+
+    With an index_scratch directory configured, for instance local NVMe when
+    data_files is on network storage, the reference is copied once to scratch
+    and other genome directory contents linked. Call the provided unstage
+    function after each index builds to move new index directories and seq/
+    files back atomically, so finished indexes survive a later failed build.
+    Staging is skipped if scratch has less free space than index_scratch_factor
+    times the reference size.
+    """
+    scratch = getattr(env, "index_scratch", None)
+    ref_path = os.path.normpath(os.path.join(work_dir, ref_file))
+    ref_parts = os.path.relpath(ref_path, work_dir).split(os.sep)
+    if not scratch or len(ref_parts) != 2:
+        yield work_dir, ref_file, lambda: None
+        return
+    stage_files = [x for x in [ref_path, ref_path + ".fai"] if os.path.exists(x)]
+    needed = float(getattr(env, "index_scratch_factor", None) or 8) * \
+        sum(os.path.getsize(x) for x in stage_files)
+    if not os.path.exists(scratch):
+        os.makedirs(scratch)
+    if shutil.disk_usage(scratch).free < needed:
+        print(f"Not enough space in {scratch} to stage {ref_path}, building indexes in place.")
+        yield work_dir, ref_file, lambda: None
+        return
+    stage_dir = tempfile.mkdtemp(dir=scratch, prefix="%s-" % os.path.basename(work_dir))
+    try:
+        seq_dir = os.path.join(work_dir, ref_parts[0])
+        for name in os.listdir(work_dir):
+            if name != ref_parts[0]:
+                os.symlink(os.path.join(work_dir, name), os.path.join(stage_dir, name))
+        os.mkdir(os.path.join(stage_dir, ref_parts[0]))
+        for name in os.listdir(seq_dir):
+            if os.path.join(seq_dir, name) in stage_files:
+                shutil.copy2(os.path.join(seq_dir, name), os.path.join(stage_dir, ref_parts[0], name))
+            else:
+                os.symlink(os.path.join(seq_dir, name), os.path.join(stage_dir, ref_parts[0], name))
+        def unstage():
+            _unstage_dir(stage_dir, work_dir, (stage_dir, work_dir))
+            _unstage_dir(os.path.join(stage_dir, ref_parts[0]), seq_dir, (stage_dir, work_dir))
+        print(f"Building indexes for {ref_path} in {stage_dir}.")
+        yield stage_dir, os.path.join(stage_dir, *ref_parts), unstage
+        unstage()
+    finally:
+        shutil.rmtree(stage_dir)
+
+def _unstage_dir(stage_dir, final_dir, stage_root=None):
+    """Move new files and directories from a staging directory back to the final directory.
+
+    Each is copied next to its final location first and then renamed into place.
+    Symlinks pointing into the staging directory, such as index builders linking
+    the staged reference, are rewritten as relative links to the final location.
+    `stage_root` is a (staging directory, genome directory) pair.
+    """
+    for name in sorted(os.listdir(stage_dir)):
+        stage_path = os.path.join(stage_dir, name)
+        final_path = os.path.join(final_dir, name)
+        if os.path.lexists(final_path):
+            continue
+        if os.path.islink(stage_path):
+            os.symlink(_unstaged_link(stage_path, final_path, stage_root), final_path)
+            continue
+        if os.path.isdir(stage_path):
+            size = sum(os.path.getsize(os.path.join(d, f)) for d, _, fs in os.walk(stage_path) for f in fs
+                       if not os.path.islink(os.path.join(d, f)))
+        else:
+            size = os.path.getsize(stage_path)
+        if shutil.disk_usage(final_dir).free < size:
+            raise IOError(f"Not enough space in {final_dir} to move {stage_path} from scratch")
+        tx_path = os.path.join(final_dir, ".%s.staging" % name)
+        if os.path.isdir(tx_path):
+            shutil.rmtree(tx_path)
+        elif os.path.lexists(tx_path):
+            os.remove(tx_path)
+        if os.path.isdir(stage_path):
+            shutil.copytree(stage_path, tx_path, symlinks=True)
+            for d, dirs, fs in os.walk(tx_path):
+                for link in [os.path.join(d, x) for x in dirs + fs if os.path.islink(os.path.join(d, x))]:
+                    final_link = os.path.join(final_path, os.path.relpath(link, tx_path))
+                    target = _unstaged_link(link, final_link, stage_root)
+                    if target != os.readlink(link):
+                        os.remove(link)
+                        os.symlink(target, link)
+        else:
+            shutil.copy2(stage_path, tx_path)
+        os.rename(tx_path, final_path)
+
+def _unstaged_link(link, final_link, stage_root):
+    """Retrieve the target for a staged symlink once moved to final_link.
+
+    Absolute targets inside the staging directory become relative links to the
+    equivalent path in the genome directory; other targets are unchanged.
+    """
+    target = os.readlink(link)
+    if stage_root:
+        stage_dir, work_dir = [os.path.abspath(x) for x in stage_root]
+        abs_target = os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(link)), target))
+        if os.path.isabs(target) and abs_target.startswith(stage_dir + os.sep):
+            final_target = os.path.join(work_dir, os.path.relpath(abs_target, stage_dir))
+            return os.path.relpath(final_target, os.path.dirname(os.path.abspath(final_link)))
+    return target
 
 class CustomMaskManager:
     """Create a custom genome based on masking an existing genome.
@@ -617,12 +756,12 @@ def _index_w_command(env, dir_name, command, ref_file, pre=None, post=None, ext=
     if ext is not None: index_name += ext
     full_ref_path = os.path.join(os.pardir, ref_file)
     if not os.path.exists(dir_name):
-        subprocess.check_call("mkdir %s" % dir_name, shell=True)
+        telemetry.check_call("mkdir %s" % dir_name, shell=True)
         with shared.chdir(dir_name):
             if pre:
                 full_ref_path = pre(full_ref_path)
-            subprocess.check_call(path_export + command.format(ref_file=full_ref_path, index_name=index_name),
-                                  shell=True)
+            telemetry.check_call(path_export + command.format(ref_file=full_ref_path, index_name=index_name),
+                                 shell=True)
             if post:
                 post(full_ref_path)
     return os.path.join(dir_name, index_name)
@@ -648,22 +787,22 @@ def _index_bowtie2(env, ref_file):
                                                 out_suffix + ".fa"))
     relative_ref_file = os.path.relpath(ref_file, os.path.dirname(bowtie_link))
     if not os.path.exists(bowtie_link):
-        subprocess.check_call("ln -sf %s %s" % (relative_ref_file, bowtie_link), shell=True)
+        telemetry.check_call("ln -sf %s %s" % (relative_ref_file, bowtie_link), shell=True)
     return out_suffix
 
 def _index_bwa(env, ref_file):
     dir_name = "bwa"
     local_ref = os.path.split(ref_file)[-1]
     if not os.path.exists(os.path.join(dir_name, "%s.bwt" % local_ref)):
-        subprocess.check_call("mkdir -p %s" % dir_name, shell=True)
+        telemetry.check_call("mkdir -p %s" % dir_name, shell=True)
         with shared.chdir(dir_name):
-            subprocess.check_call("ln -sf %s" % os.path.join(os.pardir, ref_file), shell=True)
+            telemetry.check_call("ln -sf %s" % os.path.join(os.pardir, ref_file), shell=True)
             try:
-                subprocess.check_call("bwa index -a bwtsw %s" % local_ref, shell=True)
+                telemetry.check_call("bwa index -a bwtsw %s" % local_ref, shell=True)
             except subprocess.CalledProcessError:
                 # work around a bug in bwa indexing for small files
-                subprocess.check_call("bwa index %s" % local_ref, shell=True)
-            subprocess.check_call("rm -f %s" % local_ref, shell=True)
+                telemetry.check_call("bwa index %s" % local_ref, shell=True)
+            telemetry.check_call("rm -f %s" % local_ref, shell=True)
     return os.path.join(dir_name, local_ref)
 
 def _index_bbmap(env, ref_file):
@@ -673,19 +812,19 @@ def _index_bbmap(env, ref_file):
     except:
         cores = 1
     if not os.path.exists(os.path.join(dir_name, "ref", "genome", "1", "summary.txt")):
-        subprocess.check_call("mkdir -p %s" % dir_name, shell=True)
-        subprocess.check_call("bbmap.sh -Xms%sg -Xmx%sg path=%s ref=%s" %
-                              (cores, 3 * int(cores), dir_name, ref_file), shell=True)
+        telemetry.check_call("mkdir -p %s" % dir_name, shell=True)
+        telemetry.check_call("bbmap.sh -Xms%sg -Xmx%sg path=%s ref=%s" %
+                             (cores, 3 * int(cores), dir_name, ref_file), shell=True)
     return dir_name
 
 def _index_bismark(env, ref_file):
     dir_name = "bismark"
-    subprocess.check_call("mkdir -p %s" % dir_name, shell=True)
+    telemetry.check_call("mkdir -p %s" % dir_name, shell=True)
     with shared.chdir(dir_name):
         local = os.path.basename(ref_file)
-        subprocess.check_call("ln -sf {0} {1}".format(ref_file, local), shell=True)
+        telemetry.check_call("ln -sf {0} {1}".format(ref_file, local), shell=True)
         cmd= f"bismark_genome_preparation ."
-        subprocess.check_call(cmd, shell=True)
+        telemetry.check_call(cmd, shell=True)
     return os.path.join(dir_name, "Bisulfite_Genome")
 
 def _index_maq(env, ref_file):
@@ -693,10 +832,10 @@ def _index_maq(env, ref_file):
     cmd = "maq fasta2bfa {ref_file} {index_name}"
     def link_local(ref_file):
         local = os.path.basename(ref_file)
-        subprocess.check_call("ln -sf {0} {1}".format(ref_file, local), shell=True)
+        telemetry.check_call("ln -sf {0} {1}".format(ref_file, local), shell=True)
         return local
     def rm_local(local_file):
-        subprocess.check_call("rm -f {0}".format(local_file), shell=True)
+        telemetry.check_call("rm -f {0}".format(local_file), shell=True)
     return _index_w_command(env, dir_name, cmd, ref_file, pre=link_local, post=rm_local)
 
 def _index_minimap2(env, ref_file):
@@ -725,22 +864,18 @@ def _index_sam(env, ref_file):
     (ref_dir, local_file) = os.path.split(ref_file)
     with shared.chdir(ref_dir):
         if not os.path.exists("%s.fai" % local_file):
-            subprocess.check_call("samtools faidx %s" % local_file, shell=True)
+            telemetry.check_call("samtools faidx %s" % local_file, shell=True)
     galaxy.index_picard(ref_file)
     return ref_file
 
 @_if_installed("STAR")
 def _index_star(env, ref_file):
     (ref_dir, local_file) = os.path.split(ref_file)
-    build = os.path.basename(os.path.splitext(ref_file)[0])
     dir_name = os.path.normpath(os.path.join(ref_dir, os.pardir, "star"))
     sentinel_file = os.path.join(dir_name, "SA")
     if os.path.exists(sentinel_file):
         return dir_name 
-    if build == "hg38":
-        simple_file = os.path.splitext(ref_file)[0] + "-simple.fa"
-        print(f"hg38 detected, building a simple reference with no alts, decoys or HLA from {ref_file} to {simple_file}.")
-        ref_file = prepare_simple_reference(ref_file, simple_file)
+    ref_file = _simple_reference_for_build(ref_file)
     GenomeLength = os.path.getsize(ref_file)
     Nbases = int(round(min(14, log(GenomeLength, 2) / 2 - 2), 0))
     # if there is a large number of contigs, scale nbits down
@@ -748,7 +883,7 @@ def _index_star(env, ref_file):
     # if there is a small genome, scale nbits down
     # https://groups.google.com/forum/#!topic/rna-star/9g8Uoe1Igho
     cmd = 'grep ">" {ref_file} | wc -l'.format(ref_file=ref_file)
-    nrefs = float(subprocess.check_output(cmd, shell=True).decode())
+    nrefs = float(telemetry.check_output(cmd, shell=True).decode())
     nbits = int(round(min(14, log(GenomeLength / nrefs, 2), log(GenomeLength, 2) / 2 - 1)))
     # first we estimate the number of bits we need to hold the genome and allocate
     # double that plus some padding to build the index
@@ -770,9 +905,6 @@ def _index_star(env, ref_file):
                                          nbits))
     if not os.path.exists(os.path.join(dir_name, "SA")):
         _index_w_command(env, dir_name, cmd, ref_file)
-    if build == "hg38":
-        print(f"Removing {ref_file}.")
-        os.remove(ref_file)
     return dir_name
 
 @_if_installed("hisat2-build")
@@ -786,11 +918,12 @@ def _index_hisat2(env, ref_file):
     if os.path.exists(os.path.join(index_prefix + ".1.ht2")):
         return dir_name
     if not os.path.exists(dir_name):
-        subprocess.check_call('mkdir -p %s' % dir_name, shell=True)
+        telemetry.check_call('mkdir -p %s' % dir_name, shell=True)
     try:
         cpu = env.cores
     except:
         cpu = 1
+    ref_file = _simple_reference_for_build(ref_file)
     cmd = "{path_export}hisat2-build -p {cpu} "
 
     exons_file = index_prefix + ".exons"
@@ -799,17 +932,17 @@ def _index_hisat2(env, ref_file):
         if not os.path.exists(exons_file):
             with open(exons_file, "w") as out_handle:
                 exons_cmd = ["hisat2_extract_exons.py", gtf_file]
-                subprocess.check_call(path_export + " ".join(exons_cmd), stdout=out_handle, shell=True)
+                telemetry.check_call(path_export + " ".join(exons_cmd), stdout=out_handle, shell=True)
         if not os.path.exists(splicesites_file):
             with open(splicesites_file, "w") as out_handle:
                 splicesites_cmd = ["hisat2_extract_splice_sites.py", gtf_file]
-                subprocess.check_call(path_export + " ".join(splicesites_cmd), stdout=out_handle, shell=True)
+                telemetry.check_call(path_export + " ".join(splicesites_cmd), stdout=out_handle, shell=True)
 
         if os.stat(exons_file).st_size > 0 and os.stat(splicesites_file).st_size > 0:
             cmd += "--exon {exons_file} --ss {splicesites_file} "
     cmd += "{ref_file} {index_prefix} "
     if not os.path.exists(os.path.join(index_prefix + ".1.ht2")):
-        subprocess.check_call(cmd.format(**locals()), shell=True)
+        telemetry.check_call(cmd.format(**locals()), shell=True)
     return dir_name
 
 def _index_snap(env, ref_file):
@@ -820,7 +953,7 @@ def _index_snap(env, ref_file):
     org_arg = "-hg19" if index_name in ["hg19", "GRCh37"] else ""
     cmd = "snap-aligner index {ref_file} {dir_name} -bSpace {org_arg}"
     if not os.path.exists(os.path.join(dir_name, "GenomeIndex")):
-        subprocess.check_call(cmd.format(**locals()), shell=True)
+        telemetry.check_call(cmd.format(**locals()), shell=True)
     return dir_name
 
 def _get_path_export(env):
@@ -844,7 +977,7 @@ def _index_rtg(env, ref_file):
     if not os.path.exists(os.path.join(dir_name, index_name, "done")):
         cmd = ("{path_export}export RTG_JAVA_OPTS='-Xms1g' && export RTG_MEM=2g && "
                "rtg format -o {dir_name}/{index_name} {ref_file}")
-        subprocess.check_call(cmd.format(**locals()), shell=True)
+        telemetry.check_call(cmd.format(**locals()), shell=True)
     return dir_name
 
 @_if_installed("MosaikJump")
@@ -858,7 +991,7 @@ def _index_mosaik(env, ref_file):
         if not os.path.exists("{0}_keys.jmp".format(jmp_base)):
             cmd = "export MOSAIK_TMP=`pwd` && MosaikJump -hs {hash_size} -ia {ref_file} -out {index_name}".format(
                 hash_size=hash_size, ref_file=dat_file, index_name=jmp_base)
-            subprocess.check_call(cmd, shell=True)
+            telemetry.check_call(cmd, shell=True)
     return _index_w_command(env, dir_name, cmd, ref_file,
                             post=create_jumpdb, ext=".dat")
 
@@ -889,6 +1022,7 @@ def _download_genomes(env, genomes, genome_indexes):
     """Download a group of genomes from Amazon s3 bucket.
     """
     genome_dir = _make_genome_dir(env.data_files)
+    registry = galaxy.LocRegistry(env)
     for (orgname, gid, manager) in genomes:
         org_dir = os.path.join(genome_dir, orgname, gid)
         if not os.path.exists(org_dir):
@@ -902,7 +1036,8 @@ def _download_genomes(env, genomes, genome_indexes):
             ref_file = os.path.join(org_dir, "seq", "%s.fa" % manager._name)
         assert os.path.exists(ref_file), ref_file
         cur_indexes = manager.config.get("indexes", genome_indexes)
-        _index_to_galaxy(env, org_dir, ref_file, gid, cur_indexes, manager.config)
+        _index_to_galaxy(env, org_dir, ref_file, gid, cur_indexes, manager.config, registry)
+    registry.write()
 
 def _upload_genomes(env, genomes, genome_indexes):
     """Upload our configured genomes to Amazon s3 bucket.
@@ -961,9 +1096,17 @@ def _clean_directory(dir, gid):
 
 # == Liftover files
 
+# Simultaneous chain file downloads, and time before re-checking missing chains
+LIFTOVER_CONNECTIONS = 8
+LIFTOVER_MISSING_TTL = 30 * 24 * 60 * 60
+
 def _data_liftover(env, lift_over_genomes):
     """Download chain files for running liftOver.
 
+    Chains for all genome pairs are retrieved concurrently and decompressed
+    during download. Many pairs do not exist at UCSC, so missing chains are
+    recorded and not requested again until LIFTOVER_MISSING_TTL has passed.
+
     Does not install liftOver binaries automatically.
     """
     lo_dir = os.path.join(env.data_files, "liftOver")
@@ -971,26 +1114,80 @@ def _data_liftover(env, lift_over_genomes):
         subprocess.check_call("mkdir %s" % lo_dir, shell=True)
     lo_base_url = "ftp://hgdownload.cse.ucsc.edu/goldenPath/%s/liftOver/%s"
     lo_base_file = "%sTo%s.over.chain.gz"
+    missing_file = os.path.join(lo_dir, "missing-chains.json")
+    missing = {}
+    if os.path.exists(missing_file):
+        with open(missing_file) as in_handle:
+            missing = json.load(in_handle)
+    now = time.time()
+    pairs = []
     for g1 in lift_over_genomes:
         for g2 in [g for g in lift_over_genomes if g != g1]:
             g2u = g2[0].upper() + g2[1:]
             cur_file = lo_base_file % (g1, g2u)
-            non_zip = os.path.splitext(cur_file)[0]
-            worked = False
-            with shared.chdir(lo_dir):
-                if not os.path.exists(non_zip):
-                    result = shared._remote_fetch(env, "%s" % (lo_base_url % (g1, cur_file)), allow_fail=True)
-                    # Lift over back and forths don't always exist
-                    # Only move forward if we found the file
-                    if result:
-                        worked = True
-                        subprocess.check_call("gunzip %s" % result, shell=True)
-            if worked:
-                ref_parts = [g1, g2, os.path.join(lo_dir, non_zip)]
-                galaxy.update_loc_file(env, "liftOver.loc", ref_parts)
+            pairs.append((g1, g2, lo_base_url % (g1, cur_file),
+                          os.path.join(lo_dir, os.path.splitext(cur_file)[0])))
+    to_fetch = [(url, out_file) for _, _, url, out_file in pairs
+                if not os.path.exists(out_file)
+                and now - missing.get(os.path.basename(out_file), 0) > LIFTOVER_MISSING_TTL]
+    if to_fetch:
+        pool = ThreadPool(min(LIFTOVER_CONNECTIONS, len(to_fetch)))
+        try:
+            found = pool.map(_fetch_chain, to_fetch)
+        finally:
+            pool.close()
+        for (_, out_file), cur_found in zip(to_fetch, found):
+            # Lift over back and forths don't always exist
+            if cur_found is False:
+                missing[os.path.basename(out_file)] = now
+            elif cur_found:
+                missing.pop(os.path.basename(out_file), None)
+        with open(missing_file + ".tmp", "w") as out_handle:
+            json.dump(missing, out_handle, indent=1, sort_keys=True)
+        os.rename(missing_file + ".tmp", missing_file)
+    registry = galaxy.LocRegistry(env)
+    for g1, g2, _, out_file in pairs:
+        if os.path.exists(out_file):
+            galaxy.update_loc_file(env, "liftOver.loc", [g1, g2, out_file], registry)
+    registry.write()
+
+def _fetch_chain(args):
+    """Download and decompress a gzipped chain file.
+
+    Returns True on success, False if the chain does not exist and None for
+    other failures, which are retried on the next run.
+    """
+    url, out_file = args
+    tx_out_file = out_file + ".tmp"
+    try:
+        in_handle = urlopen(url, timeout=300)
+        try:
+            with open(tx_out_file, "wb") as out_handle:
+                shutil.copyfileobj(gzip.GzipFile(fileobj=in_handle, mode="rb"), out_handle)
+        finally:
+            in_handle.close()
+    except (IOError, EOFError) as e:
+        if os.path.exists(tx_out_file):
+            os.remove(tx_out_file)
+        if (isinstance(e, HTTPError) and e.code == 404) or _is_ftp_missing(e):
+            return False
+        print("Could not retrieve liftOver chain %s: %s" % (url, e))
+        return None
+    os.rename(tx_out_file, out_file)
+    return True
+
+def _is_ftp_missing(e):
+    """Check if a URLError reports a missing FTP file or directory (550).
+
+    urllib wraps the underlying ftplib.error_perm, for missing files inside a
+    second URLError, so follow reasons and causes down to the FTP error.
+    """
+    while isinstance(e, URLError):
+        e = e.reason if isinstance(e.reason, BaseException) else e.__cause__
+    return isinstance(e, ftplib.error_perm) and str(e).startswith("550")
 
 # == UniRef
-def _data_uniref(env):
+def _data_uniref(env, shards=1):
     """Retrieve and index UniRef databases for protein searches.
 
     http://www.ebi.ac.uk/uniref/
@@ -999,34 +1196,122 @@ def _data_uniref(env):
     Should this be separated out and organized by program like genome data?
     This should also check the release note and automatically download and
     replace older versions.
+
+    Databases are retrieved and indexed concurrently, and each can be split
+    into `shards` BLAST volumes built in parallel.
     """
+    dbs = ["uniref50", "uniref90", "uniref100"]
+    pool = ThreadPool(len(dbs))
+    try:
+        pool.map(_prep_uniref, [(env, uniref_db, shards) for uniref_db in dbs])
+    finally:
+        pool.close()
+
+def _prep_uniref(args):
+    """Download a compressed UniRef database and build a BLAST database from it.
+    """
+    env, uniref_db, shards = args
     site = "ftp://ftp.uniprot.org"
     base_url = site + "/pub/databases/uniprot/" \
                "current_release/uniref/%s/%s"
-    for uniref_db in ["uniref50", "uniref90", "uniref100"]:
-        work_dir = os.path.join(env.data_files, "uniref", uniref_db)
-        if not os.path.exists(work_dir):
-            subprocess.check_call("mkdir -p %s" % work_dir, shell=True)
-        base_work_url = base_url % (uniref_db, uniref_db)
-        fasta_url = base_work_url + ".fasta.gz"
-        base_file = os.path.splitext(os.path.basename(fasta_url))[0]
-        with shared.chdir(work_dir):
-            if not os.path.exists(base_file):
-                out_file = shared._remote_fetch(env, fasta_url)
-                subprocess.check_call("gunzip %s" % out_file, shell=True)
-                shared._remote_fetch(env, base_work_url + ".release_note")
-        _index_blast_db(work_dir, base_file, "prot")
-
-def _index_blast_db(work_dir, base_file, db_type):
+    work_dir = os.path.join(env.data_files, "uniref", uniref_db)
+    if not os.path.exists(work_dir):
+        subprocess.check_call("mkdir -p %s" % work_dir, shell=True)
+    base_work_url = base_url % (uniref_db, uniref_db)
+    fasta_url = base_work_url + ".fasta.gz"
+    if _has_blast_db(work_dir, uniref_db, "prot"):
+        return
+    # Work from absolute paths, since the working directory is shared between threads
+    for url in [fasta_url, base_work_url + ".release_note"]:
+        out_file = os.path.join(work_dir, os.path.basename(url))
+        if not os.path.exists(out_file):
+            subprocess.check_call(["wget", "--continue", "--no-check-certificate",
+                                   "-O", out_file + ".part", url])
+            os.rename(out_file + ".part", out_file)
+    _index_blast_db(work_dir, os.path.basename(fasta_url), "prot", shards)
+
+def _index_blast_db(work_dir, base_file, db_type, shards=1):
     """Index a database using blast+ for similary searching.
+
+    Gzipped inputs are decompressed into makeblastdb without an uncompressed
+    copy on disk.
     """
+    db_name = os.path.splitext(base_file[:-3] if base_file.endswith(".gz") else base_file)[0]
+    if not _has_blast_db(work_dir, db_name, db_type):
+        if base_file.endswith(".gz"):
+            _makeblastdb_stream(work_dir, base_file, db_name, db_type, shards)
+        else:
+            subprocess.check_call(["makeblastdb", "-in", base_file, "-dbtype", db_type,
+                                   "-out", db_name], cwd=work_dir)
+
+def _has_blast_db(work_dir, db_name, db_type):
     type_to_ext = dict(prot=("phr", "pal"), nucl=("nhr", "nal"))
-    db_name = os.path.splitext(base_file)[0]
-    with shared.chdir(work_dir):
-        if not reduce(operator.or_,
-                      (os.path.exists("%s.%s" % (db_name, ext)) for ext in type_to_ext[db_type])):
-            subprocess.check_call("makeblastdb -in %s -dbtype %s -out %s" %
-                                  (base_file, db_type, db_name), shell=True)
+    return any(os.path.exists(os.path.join(work_dir, "%s.%s" % (db_name, ext)))
+               for ext in type_to_ext[db_type])
+
+def _makeblastdb_stream(work_dir, fasta_gz, db_name, db_type, shards=1,
+                        chunk_size=16 * 1024 * 1024):
+    """Build a BLAST database from gzipped FASTA, optionally split into parallel volumes.
+
+    Decompressed chunks of whole FASTA records are handed to whichever
+    makeblastdb process is free, and multiple volumes combined into a single
+    database with an alias file.
+    """
+    names = [db_name] if shards <= 1 else ["%s.%02d" % (db_name, i) for i in range(shards)]
+    procs = [subprocess.Popen(["makeblastdb", "-in", "-", "-dbtype", db_type, "-title", name,
+                               "-out", name], stdin=subprocess.PIPE, cwd=work_dir)
+             for name in names]
+    chunks = queue.Queue(maxsize=2 * len(procs))
+
+    def _feed(proc):
+        failed = False
+        while True:
+            chunk = chunks.get()
+            if chunk is None:
+                break
+            if not failed:
+                try:
+                    proc.stdin.write(chunk)
+                except IOError:
+                    # keep draining so the reader is not blocked, and report on exit status
+                    failed = True
+        try:
+            proc.stdin.close()
+        except IOError:
+            pass
+    feeders = [threading.Thread(target=_feed, args=(proc,)) for proc in procs]
+    for feeder in feeders:
+        feeder.start()
+    gunzip = subprocess.Popen(["gzip", "-dc", fasta_gz], stdout=subprocess.PIPE, cwd=work_dir)
+    try:
+        remainder = b""
+        while True:
+            data = gunzip.stdout.read(chunk_size)
+            if not data:
+                break
+            data = remainder + data
+            split = data.rfind(b"\n>")
+            if split < 0:
+                remainder = data
+            else:
+                chunks.put(data[:split + 1])
+                remainder = data[split + 1:]
+        if remainder:
+            chunks.put(remainder)
+    finally:
+        for _ in feeders:
+            chunks.put(None)
+        for feeder in feeders:
+            feeder.join()
+    if gunzip.wait() != 0:
+        raise subprocess.CalledProcessError(gunzip.returncode, "gzip -dc %s" % fasta_gz)
+    for name, proc in zip(names, procs):
+        if proc.wait() != 0:
+            raise subprocess.CalledProcessError(proc.returncode, "makeblastdb -out %s" % name)
+    if len(names) > 1:
+        subprocess.check_call(["blastdb_aliastool", "-dblist", " ".join(names), "-dbtype", db_type,
+                               "-out", db_name, "-title", db_name], cwd=work_dir)
+
 def get_index_fn(index):
     """
     return the index function for an index, if it is missing return a function
@@ -1036,20 +1321,103 @@ def get_index_fn(index):
         pass
     return INDEX_FNS.get(index, noop)
 
-def prepare_simple_reference(ref_file, out_file):
+# Builds indexed for RNA-seq aligners without alts, decoys or HLA
+SIMPLE_REFERENCE_BUILDS = ["hg38"]
+
+def _simple_reference_for_build(ref_file):
+    """Retrieve the cached simple reference for builds with alts, decoys or HLA.
+
+    The simple reference is kept in seq/ and shared between index builders.
+    """
+    build = os.path.basename(os.path.splitext(ref_file)[0])
+    if build not in SIMPLE_REFERENCE_BUILDS:
+        return ref_file
+    simple_file = os.path.splitext(ref_file)[0] + "-simple.fa"
+    if not os.path.exists(simple_file):
+        print(f"{build} detected, building a simple reference with no alts, decoys or HLA from {ref_file} to {simple_file}.")
+    return prepare_simple_reference(ref_file, simple_file)
+
+def contig_classes(ref_file):
+    """Classify reference contigs as primary, alt, decoy, HLA or unplaced.
+
+    Returns (name, length, class) for each contig in reference order. The
+    table is cached alongside the reference and rebuilt when the .fai changes.
+    """
+    fai_file = ref_file + ".fai"
+    table_file = os.path.splitext(ref_file)[0] + "-contigs.tsv"
+    if os.path.exists(table_file) and os.path.getmtime(table_file) >= os.path.getmtime(fai_file):
+        with open(table_file) as in_handle:
+            return [(name, int(length), cls) for name, length, cls in
+                    (line.rstrip("\n").split("\t") for line in in_handle)]
+    out = []
+    with open(fai_file) as in_handle:
+        for line in in_handle:
+            name, length = line.split("\t")[:2]
+            out.append((name, int(length), _contig_class(name)))
+    tx_table_file = table_file + ".tmp"
+    with open(tx_table_file, "w") as out_handle:
+        for name, length, cls in out:
+            out_handle.write("%s\t%s\t%s\n" % (name, length, cls))
+    os.rename(tx_table_file, table_file)
+    return out
+
+def _contig_class(chrom):
+    if is_alt(chrom):
+        return "alt"
+    elif is_decoy(chrom):
+        return "decoy"
+    elif is_HLA(chrom):
+        return "HLA"
+    elif is_unplaced(chrom):
+        return "unplaced"
+    else:
+        return "primary"
+
+def prepare_simple_reference(ref_file, out_file, classes=("primary", "unplaced")):
     """
     given an hg38 FASTA file, create a FASTA file with no alts, HLA or decoys
+
+    Sequence bytes for each retained contig are copied directly from the
+    reference using .fai offsets, and a matching .fai written for the output.
     """
     if os.path.exists(out_file):
         return out_file
-    with open(ref_file + ".fai") as in_handle:
-        chroms = [x.split()[0].strip() for x in in_handle]
-    chroms = [x for x in chroms if not (is_alt(x) or is_decoy(x) or is_HLA(x))]
-    cmd = ["samtools", "faidx", ref_file] + chroms
-    with open(out_file, "w") as out_handle:
-        subprocess.check_call(cmd, stdout=out_handle)
+    keep = set(name for name, _, cls in contig_classes(ref_file) if cls in classes)
+    tx_out_file = out_file + ".tmp"
+    out_fai = []
+    with open(ref_file + ".fai") as fai_handle, open(ref_file, "rb") as in_handle:
+        with open(tx_out_file, "wb") as out_handle:
+            for line in fai_handle:
+                name, length, offset, linebases, linewidth = line.split("\t")[:5]
+                if name not in keep:
+                    continue
+                length, offset, linebases, linewidth = int(length), int(offset), int(linebases), int(linewidth)
+                size = (length // linebases) * linewidth
+                if length % linebases:
+                    size += length % linebases + (linewidth - linebases)
+                out_handle.write((">%s\n" % name).encode())
+                out_fai.append((name, length, out_handle.tell(), linebases, linewidth))
+                _copy_range(in_handle, out_handle, offset, size)
+    with open(tx_out_file + ".fai", "w") as out_handle:
+        for parts in out_fai:
+            out_handle.write("\t".join(str(x) for x in parts) + "\n")
+    os.rename(tx_out_file, out_file)
+    os.rename(tx_out_file + ".fai", out_file + ".fai")
     return out_file
 
+def _copy_range(in_handle, out_handle, offset, size, buffer_size=16 * 1024 * 1024):
+    """Copy a byte range between files, using sendfile to avoid user space copies.
+    """
+    out_handle.flush()
+    out_fd = out_handle.fileno()
+    while size > 0:
+        sent = os.sendfile(out_fd, in_handle.fileno(), offset, min(size, buffer_size))
+        if sent == 0:
+            raise IOError("Unexpected end of file copying from %s" % in_handle.name)
+        offset += sent
+        size -= sent
+    out_handle.seek(0, os.SEEK_END)
+
 def is_alt(chrom):
     return chrom.endswith("_alt")
 
@@ -1059,6 +1427,9 @@ def is_decoy(chrom):
 def is_HLA(chrom):
     return chrom.startswith("HLA")
 
+def is_unplaced(chrom):
+    return chrom.startswith("chrUn") or chrom.endswith("_random")
+
 INDEX_FNS = {
     "seq": _index_sam,
     "bbmap": _index_bbmap,
@@ -10,10 +10,11 @@ import contextlib
 from distutils.version import LooseVersion
 import os
 import shutil
-import subprocess
 
 import yaml
 
+from cloudbio.biodata import telemetry
+
 def install_recipe(base_dir, system_install, recipe_file, genome_build):
     """Install data in a biodata directory given instructions from GGD YAML recipe.
     """
@@ -59,7 +60,7 @@ def _run_recipe(work_dir, recipe_cmds, recipe_type, system_install):
     with open(run_file, "w") as out_handle:
         out_handle.write("#!/bin/bash\nset -eu -o pipefail\nexport PATH=%s/bin:$PATH\n" % system_install)
         out_handle.write("\n".join(recipe_cmds))
-    subprocess.check_output(["bash", run_file])
+    telemetry.check_output(["bash", run_file])
 
 def _move_files(tmp_dir, final_dir, targets):
     for target in targets:
@@ -0,0 +1,239 @@
+"""Sorted binary GI to NCBI taxonomy ID lookup table.
+
+Builds a fixed width binary table from the NCBI gi_taxid_nucl and
+gi_taxid_prot dumps using a parallel external sort, and provides memory
+mapped lookups by binary search:
+
+  with GiTaxonomy("gi_taxid.bin") as tax:
+      taxid = tax.taxid(12345)
+
+The module has no dependencies outside the standard library so it can be
+copied to and run on remote machines during deployment:
+
+  python taxonomy.py build gi_taxid.bin gi_taxid_nucl.dmp.gz gi_taxid_prot.dmp.gz
+  python taxonomy.py names names.dmp names.clean.dmp
+  python taxonomy.py lookup gi_taxid.bin 12345
+"""
+from __future__ import print_function
+import argparse
+import array
+import gzip
+import heapq
+import mmap
+import multiprocessing
+import os
+import shutil
+import struct
+import sys
+import tempfile
+
+MAGIC = b"GITAXID1"
+_HEADER = struct.Struct("<8sQ")
+_RECORD = struct.Struct("<Q")
+_MAX_ID = 0xffffffff
+
+def _uint64_typecode():
+    """Array typecode for unsigned 64-bit records; Python 2 has no "Q" typecode.
+    """
+    for code in ["L", "Q"]:
+        try:
+            if array.array(code).itemsize == 8:
+                return code
+        except ValueError:
+            pass
+    raise ValueError("No unsigned 64-bit array type available")
+
+_UINT64 = _uint64_typecode()
+
+# -- Building
+
+def build_gi_taxid(in_files, out_file, text_file=None, cores=1, chunk_size=5000000,
+                   tmp_dir=None):
+    """Build a sorted binary GI to taxid table from gi_taxid dump files.
+
+    Input dumps (plain or gzipped) are streamed in chunks, each chunk sorted in
+    a separate worker and the sorted chunks merged into the output. Records are
+    stored as a single little-endian uint64 of `gi << 32 | taxid`. text_file
+    optionally also writes the merged table in the tab delimited format of
+    the sorted text file used by Galaxy taxonomy tools. Sorting a chunk takes
+    about 70 bytes per record, so peak memory is roughly cores * chunk_size * 70
+    bytes, 350Mb per core with the default chunk size.
+    """
+    work_dir = tempfile.mkdtemp(dir=tmp_dir or os.path.dirname(os.path.abspath(out_file)))
+    pool = multiprocessing.Pool(max(1, cores))
+    try:
+        jobs = []
+        for i, chunk in enumerate(_read_chunks(in_files, chunk_size)):
+            jobs.append(pool.apply_async(_sort_chunk, (chunk, os.path.join(work_dir, "chunk%s" % i))))
+            # bound memory use to one chunk in flight per core
+            while len([j for j in jobs if not j.ready()]) >= max(1, cores):
+                jobs[[j.ready() for j in jobs].index(False)].wait()
+        chunk_files = [j.get() for j in jobs]
+        tx_out_file = out_file + ".tmp"
+        tx_text_file = text_file + ".tmp" if text_file else None
+        _merge_chunks(chunk_files, tx_out_file, tx_text_file)
+        os.rename(tx_out_file, out_file)
+        if text_file:
+            os.rename(tx_text_file, text_file)
+    finally:
+        pool.close()
+        shutil.rmtree(work_dir)
+    return out_file
+
+def _open(fname, mode="rb"):
+    return gzip.open(fname, mode) if fname.endswith(".gz") else open(fname, mode)
+
+def _read_chunks(in_files, chunk_size):
+    chunk = array.array(_UINT64)
+    for in_file in in_files:
+        with _open(in_file) as in_handle:
+            for line in in_handle:
+                parts = line.split()
+                if len(parts) < 2:
+                    continue
+                gi, taxid = int(parts[0]), int(parts[1])
+                if gi > _MAX_ID or taxid > _MAX_ID:
+                    raise ValueError("GI or taxid too large for table: %s" % line)
+                chunk.append(gi << 32 | taxid)
+                if len(chunk) >= chunk_size:
+                    yield chunk
+                    chunk = array.array(_UINT64)
+    if len(chunk) > 0:
+        yield chunk
+
+def _sort_chunk(chunk, out_file):
+    with open(out_file, "wb") as out_handle:
+        array.array(_UINT64, sorted(chunk)).tofile(out_handle)
+    return out_file
+
+def _iter_chunk(fname, buffer_size=65536):
+    with open(fname, "rb") as in_handle:
+        while True:
+            buf = array.array(_UINT64)
+            try:
+                buf.fromfile(in_handle, buffer_size)
+            except EOFError:
+                pass
+            if len(buf) == 0:
+                break
+            for x in buf:
+                yield x
+
+def _merge_chunks(chunk_files, out_file, text_file=None, buffer_size=65536):
+    count = 0
+    last_gi = None
+    text_handle = open(text_file, "w") if text_file else None
+    try:
+        with open(out_file, "wb") as out_handle:
+            out_handle.write(_HEADER.pack(MAGIC, 0))
+            buf = array.array(_UINT64)
+            for x in heapq.merge(*[_iter_chunk(f) for f in chunk_files]):
+                gi = x >> 32
+                if gi == last_gi:
+                    continue
+                last_gi = gi
+                buf.append(x)
+                if text_handle:
+                    text_handle.write("%s\t%s\n" % (gi, x & _MAX_ID))
+                if len(buf) >= buffer_size:
+                    _write_le(buf, out_handle)
+                    count += len(buf)
+                    buf = array.array(_UINT64)
+            _write_le(buf, out_handle)
+            count += len(buf)
+            out_handle.seek(0)
+            out_handle.write(_HEADER.pack(MAGIC, count))
+    finally:
+        if text_handle:
+            text_handle.close()
+    return count
+
+def _write_le(buf, out_handle):
+    if sys.byteorder != "little":
+        buf.byteswap()
+    buf.tofile(out_handle)
+
+def clean_names(in_file, out_file):
+    """Replace quotes and parentheses in names.dmp, which break Galaxy taxonomy tools.
+    """
+    table = dict((ord(c), u"_") for c in u"()'\"")
+    with _open(in_file) as in_handle:
+        with open(out_file, "wb") as out_handle:
+            for line in in_handle:
+                out_handle.write(line.decode("utf-8").translate(table).encode("utf-8"))
+    return out_file
+
+# -- Lookup
+
+class GiTaxonomy:
+    """Memory mapped lookup of NCBI taxonomy IDs by GI number.
+    """
+    def __init__(self, fname):
+        self._handle = open(fname, "rb")
+        self._mmap = mmap.mmap(self._handle.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self._count = _HEADER.unpack_from(self._mmap, 0)
+        if magic != MAGIC:
+            raise ValueError("Not a GI to taxid table: %s" % fname)
+
+    def __len__(self):
+        return self._count
+
+    def _record(self, i):
+        return _RECORD.unpack_from(self._mmap, _HEADER.size + i * _RECORD.size)[0]
+
+    def taxid(self, gi):
+        """Retrieve the taxonomy ID for a GI, or None if not present.
+        """
+        lo, hi = 0, self._count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            cur = self._record(mid)
+            cur_gi = cur >> 32
+            if cur_gi < gi:
+                lo = mid + 1
+            elif cur_gi > gi:
+                hi = mid
+            else:
+                return cur & _MAX_ID
+        return None
+
+    def __contains__(self, gi):
+        return self.taxid(gi) is not None
+
+    def close(self):
+        self._mmap.close()
+        self._handle.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+def main(args):
+    if args.command == "build":
+        build_gi_taxid(args.inputs, args.out_file, args.text, args.cores, tmp_dir=args.tmpdir)
+    elif args.command == "names":
+        clean_names(args.in_file, args.out_file)
+    elif args.command == "lookup":
+        with GiTaxonomy(args.table) as tax:
+            for gi in args.gis:
+                print("%s\t%s" % (gi, tax.taxid(int(gi)) or ""))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build and query a binary GI to taxid table.")
+    subparsers = parser.add_subparsers(dest="command")
+    build = subparsers.add_parser("build", help="Build a table from gi_taxid dump files")
+    build.add_argument("out_file")
+    build.add_argument("inputs", nargs="+", help="gi_taxid dump files, plain or gzipped")
+    build.add_argument("--text", help="Also write a sorted tab delimited text table")
+    build.add_argument("-c", "--cores", type=int, default=min(4, multiprocessing.cpu_count()),
+                       help="Chunks to sort in parallel, each using about 350Mb of memory")
+    build.add_argument("--tmpdir", help="Directory for temporary sorted chunks")
+    names = subparsers.add_parser("names", help="Clean names.dmp for Galaxy")
+    names.add_argument("in_file")
+    names.add_argument("out_file")
+    lookup = subparsers.add_parser("lookup", help="Retrieve taxids for GIs")
+    lookup.add_argument("table")
+    lookup.add_argument("gis", nargs="+")
+    main(parser.parse_args())
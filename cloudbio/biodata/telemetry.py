@@ -0,0 +1,163 @@
+"""Resource usage telemetry for genome index builds and data recipes.
+
+Commands run through `check_call` and `check_output` inside a `recording`
+are measured with wait4, logging wall time, user and system CPU, peak
+resident memory, block I/O and exit status as JSON lines. Each `step`
+additionally logs its totals:
+
+  with telemetry.recording("hg38/telemetry.jsonl", genome="hg38"):
+      with telemetry.step("bwa"):
+          telemetry.check_call("bwa index hg38.fa", shell=True)
+
+Summarize logs, ranking the slowest and most memory hungry steps, with:
+
+  python -m cloudbio.biodata.telemetry report */*/telemetry.jsonl
+"""
+from __future__ import print_function
+import argparse
+import contextlib
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+
+_state = threading.local()
+
+# ru_maxrss is kilobytes on Linux and bytes on macOS
+_RSS_SCALE = 1.0 / (1024 * 1024) if sys.platform == "darwin" else 1.0 / 1024
+_BLOCK_SIZE = 512
+
+@contextlib.contextmanager
+def recording(log_file, genome=None):
+    """Record commands run in this thread to a JSON lines log file.
+    """
+    prev = getattr(_state, "recorder", None)
+    _state.recorder = {"log_file": log_file, "genome": genome, "step": None}
+    try:
+        yield log_file
+    finally:
+        _state.recorder = prev
+
+@contextlib.contextmanager
+def step(name):
+    """Group commands into a named step, logging totals when the step finishes.
+    """
+    recorder = getattr(_state, "recorder", None)
+    if recorder is None:
+        yield
+        return
+    prev_step, prev_totals = recorder["step"], recorder.get("totals")
+    recorder["step"] = name
+    recorder["totals"] = totals = {"commands": 0, "user": 0.0, "sys": 0.0, "max_rss_mb": 0.0,
+                                   "read_bytes": 0, "write_bytes": 0}
+    start = time.time()
+    status = "ok"
+    try:
+        yield
+    except BaseException:
+        status = "failed"
+        raise
+    finally:
+        recorder["step"], recorder["totals"] = prev_step, prev_totals
+        out = {"type": "step", "step": name, "wall": round(time.time() - start, 3), "status": status}
+        out.update(totals)
+        _write(recorder, out)
+
+def check_call(cmd, **kwargs):
+    """subprocess.check_call, recording resource usage of the command.
+    """
+    retcode = _run(cmd, kwargs)[0]
+    if retcode:
+        raise subprocess.CalledProcessError(retcode, cmd)
+    return 0
+
+def check_output(cmd, **kwargs):
+    """subprocess.check_output, recording resource usage of the command.
+    """
+    retcode, output = _run(cmd, kwargs, capture=True)
+    if retcode:
+        raise subprocess.CalledProcessError(retcode, cmd, output)
+    return output
+
+def _run(cmd, kwargs, capture=False):
+    recorder = getattr(_state, "recorder", None)
+    if recorder is None:
+        if capture:
+            try:
+                return 0, subprocess.check_output(cmd, **kwargs)
+            except subprocess.CalledProcessError as e:
+                return e.returncode, e.output
+        return subprocess.call(cmd, **kwargs), None
+    if capture:
+        kwargs["stdout"] = subprocess.PIPE
+    start = time.time()
+    proc = subprocess.Popen(cmd, **kwargs)
+    output = None
+    if capture:
+        output = proc.stdout.read()
+        proc.stdout.close()
+    _, status, usage = os.wait4(proc.pid, 0)
+    retcode = -os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status)
+    proc.returncode = retcode
+    out = {"type": "command", "step": recorder["step"],
+           "cmd": cmd if isinstance(cmd, str) else " ".join(cmd),
+           "wall": round(time.time() - start, 3), "user": round(usage.ru_utime, 3),
+           "sys": round(usage.ru_stime, 3), "max_rss_mb": round(usage.ru_maxrss * _RSS_SCALE, 1),
+           "read_bytes": usage.ru_inblock * _BLOCK_SIZE, "write_bytes": usage.ru_oublock * _BLOCK_SIZE,
+           "exit": retcode}
+    _write(recorder, out)
+    totals = recorder.get("totals")
+    if totals is not None:
+        totals["commands"] += 1
+        for key in ["user", "sys"]:
+            totals[key] = round(totals[key] + out[key], 3)
+        for key in ["read_bytes", "write_bytes"]:
+            totals[key] += out[key]
+        totals["max_rss_mb"] = max(totals["max_rss_mb"], out["max_rss_mb"])
+    return retcode, output
+
+def _write(recorder, out):
+    out["genome"] = recorder["genome"]
+    out["time"] = time.strftime("%Y-%m-%dT%H:%M:%S")
+    log_dir = os.path.dirname(os.path.abspath(recorder["log_file"]))
+    if not os.path.exists(log_dir):
+        os.makedirs(log_dir)
+    with open(recorder["log_file"], "a") as out_handle:
+        out_handle.write(json.dumps(out, sort_keys=True) + "\n")
+
+# ## Reporting
+
+def read_logs(log_files):
+    out = []
+    for log_file in log_files:
+        with open(log_file) as in_handle:
+            for line in in_handle:
+                if line.strip():
+                    out.append(json.loads(line))
+    return out
+
+def report(log_files, top=10, out_handle=sys.stdout):
+    """Print the slowest and most memory hungry steps and commands from telemetry logs.
+    """
+    records = read_logs(log_files)
+    for rtype in ["step", "command"]:
+        cur = [x for x in records if x["type"] == rtype]
+        for key, label, fmt in [("wall", "wall time", "%10.1fs"), ("max_rss_mb", "peak RSS", "%9.0fMb")]:
+            out_handle.write("## %ss by %s\n" % (rtype.capitalize(), label))
+            for x in sorted(cur, key=lambda x: x[key], reverse=True)[:top]:
+                desc = x["step"] if rtype == "step" else "%s %s" % (x["step"], x["cmd"])
+                out_handle.write("%s  cpu %9.1fs  %-10s %s\n" % (fmt % x[key], x["user"] + x["sys"],
+                                                                 x["genome"], desc[:100]))
+            out_handle.write("\n")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Summarize genome index build telemetry.")
+    subparsers = parser.add_subparsers(dest="command")
+    report_parser = subparsers.add_parser("report", help="Rank slowest and most memory hungry steps")
+    report_parser.add_argument("log_files", nargs="+")
+    report_parser.add_argument("-n", "--top", type=int, default=10)
+    args = parser.parse_args()
+    if args.command == "report":
+        report(args.log_files, args.top)
@@ -1,10 +1,12 @@
 #!/usr/bin/env python
 from __future__ import print_function
+import multiprocessing
 import os
 
 from tempfile import tempdir
 from subprocess import call
 from inspect import getargspec
+from multiprocessing.pool import ThreadPool
 
 from cloudbio.utils import _setup_logging, _configure_fabric_environment, _parse_fabricrc
 from cloudbio.biodata.genomes import install_data, install_data_s3, install_data_rsync
@@ -17,6 +19,7 @@ from fabfile import _perform_install, _install_custom
 from .util import eval_template
 
 import cloudbio.deploy.plugins
+from cloudbio.deploy.plugins import ACTION_INDEX
 
 from fabric.main import load_settings
 from fabric.api import put, run, env, settings, sudo
@@ -36,31 +39,103 @@ def deploy(options):
     _setup_logging(env)
 
     actions = _expand_actions(options.get("actions"))
-    if options["vm_provider"] == "novm":
-        vm_launcher = LocalVmLauncher(options)
-    else:
-        if not build_vm_launcher:
-            raise ImportError("Require vmlauncher: https://github.com/jmchilton/vm-launcher")
-        vm_launcher = build_vm_launcher(options)
+    vm_launcher = _build_vm_launcher(options)
+    fleet = _fleet_options(options)
 
     if _do_perform_action("list", actions):
         for node in vm_launcher.list():
             print("Active node with uuid %s <%s>" % (node.uuid, node))
 
     if _do_perform_action("destroy", actions):
-        target_name = options["hostname"]
+        target_names = [x["hostname"] for x in fleet] if fleet else [options["hostname"]]
         for node in vm_launcher.list():
             node_name = node.name
-            if node_name == target_name:
+            if node_name in target_names:
                 vm_launcher.destroy(node)
 
     __invoke_plugin_actions(env, actions, "local_actions", [vm_launcher, options])
 
     # Do we have remaining actions requiring an vm?
     if len(actions) > 0:
-        print('Setting up virtual machine')
+        if fleet:
+            _deploy_fleet(fleet, actions)
+        else:
+            print('Setting up virtual machine')
+            vm_launcher.boot_and_connect()
+            _setup_vm(options, vm_launcher, actions)
+
+
+def _build_vm_launcher(options):
+    if options["vm_provider"] == "novm":
+        return LocalVmLauncher(options)
+    else:
+        if not build_vm_launcher:
+            raise ImportError("Require vmlauncher: https://github.com/jmchilton/vm-launcher")
+        return build_vm_launcher(options)
+
+
+def _fleet_options(options):
+    """Options for each instance of a fleet, named by fleet_hostnames or numbered up to fleet_size.
+
+    Fleets always boot new instances, since use_existing_instance would attach
+    every launcher to the same node.
+    """
+    hostnames = options.get("fleet_hostnames")
+    if not hostnames and int(options.get("fleet_size") or 1) > 1:
+        base_hostname = options.get("hostname") or "vm_launcher_instance"
+        hostnames = ["%s-%s" % (base_hostname, i + 1) for i in range(int(options["fleet_size"]))]
+    if hostnames:
+        provider = options.get("vm_provider") or options.get("vm_host") or "aws"
+        driver_options = options.get(provider)
+        if isinstance(driver_options, dict) and "use_existing_instance" in driver_options:
+            raise ValueError("use_existing_instance in %s options cannot be combined with "
+                             "fleet_size or fleet_hostnames" % provider)
+    return [dict(options, hostname=hostname) for hostname in hostnames or []]
+
+
+def _deploy_fleet(fleet, actions):
+    """Boot all instances of a fleet concurrently, then set each up in a separate process.
+
+    Fabric keeps connection details in a shared global environment, so setup
+    runs in forked processes, as with fabric's own parallel execution.
+    Returns errors by hostname, None for successful instances, raising an error
+    after all instances finish if any failed.
+    """
+    launchers = [_build_vm_launcher(x) for x in fleet]
+    print('Setting up %s virtual machines' % len(launchers))
+    pool = ThreadPool(len(launchers))
+    try:
+        boot_errors = pool.map(_boot_fleet_instance, launchers)
+    finally:
+        pool.close()
+    results = {}
+    procs = []
+    for instance_options, vm_launcher, boot_error in zip(fleet, launchers, boot_errors):
+        if boot_error:
+            results[instance_options["hostname"]] = "boot failed: %s" % boot_error
+        else:
+            proc = multiprocessing.Process(target=_setup_vm, args=(instance_options, vm_launcher, set(actions)))
+            proc.start()
+            procs.append((instance_options["hostname"], proc))
+    for hostname, proc in procs:
+        proc.join()
+        results[hostname] = "setup failed with exit code %s" % proc.exitcode if proc.exitcode else None
+    print("Fleet deploy results:")
+    for hostname in sorted(results):
+        print("  %s: %s" % (hostname, results[hostname] or "ok"))
+    failed = sorted(x for x in results if results[x])
+    if failed:
+        raise Exception("Fleet deploy failed for %s of %s instances: %s" % (len(failed), len(results),
+                                                                            ", ".join(failed)))
+    return results
+
+
+def _boot_fleet_instance(vm_launcher):
+    try:
         vm_launcher.boot_and_connect()
-        _setup_vm(options, vm_launcher, actions)
+    except Exception as e:
+        return str(e) or e.__class__.__name__
+    return None
 
 
 class LocalVmLauncher:
@@ -139,7 +214,7 @@ def _expand_actions(actions):
     for simple_action in _possible_actions():
         if simple_action in actions:
             unique_actions.add(simple_action)
-    compound_actions = __get_plugin_actions(env, "compound_actions")
+    compound_actions = __get_plugin_actions(env, "compound_actions", actions)
     for compound_action in compound_actions.keys():
         if compound_action in actions:
             for compound_action_part in compound_actions[compound_action]:
@@ -167,7 +242,7 @@ def _possible_actions():
                          "detach_volumes",
                         ]
     for action_type in ["local_actions", "configure_actions", "ready_action"]:
-        for action in  __get_plugin_actions(env, action_type):
+        for action in  __get_plugin_action_names(env, action_type):
             possible_actions.append(action)
     return possible_actions
 
@@ -342,7 +417,7 @@ def get_main_options_string(options, key, default=''):
 
 
 def __invoke_plugin_actions(env, actions, action_type, provided_args):
-    possible_actions = __get_plugin_actions(env, action_type)
+    possible_actions = __get_plugin_actions(env, action_type, actions)
     for action in list(actions):
         if action in possible_actions:
             __invoke_plugin_action(env, possible_actions[action], provided_args)
@@ -355,34 +430,62 @@ def __invoke_plugin_action(env, action_function, provided_args):
     action_function(*args)
 
 
-def __get_plugin_actions(env, action_type):
+def __get_plugin_actions(env, action_type, requested=None):
+    """Retrieve plugin actions of a type, only importing modules providing requested actions.
+    """
     actions = {}
-    for plugin_module in __get_plugin_modules(env):
+    for plugin_module in __get_plugin_modules(env, action_type, requested):
         if hasattr(plugin_module, action_type):
             for action_name, action_function in getattr(plugin_module, action_type).iteritems():
                 actions[action_name] = action_function
     return actions
 
 
-def __get_plugin_modules(env):
+def __get_plugin_action_names(env, action_type):
+    """Retrieve names of plugin actions of a type from the action index.
+    """
+    names = []
+    for plugin_module_name in __get_plugin_module_names():
+        provided = ACTION_INDEX.get(plugin_module_name.split(".")[-1])
+        if provided is None:
+            module = __load_plugin_module(env, plugin_module_name)
+            provided = {action_type: list(getattr(module, action_type, {}).keys())}
+        names.extend(provided.get(action_type, []))
+    return names
+
+
+def __get_plugin_modules(env, action_type, requested=None):
+    module_names = []
+    for plugin_module_name in __get_plugin_module_names():
+        provided = ACTION_INDEX.get(plugin_module_name.split(".")[-1])
+        if provided is None:
+            module_names.append(plugin_module_name)
+        elif provided.get(action_type) and (requested is None or set(provided[action_type]) & set(requested)):
+            module_names.append(plugin_module_name)
+    ## Load modules in reverse order to allow hierarchical overrides
+    modules = []
+    for plugin_module_name in sorted(module_names, reverse=True):
+        module = __load_plugin_module(env, plugin_module_name)
+        if module is not None:
+            modules.append(module)
+    return modules
+
+
+def __load_plugin_module(env, plugin_module_name):
     if not "plugin_modules" in env:
-        unsorted_module_names = __get_plugin_module_names( )
-        ## Load modules in reverse order to allow hierarchical overrides
-        module_names = sorted(unsorted_module_names, reverse=True)
-        modules = []
-        for plugin_module_name in module_names:
-            try:
-                module = __import__(plugin_module_name)
-                for comp in plugin_module_name.split(".")[1:]:
-                    module = getattr(module, comp)
-                modules.append(module)
-            except BaseException as exception:
-                exception_str = str(exception)
-                message = "%s rule module could not be loaded: %s" % (plugin_module_name, exception_str)
-                env.logger.warn(message)
-                continue
-        env.plugin_modules = modules
-    return env.plugin_modules
+        env.plugin_modules = {}
+    if plugin_module_name not in env.plugin_modules:
+        module = None
+        try:
+            module = __import__(plugin_module_name)
+            for comp in plugin_module_name.split(".")[1:]:
+                module = getattr(module, comp)
+        except BaseException as exception:
+            exception_str = str(exception)
+            message = "%s rule module could not be loaded: %s" % (plugin_module_name, exception_str)
+            env.logger.warn(message)
+        env.plugin_modules[plugin_module_name] = module
+    return env.plugin_modules[plugin_module_name]
 
 
 def __get_plugin_module_names():
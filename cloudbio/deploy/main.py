@@ -15,6 +15,7 @@ ARG_PROPERTIES = [
   "runtime_properties",
   "vm_provider",
   "hostname",
+  "fleet_size",
 
   # CloudBioLinux options
   "target",
@@ -61,6 +62,7 @@ def parse_args():
     parser.add_argument('--file', dest="files", action="append", default=[], help="file to transfer to new instance")
     parser.add_argument("--vm_provider", dest="vm_provider", default=None, help="libcloud driver to use (or vagrant) (e.g. aws, openstack)")
     parser.add_argument("--hostname", dest="hostname", default=None, help="Newly created nodes are created with this specified hostname.")
+    parser.add_argument("--fleet_size", dest="fleet_size", type=int, default=None, help="Boot and configure this many instances in parallel, named <hostname>-1 to <hostname>-N.")
 
     # CloudBioLinux options
     parser.add_argument("--target", dest="target", default=None, help="Specify a CloudBioLinux target, used with action install_biolinux action")
@@ -13,4 +13,23 @@ ready_actions:
 compound_actions:
   Dictionary of list values. Key represents an short-cut action that is expanded to each action specified
   in corresponding value (a list of simple actions - standard or defined in the plugins).
+
+ACTION_INDEX:
+  Actions provided by each plugin module, by action type, so only modules providing requested actions
+  are imported. Keep in sync when adding actions; modules missing from the index are imported whenever
+  their action type is needed.
 """
+
+ACTION_INDEX = {
+    "cloudman": {
+        "local_actions": ["cloudman_launch", "sync_cloudman_bucket", "bundle_cloudman"],
+    },
+    "galaxy": {
+        "configure_actions": ["install_galaxy_tool"],
+    },
+    "gvl": {
+        "configure_actions": ["setup_image", "setup_genomes", "purge_genomes", "setup_galaxy", "purge_galaxy"],
+        "ready_actions": ["galaxy_transfer", "refresh_galaxy", "copy_runtime_properties"],
+        "compound_actions": ["configure", "reinstall_galaxy", "reinstall_genomes", "reinstall_tools"],
+    },
+}
@@ -6,7 +6,9 @@ from __future__ import print_function
 import os
 import time
 
+from cloudbio.biodata import taxonomy
 from cloudbio.biodata.genomes import install_data, install_data_s3
+from cloudbio.deploy import stash
 from cloudbio.deploy import get_main_options_string, _build_transfer_options, _do_transfer, transfer_files, get_boolean_option
 from cloudbio.deploy.util import wget, start_service, ensure_can_sudo_into, sudoers_append
 from cloudbio.galaxy.utils import _chown_galaxy
@@ -21,6 +23,8 @@ from fabric.api import put, run, env, sudo, get, cd
 from fabric.context_managers import prefix
 from fabric.contrib.files import append, contains, exists
 
+STASH_DIR = "genome_stash"
+
 
 ## Deprecated galaxy-vm-launcher way of setting up biodata.
 def setup_genomes(options):
@@ -45,6 +49,11 @@ def setup_taxonomy_data():
     """
     Setup up taxonomy data required by Galaxy. Need to find another place to put
     this, it is useful.
+
+    The GI to taxid dumps are merged with a parallel external sort into a
+    binary table (gi_taxid.bin) for lookups with
+    cloudbio.biodata.taxonomy.GiTaxonomy, also writing the sorted text file
+    used by Galaxy taxonomy tools from the same merge.
     """
     taxonomy_directory = os.path.join(env.data_files, "taxonomy")
     env.safe_sudo("mkdir -p '%s'" % taxonomy_directory, user=env.user)
@@ -55,42 +64,72 @@ def setup_taxonomy_data():
         wget(taxonomy_url)
         wget(gi_taxid_nucl)
         wget(gi_taxid_prot)
+        put(taxonomy.__file__.replace(".pyc", ".py"), "taxonomy.py")
         run("gunzip -c taxdump.tar.gz | tar xvf -")
-        run("gunzip gi_taxid_nucl.dmp.gz")
-        run("gunzip gi_taxid_prot.dmp.gz")
-        run("cat gi_taxid_nucl.dmp gi_taxid_prot.dmp > gi_taxid_all.dmp")
-        run("sort -n -k 1 gi_taxid_all.dmp > gi_taxid_sorted.txt")
-        run("rm gi_taxid_nucl.dmp gi_taxid_prot.dmp gi_taxid_all.dmp")
-        run("cat names.dmp | sed s/[\\(\\)\\'\\\"]/_/g > names.temporary")
+        run("python taxonomy.py build gi_taxid.bin gi_taxid_nucl.dmp.gz gi_taxid_prot.dmp.gz "
+            "--text gi_taxid_sorted.txt")
+        run("rm gi_taxid_nucl.dmp.gz gi_taxid_prot.dmp.gz")
+        run("python taxonomy.py names names.dmp names.temporary")
         run("mv names.dmp names.dmp.orig")
         run("mv names.temporary names.dmp")
+        run("rm taxonomy.py")
 
 
 def stash_genomes(where):
+    """Archive genome indices changed since the previous stash.
+
+    Writes a delta tar.gz plus manifest into a genome_stash directory, so
+    republishing after adding an index transfers only the new files. The
+    previous manifest is read from the download or /opt stash location.
+    """
     with _cd_indices_parent():
         sudo("chown %s:%s ." % (env.user, env.user))
         indices_dir_name = _indices_dir_name()
-        remote_compressed_indices = "%s.tar.gz" % indices_dir_name
-        run("tar czvf %s %s" % (remote_compressed_indices, indices_dir_name))
+        _put_stash_script()
+        run("mkdir -p %s" % STASH_DIR)
         if where == 'download':
-            get(remote_path=remote_compressed_indices,
-                local_path="compressed_genomes.tar.gz")
+            if os.path.exists(os.path.join(STASH_DIR, stash.MANIFEST)):
+                put(os.path.join(STASH_DIR, stash.MANIFEST), STASH_DIR)
         elif where == 'opt':
-            sudo("cp %s /opt/compressed_genomes.tar.gz" % remote_compressed_indices)
+            run("[ ! -f /opt/%s/%s ] || cp /opt/%s/%s %s" % (STASH_DIR, stash.MANIFEST, STASH_DIR,
+                                                            stash.MANIFEST, STASH_DIR))
         else:
             print("Invalid option specified for stash_genomes [%s] - valid values include download and opt." % where)
+            return
+        run("python stash.py create %s %s" % (indices_dir_name, STASH_DIR))
+        if where == 'download':
+            if not os.path.exists(STASH_DIR):
+                os.makedirs(STASH_DIR)
+            for fname in run("ls -1 %s" % STASH_DIR).split():
+                if fname == stash.MANIFEST or not os.path.exists(os.path.join(STASH_DIR, fname)):
+                    get(remote_path=os.path.join(STASH_DIR, fname),
+                        local_path=os.path.join(STASH_DIR, fname))
+        elif where == 'opt':
+            sudo("mkdir -p /opt/%s" % STASH_DIR)
+            sudo("cp -u %s/* /opt/%s/" % (STASH_DIR, STASH_DIR))
 
 
 def upload_genomes(options):
     with _cd_indices_parent():
         sudo("chown %s:%s ." % (env.user, env.user))
         indices_dir_name = _indices_dir_name()
-        _transfer_genomes(options)
-        run("rm -rf %s" % indices_dir_name)
-        run("tar xzvfm compressed_genomes.tar.gz")
+        if os.path.exists(os.path.join(STASH_DIR, stash.MANIFEST)):
+            _transfer_genomes(options, [os.path.join(STASH_DIR, f) for f in os.listdir(STASH_DIR)],
+                              os.path.join(_indices_parent(), STASH_DIR))
+            _put_stash_script()
+            run("rm -rf %s" % indices_dir_name)
+            run("python stash.py restore %s ." % STASH_DIR)
+        else:
+            _transfer_genomes(options)
+            run("rm -rf %s" % indices_dir_name)
+            run("tar xzvfm compressed_genomes.tar.gz")
         sudo("/etc/init.d/galaxy restart")
 
 
+def _put_stash_script():
+    put(stash.__file__.replace(".pyc", ".py"), "stash.py")
+
+
 def purge_genomes():
     sudo("rm -rf %s" % env.data_files)
 
@@ -159,12 +198,12 @@ def copy_runtime_properties(vm_launcher, options):
     sudo("echo '%s' > %s/runtime_properties" % (export_file, env.galaxy_home), user=env.galaxy_user)
 
 
-def _transfer_genomes(options):
+def _transfer_genomes(options, files=None, destination=None):
     # Use just transfer settings in YAML
     options = options['transfer']
-    transfer_options = _build_transfer_options(options, _indices_parent(), env.user)
+    transfer_options = _build_transfer_options(options, destination or _indices_parent(), env.user)
     transfer_options["compress"] = False
-    _do_transfer(transfer_options, ["compressed_genomes.tar.gz"])
+    _do_transfer(transfer_options, files or ["compressed_genomes.tar.gz"])
 
 
 def wait_for_galaxy():
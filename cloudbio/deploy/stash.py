@@ -0,0 +1,124 @@
+"""Incremental archives of a data directory, tracking changes with a file manifest.
+
+Each stash writes a tar.gz containing only files added or changed since the
+previous stash, along with a manifest of every file's size, modification time
+and SHA1. Unchanged files (same size and mtime as the previous manifest) are
+not re-read. Restoring applies the full archive and then each delta in order,
+removing files deleted in between.
+
+The module has no dependencies outside the standard library so it can be
+copied to and run on remote machines during deployment:
+
+  python stash.py create <data_dir> <stash_dir>
+  python stash.py restore <stash_dir> <parent_dir>
+"""
+from __future__ import print_function
+import argparse
+import hashlib
+import json
+import os
+import tarfile
+import time
+
+MANIFEST = "manifest.json"
+
+def _file_sha1(fname, block_size=8 * 1024 * 1024):
+    sha1 = hashlib.sha1()
+    with open(fname, "rb") as in_handle:
+        while True:
+            block = in_handle.read(block_size)
+            if not block:
+                break
+            sha1.update(block)
+    return sha1.hexdigest()
+
+def scan(data_dir, previous=None):
+    """Build a manifest of files in a directory, relative to its parent.
+
+    Hashes are reused from the previous manifest for files with unchanged size
+    and modification time.
+    """
+    previous = previous or {}
+    parent = os.path.dirname(os.path.abspath(data_dir))
+    out = {}
+    for dirpath, _, filenames in os.walk(os.path.abspath(data_dir)):
+        for filename in filenames:
+            full_path = os.path.join(dirpath, filename)
+            if os.path.islink(full_path) or not os.path.isfile(full_path):
+                continue
+            rel_path = os.path.relpath(full_path, parent)
+            stat = os.stat(full_path)
+            cur = {"size": stat.st_size, "mtime": int(stat.st_mtime)}
+            prev = previous.get(rel_path)
+            if prev and prev["size"] == cur["size"] and prev["mtime"] == cur["mtime"]:
+                cur["sha1"] = prev["sha1"]
+            else:
+                cur["sha1"] = _file_sha1(full_path)
+            out[rel_path] = cur
+    return out
+
+def load_manifest(stash_dir):
+    manifest_file = os.path.join(stash_dir, MANIFEST)
+    if os.path.exists(manifest_file):
+        with open(manifest_file) as in_handle:
+            return json.load(in_handle)
+    return {"archives": [], "files": {}}
+
+def create(data_dir, stash_dir):
+    """Write a delta archive of changes since the previous stash.
+
+    Returns the new archive, or None if nothing changed.
+    """
+    if not os.path.exists(stash_dir):
+        os.makedirs(stash_dir)
+    manifest = load_manifest(stash_dir)
+    files = scan(data_dir, manifest["files"])
+    changed = sorted(x for x, info in files.items()
+                     if manifest["files"].get(x, {}).get("sha1") != info["sha1"])
+    deleted = sorted(x for x in manifest["files"] if x not in files)
+    if not changed and not deleted:
+        print("No changes in %s since previous stash" % data_dir)
+        return None
+    archive = "%s-%04d.tar.gz" % (os.path.basename(os.path.abspath(data_dir)), len(manifest["archives"]))
+    parent = os.path.dirname(os.path.abspath(data_dir))
+    tx_archive = os.path.join(stash_dir, archive + ".tmp")
+    with tarfile.open(tx_archive, "w:gz") as tar:
+        for rel_path in changed:
+            tar.add(os.path.join(parent, rel_path), arcname=rel_path)
+    os.rename(tx_archive, os.path.join(stash_dir, archive))
+    manifest["archives"].append({"archive": archive, "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                                 "changed": len(changed), "deleted": deleted})
+    manifest["files"] = files
+    tx_manifest = os.path.join(stash_dir, MANIFEST + ".tmp")
+    with open(tx_manifest, "w") as out_handle:
+        json.dump(manifest, out_handle, indent=1, sort_keys=True)
+    os.rename(tx_manifest, os.path.join(stash_dir, MANIFEST))
+    print("Stashed %s changed and %s deleted files in %s" % (len(changed), len(deleted), archive))
+    return os.path.join(stash_dir, archive)
+
+def restore(stash_dir, parent_dir):
+    """Apply all archives in a stash directory in order, removing deleted files.
+    """
+    manifest = load_manifest(stash_dir)
+    for archive in manifest["archives"]:
+        with tarfile.open(os.path.join(stash_dir, archive["archive"])) as tar:
+            tar.extractall(parent_dir)
+        for rel_path in archive["deleted"]:
+            full_path = os.path.join(parent_dir, rel_path)
+            if os.path.exists(full_path):
+                os.remove(full_path)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Incremental archives of a data directory.")
+    subparsers = parser.add_subparsers(dest="command")
+    create_parser = subparsers.add_parser("create", help="Archive changes since the previous stash")
+    create_parser.add_argument("data_dir")
+    create_parser.add_argument("stash_dir")
+    restore_parser = subparsers.add_parser("restore", help="Restore a directory from a stash")
+    restore_parser.add_argument("stash_dir")
+    restore_parser.add_argument("parent_dir")
+    args = parser.parse_args()
+    if args.command == "create":
+        create(args.data_dir, args.stash_dir)
+    elif args.command == "restore":
+        restore(args.stash_dir, args.parent_dir)
@@ -58,14 +58,18 @@ class VmLauncher:
             self.conn = self._get_connection()
         return self.conn
 
-    def _wait_for_node_info(self, f):
+    def _wait_for_node_info(self, f, initial_delay=1, max_delay=30):
+        """Poll for node information, backing off from initial_delay up to max_delay seconds.
+        """
         initial_value = f(self.node)
         if initial_value:
             return self._parse_node_info(initial_value)
+        delay = initial_delay
         while True:
-            time.sleep(10)
+            time.sleep(delay)
+            delay = min(delay * 2, max_delay)
             refreshed_node = self._find_node()
-            refreshed_value = f(refreshed_node)
+            refreshed_value = refreshed_node and f(refreshed_node)
             if refreshed_value and not refreshed_value == []:
                 return self._parse_node_info(refreshed_value)
 
@@ -6,56 +6,152 @@ from .util import eval_template
 
 
 def attach_volumes(vm_launcher, options, format=False):
-    """
+    """Attach, format and mount all configured volumes.
+
+    Attach requests for every volume are issued up front and all volumes are
+    waited on together. Volumes needing formatting are formatted in parallel.
+    A volume entry with a `stripe` list of member volumes is assembled into a
+    RAID0 array on its `device` and mounted as a single filesystem:
+
+      volumes:
+        - path: /mnt/galaxyIndices
+          device: /dev/md0
+          filesystem: xfs
+          format: __auto__
+          stripe:
+            - {id: vol-XXXXXX, device: /dev/xvdf}
+            - {id: vol-YYYYYY, device: /dev/xvdg}
     """
     volumes = options.get("volumes", [])
     if not volumes:
         return
     boto_connection = vm_launcher.boto_connection()
     instance_id = run("curl --silent http://169.254.169.254/latest/meta-data/instance-id")
-    for volume in volumes:
-        volume_id = volume['id']
-        device_id = volume['device']
-        if not _get_attached(boto_connection, instance_id, device_id, valid_states=["attached", "attaching"]):
-            boto_connection.attach_volume(volume_id, instance_id, device_id)
-    for volume in volumes:
-        volume_id = volume['id']
+    attachments = _volume_attachments(volumes)
+    _attach_all(boto_connection, instance_id, attachments)
+    _wait_for_attached(boto_connection, instance_id, [device_id for _, device_id in attachments],
+                       timeout=int(options.get("volume_attach_timeout", 600)))
+
+    # Don't mount if already mounted
+    to_mount = [v for v in volumes if not _find_mounted_device_id(v.get("path"))]
+    for volume in to_mount:
+        if volume.get("stripe"):
+            _assemble_array(volume)
+    _format_devices([v for v in to_mount if _format_option(v) == "true"])
+    retry = []
+    for volume in to_mount:
         device_id = volume['device']
         path = volume.get("path")
-
-        while True:
-            if _get_attached(boto_connection, instance_id, device_id):
-                break
-
-            sleep(5)
-            print("Waiting for volume corresponding to device %s to attach" % device_id)
-            break
-
-        # Don't mount if already mounted
-        if _find_mounted_device_id(path):
-            continue
-
-        format = str(volume.get('format', "False")).lower()
-        if format == "true":
-            _format_device(device_id)
         env.safe_sudo("mkdir -p '%s'" % path)
         try:
             _mount(device_id, path)
         except:
-            if format == "__auto__":
-                print("Failed to mount device. format is set to __auto__ so will now format device and retry mount")
-                _format_device(device_id)
-                _mount(device_id, path)
+            if _format_option(volume) == "__auto__":
+                print("Failed to mount device %s. format is set to __auto__ so will now format device and retry mount" % device_id)
+                retry.append(volume)
             else:
                 raise
+    _format_devices(retry)
+    for volume in retry:
+        _mount(volume['device'], volume.get("path"))
+
+
+def _format_option(volume):
+    return str(volume.get('format', "False")).lower()
+
+
+def _volume_attachments(volumes):
+    """Retrieve (volume_id, device_id) for all EBS volumes, including striped array members.
+    """
+    out = []
+    for volume in volumes:
+        for member in volume.get("stripe") or [volume]:
+            out.append((member['id'], member['device']))
+    return out
+
+
+def _attach_all(conn, instance_id, attachments):
+    """Issue attach requests for all volumes not already attached or attaching.
+    """
+    current = _attached_devices(conn, instance_id, valid_states=["attached", "attaching"])
+    for volume_id, device_id in attachments:
+        if device_id not in current:
+            conn.attach_volume(volume_id, instance_id, device_id)
+
+
+def _attached_devices(conn, instance_id, valid_states=['attached']):
+    """Retrieve devices with attached volumes for an instance in a single API call.
+    """
+    out = set([])
+    for vol in conn.get_all_volumes(filters={"attachment.instance-id": instance_id}):
+        if vol.attach_data.instance_id == instance_id and vol.attach_data.status in valid_states:
+            out.add(vol.attach_data.device)
+    return out
+
+
+def _wait_for_attached(conn, instance_id, device_ids, timeout=600, initial_delay=1, max_delay=30):
+    """Wait for all devices to attach, polling with exponential backoff.
+    """
+    waited = 0
+    delay = initial_delay
+    while True:
+        missing = set(device_ids) - _attached_devices(conn, instance_id)
+        if not missing:
+            return
+        if waited >= timeout:
+            raise Exception("Volumes for devices %s did not attach within %s seconds" %
+                            (", ".join(sorted(missing)), timeout))
+        print("Waiting for volumes corresponding to devices %s to attach" % ", ".join(sorted(missing)))
+        sleep(delay)
+        waited += delay
+        delay = min(delay * 2, max_delay)
+
+
+def _assemble_array(volume):
+    """Assemble a RAID0 array from striped volume members, creating it if needed.
+    """
+    device_id = volume['device']
+    members = " ".join("'%s'" % x['device'] for x in volume["stripe"])
+    if env.safe_sudo("mdadm --detail '%s' > /dev/null 2>&1 && echo ok || true" % device_id).strip() == "ok":
+        return
+    assembled = env.safe_sudo("mdadm --assemble '%s' %s > /dev/null 2>&1 && echo ok || true" %
+                              (device_id, members)).strip() == "ok"
+    if not assembled:
+        if _format_option(volume) not in ["true", "__auto__"]:
+            raise Exception("Could not assemble striped array %s and format is not enabled" % device_id)
+        env.safe_sudo("mdadm --create '%s' --run --level=0 --chunk=256 --raid-devices=%s %s" %
+                      (device_id, len(volume["stripe"]), members))
+        volume["format"] = "true"
 
 
 def _mount(device_id, path):
     env.safe_sudo("mount '%s' '%s'" % (device_id, path))
 
 
-def _format_device(device_id):
-    env.safe_sudo("mkfs -t ext3 %s" % device_id)
+def _mkfs_command(device_id, filesystem="ext4"):
+    """Format command, skipping up front inode table and journal initialization.
+    """
+    if filesystem == "ext4":
+        return "mkfs -t ext4 -q -E lazy_itable_init=1,lazy_journal_init=1 %s" % device_id
+    elif filesystem == "xfs":
+        return "mkfs -t xfs -q -f -K %s" % device_id
+    else:
+        return "mkfs -t %s %s" % (filesystem, device_id)
+
+
+def _format_device(device_id, filesystem="ext4"):
+    env.safe_sudo(_mkfs_command(device_id, filesystem))
+
+
+def _format_devices(volumes):
+    """Format volumes in parallel on the remote machine, failing if any format fails.
+    """
+    if len(volumes) == 1:
+        _format_device(volumes[0]['device'], volumes[0].get("filesystem", "ext4"))
+    elif len(volumes) > 1:
+        cmds = ['(%s) & pids="$pids $!"' % _mkfs_command(v['device'], v.get("filesystem", "ext4"))
+                for v in volumes]
+        env.safe_sudo('pids=""; %s; for p in $pids; do wait $p || exit 1; done' % "; ".join(cmds))
 
 
 def detach_volumes(vm_launcher, options):
@@ -66,10 +162,12 @@ def detach_volumes(vm_launcher, options):
     boto_connection = vm_launcher.boto_connection()
     instance_id = run("curl --silent http://169.254.169.254/latest/meta-data/instance-id")
     for volume in volumes:
-        volume_id = volume['id']
         path = volume.get("path")
         env.safe_sudo("umount '%s'" % path)
-        _detach(boto_connection, instance_id, volume_id)
+        if volume.get("stripe"):
+            env.safe_sudo("mdadm --stop '%s'" % volume['device'])
+        for volume_id, _ in _volume_attachments([volume]):
+            _detach(boto_connection, instance_id, volume_id)
 
 
 def make_snapshots(vm_launcher, options):
@@ -80,13 +178,18 @@ def make_snapshots(vm_launcher, options):
         desc = eval_template(env, desc)
         # Allow volume to specify it should not be snapshotted, e.g. if
         # piggy backing on core teams snapshots for galaxyIndicies for instance.
+        # EBS snapshots are incremental at the block level, so by default the
+        # filesystem is frozen while the snapshot starts rather than detaching
+        # the volume. Set snapshot to `detach` for the unmount/detach cycle.
         snapshot = volume.get("snapshot", True)
-        if snapshot:
-            _make_snapshot(vm_launcher, path, desc)
+        if snapshot and volume.get("stripe"):
+            print("Skipping snapshot of striped array at %s, use stash_genomes for file level archives" % path)
+        elif snapshot:
+            _make_snapshot(vm_launcher, path, desc, detach=str(snapshot).lower() == "detach")
 
 
 def _get_attached(conn, instance_id, device_id, valid_states=['attached']):
-    vol_list = conn.get_all_volumes()
+    vol_list = conn.get_all_volumes(filters={"attachment.instance-id": instance_id})
     fs_vol = None
     for vol in vol_list:
         if vol.attach_data.instance_id == instance_id and vol.attach_data.device == device_id:
@@ -96,9 +199,11 @@ def _get_attached(conn, instance_id, device_id, valid_states=['attached']):
     return fs_vol
 
 
-def _make_snapshot(vm_launcher, fs_path, desc):
+def _make_snapshot(vm_launcher, fs_path, desc, detach=False):
     """ Create a snapshot of an existing volume that is currently attached to an
-    instance, taking care of the unmounting and detaching. If you specify the
+    instance. By default the file system is synced and frozen with fsfreeze
+    until the snapshot is initiated, leaving the volume attached and mounted.
+    With detach, takes care of the unmounting and detaching. If you specify the
     optional argument (:galaxy), the script will pull the latest Galaxy code
     from bitbucket and perform an update before snapshotting. Else, the script
     will prompt for the file system path to be snapshoted.
@@ -121,14 +226,23 @@ def _make_snapshot(vm_launcher, fs_path, desc):
     ec2_conn = vm_launcher.boto_connection()
     fs_vol = _get_attached(ec2_conn, instance_id, device_id)
     if fs_vol:
-        env.safe_sudo("umount %s" % fs_path)
-        _detach(ec2_conn, instance_id, fs_vol.id)
-        snap_id = _create_snapshot(ec2_conn, fs_vol.id, desc)
+        if detach:
+            env.safe_sudo("umount %s" % fs_path)
+            _detach(ec2_conn, instance_id, fs_vol.id)
+            snap_id = _create_snapshot(ec2_conn, fs_vol.id, desc)
+        else:
+            env.safe_sudo("sync")
+            env.safe_sudo("fsfreeze -f %s" % fs_path)
+            try:
+                snapshot = ec2_conn.create_snapshot(fs_vol.id, description=desc)
+            finally:
+                env.safe_sudo("fsfreeze -u %s" % fs_path)
+            snap_id = _wait_for_snapshot(snapshot, fs_vol.id)
         # TODO: Auto Update snaps?
         make_public = True
         if make_public:  # Make option
             ec2_conn.modify_snapshot_attribute(snap_id, attribute='createVolumePermission', operation='add', groups=['all'])
-        reattach = True
+        reattach = detach
         if reattach:
             _attach(ec2_conn, instance_id, fs_vol.id, device_id)
             env.safe_sudo("mount %s %s" % (device_id, fs_path))
@@ -209,6 +323,10 @@ def _create_snapshot(ec2_conn, volume_id, description=None):
     Wait until the snapshot process is complete (note that this may take quite a while)
     """
     snapshot = ec2_conn.create_snapshot(volume_id, description=description)
+    return _wait_for_snapshot(snapshot, volume_id)
+
+
+def _wait_for_snapshot(snapshot, volume_id):
     if snapshot:
         while snapshot.status != 'completed':
             sleep(6)
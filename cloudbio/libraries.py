@@ -51,47 +51,91 @@ def _make_install_script(out_file, config):
     if config.get("biocrepo"):
         repo_info += """\nsource("%s")\n""" % config["biocrepo"]
     env.safe_append(out_file, repo_info)
+    cache_dir = '"%s"' % config["binary_cache"] if config.get("binary_cache") else "NULL"
+    ncpus = config.get("ncpus") or "max(1, parallel::detectCores(), na.rm=TRUE)"
+    env.safe_append(out_file, """
+    lib.loc <- "%s"
+    ncpus <- %s
+    binary.cache <- %s
+    """ % (lib_loc, ncpus, cache_dir))
+    # A single installed package snapshot, refreshed after each batch of installs,
+    # and built packages cached by R version and platform for reuse on other machines.
     install_fn = """
-    repo.installer <- function(repos, install.fn, pkg_name_fn) {
+    ipkgs <- installed.packages()[, "Version"]
+    refresh.installed <- function() {
+      before <- ipkgs
+      ipkgs <<- installed.packages()[, "Version"]
+      names(ipkgs)[is.na(before[names(ipkgs)]) | before[names(ipkgs)] != ipkgs]
+    }
+    cache.dir <- NULL
+    if (!is.null(binary.cache))
+      cache.dir <- file.path(binary.cache,
+                             paste(R.version$major, strsplit(R.version$minor, ".", fixed=TRUE)[[1]][1], sep="."),
+                             R.version$platform)
+    from.cache <- function(pkgs, repos) {
+      if (is.null(cache.dir) || is.null(repos) || length(pkgs) == 0)
+        return(pkgs)
+      avail <- available.packages(repos=repos)
+      deps <- tools::package_dependencies(intersect(pkgs, rownames(avail)), db=avail,
+                                          which=c("Depends", "Imports", "LinkingTo"), recursive=TRUE)
+      for (p in setdiff(intersect(unique(c(pkgs, unlist(deps))), rownames(avail)), names(ipkgs))) {
+        cache.file <- file.path(cache.dir, paste0(p, "_", avail[p, "Version"], ".tar.gz"))
+        if (file.exists(cache.file))
+          untar(cache.file, exdir=lib.loc)
+      }
+      refresh.installed()
+      setdiff(pkgs, names(ipkgs))
+    }
+    to.cache <- function(pkgs) {
+      if (is.null(cache.dir))
+        return(invisible(NULL))
+      dir.create(cache.dir, recursive=TRUE, showWarnings=FALSE)
+      for (p in pkgs[file.exists(file.path(lib.loc, pkgs))]) {
+        cache.file <- file.path(cache.dir, paste0(p, "_", ipkgs[p], ".tar.gz"))
+        tx.file <- paste0(cache.file, ".", Sys.getpid(), ".tmp")
+        if (!file.exists(cache.file) && system2("tar", c("-czf", tx.file, "-C", lib.loc, p)) == 0)
+          file.rename(tx.file, cache.file)
+      }
+    }
+    repo.installer <- function(repos, install.fn) {
       %s
-      maybe.install <- function(pname) {
-        if (!is.null(pkg_name_fn)) {
-           pinfo <- pkg_name_fn(pname)
-           ipkgs <- installed.packages()[,3][pinfo["pkg"]]
-           if (is.na(ipkgs[pinfo["pkg"]]) || pinfo["version"] != ipkgs[pinfo["pkg"]])
-             try(install.fn(pinfo["pname"]))
+      function(pkgs) {
+        pkgs <- from.cache(setdiff(pkgs, names(ipkgs)), repos)
+        if (length(pkgs) > 0) {
+          install.fn(pkgs, Ncpus=ncpus)
+          to.cache(refresh.installed())
         }
-        else if (!(is.element(pname, installed.packages()[,1])))
-           install.fn(pname)
       }
-
     }
     """
     if config.get("update_packages", True):
         update_str = """
-        update.packages(lib.loc="%s", repos=repos, ask=FALSE)
-        """ % lib_loc
+        if (!is.null(repos)) {
+          update.packages(lib.loc=lib.loc, repos=repos, ask=FALSE, Ncpus=ncpus)
+          to.cache(refresh.installed())
+        }
+        """
     else:
         update_str = "\n"
     env.safe_append(out_file, install_fn % update_str)
     if len(config.get("cran") or []) > 0:
         std_install = """
         std.pkgs <- c(%s)
-        std.installer = repo.installer(cran.repos, install.packages, NULL)
-        lapply(std.pkgs, std.installer)
+        std.installer = repo.installer(cran.repos, install.packages)
+        std.installer(std.pkgs)
         """ % (", ".join('"%s"' % p for p in config['cran']))
         env.safe_append(out_file, std_install)
     if len(config.get("bioc") or []) > 0:
         bioc_install = """
         bioc.pkgs <- c(%s)
-        bioc.installer = repo.installer(biocinstallRepos(), biocLite, NULL)
-        lapply(bioc.pkgs, bioc.installer)
+        bioc.installer = repo.installer(biocinstallRepos(), biocLite)
+        bioc.installer(bioc.pkgs)
         """ % (", ".join('"%s"' % p for p in config['bioc']))
         env.safe_append(out_file, bioc_install)
     if config.get("cran-after-bioc"):
         std2_install = """
         std2.pkgs <- c(%s)
-        lapply(std2.pkgs, std.installer)
+        std.installer(std2.pkgs)
         """ % (", ".join('"%s"' % p for p in config['cran-after-bioc']))
         env.safe_append(out_file, std2_install)
     if config.get("github"):
@@ -103,10 +147,11 @@ def _make_install_script(out_file, config):
             version=unlist(strsplit(orig, ";"))[2],
             pname=unlist(strsplit(orig, ";"))[1])
         }
-        gh_install <- function(name) {
-          install_github(name, upgrade_dependencies=FALSE)
+        for (orig in github.pkgs) {
+          pinfo <- get_pkg_name(orig)
+          if (is.na(ipkgs[pinfo["pkg"]]) || pinfo["version"] != ipkgs[pinfo["pkg"]])
+            try(install_github(pinfo["pname"], upgrade_dependencies=FALSE))
         }
-        github_installer = repo.installer(NULL, gh_install, get_pkg_name)
-        lapply(github.pkgs, github_installer)
+        refresh.installed()
         """ % (", ".join('"%s"' % p for p in config['github']))
-        env.safe_append(out_file, dev_install)
\ No newline at end of file
+        env.safe_append(out_file, dev_install)
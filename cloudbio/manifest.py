@@ -4,13 +4,21 @@ This provides an output YAML file with package details, providing a complete
 dump of installed software and packages. The YAML output feeds into a BioGems
 style webpage that provides a more human friendly view of installed packages.
 The version information provides a reproducible dump of software on a system.
+
+Package sources are queried concurrently and only re-queried when their
+fingerprint, the modification times of files the package manager updates on
+install, changes. All packages are also combined into manifest.json, with
+differences from the previous manifest in manifest-diff.json.
 """
 import os
 import collections
+import glob
 import json
 import inspect
 import subprocess
 import sys
+import time
+from multiprocessing.pool import ThreadPool
 
 from six.moves import urllib
 
@@ -21,16 +29,109 @@ try:
 except ImportError:
     yolk = None
 
-def create(out_dir, tooldir="/usr/local", fetch_remote=False):
+def create(out_dir, tooldir="/usr/local", fetch_remote=False, sources=("python", "r")):
     """Create a manifest in the output directory with installed packages.
+
+    sources selects from python, r, debian, brew and custom packages.
     """
     if not os.path.exists(out_dir):
         os.makedirs(out_dir)
-    #write_debian_pkg_info(out_dir, fetch_remote)
-    write_python_pkg_info(out_dir)
-    write_r_pkg_info(out_dir)
-    #write_brew_pkg_info(out_dir, tooldir)
-    #write_custom_pkg_info(out_dir, tooldir)
+    writers = {"debian": lambda: write_debian_pkg_info(out_dir, fetch_remote),
+               "python": lambda: write_python_pkg_info(out_dir),
+               "r": lambda: write_r_pkg_info(out_dir),
+               "brew": lambda: write_brew_pkg_info(out_dir, tooldir),
+               "custom": lambda: write_custom_pkg_info(out_dir, tooldir)}
+    fingerprint_file = os.path.join(out_dir, "manifest-fingerprints.json")
+    prev_fingerprints = _read_json(fingerprint_file) or {}
+    fingerprints = dict((source, _source_fingerprint(source, tooldir)) for source in sources)
+    stale = []
+    for source in sources:
+        out_files = [os.path.join(out_dir, x) for x in SOURCE_FILES[source]]
+        if (fingerprints[source] is None or fingerprints[source] != prev_fingerprints.get(source)
+                or not all(os.path.exists(x) for x in out_files)):
+            for out_file in out_files:
+                if os.path.exists(out_file):
+                    os.remove(out_file)
+            stale.append(source)
+    if stale:
+        pool = ThreadPool(len(stale))
+        try:
+            pool.map(lambda source: writers[source](), stale)
+        finally:
+            pool.close()
+    _write_json(fingerprint_file, fingerprints)
+    return write_combined_manifest(out_dir, sources)
+
+# ## Incremental updates and combined manifest
+
+SOURCE_FILES = {"debian": ["debian-packages.yaml", "debian-base-packages.yaml"],
+                "python": ["python-packages.yaml"],
+                "r": ["r-packages.yaml"],
+                "brew": ["brew-packages.yaml"],
+                "custom": ["custom-packages.yaml"]}
+
+def _source_fingerprint(source, tooldir):
+    """Retrieve modification times of files updated when packages in a source change.
+
+    Returns None when no files are found, so the source is always queried.
+    """
+    conda_prefix = os.path.dirname(os.path.dirname(os.path.realpath(sys.executable)))
+    if source == "debian":
+        paths = ["/var/lib/dpkg/status"]
+    elif source == "python":
+        paths = [os.path.join(conda_prefix, "conda-meta")] + \
+                glob.glob(os.path.join(conda_prefix, "envs", "*", "conda-meta")) + \
+                glob.glob(os.path.join(conda_prefix, "lib", "python*", "site-packages"))
+    elif source == "r":
+        paths = [os.path.join(conda_prefix, "lib", "R", "library")] + \
+                glob.glob(os.path.join(tooldir, "lib", "R", "*library"))
+    elif source == "brew":
+        paths = [os.path.join(tooldir, "Cellar")]
+    elif source == "custom":
+        paths = glob.glob(os.path.join(os.path.dirname(__file__), "custom", "*.py"))
+    else:
+        raise ValueError("Unexpected manifest source: %s" % source)
+    paths = sorted(x for x in paths if os.path.exists(x))
+    if not paths:
+        return None
+    return [[x, os.path.getmtime(x)] for x in paths]
+
+def _read_json(in_file):
+    if os.path.exists(in_file):
+        with open(in_file) as in_handle:
+            return json.load(in_handle)
+
+def _write_json(out_file, data):
+    with open(out_file + ".tmp", "w") as out_handle:
+        json.dump(data, out_handle, indent=1, sort_keys=True)
+    os.rename(out_file + ".tmp", out_file)
+
+def write_combined_manifest(out_dir, sources):
+    """Combine package versions from all sources, writing differences from the previous manifest.
+    """
+    out_file = os.path.join(out_dir, "manifest.json")
+    packages = {}
+    for source in sources:
+        for fname in SOURCE_FILES[source]:
+            in_file = os.path.join(out_dir, fname)
+            if os.path.exists(in_file):
+                with open(in_file) as in_handle:
+                    pkgs = yaml.safe_load(in_handle) or {}
+                packages[fname.replace("-packages.yaml", "")] = \
+                    dict((name, str(pkg.get("version", ""))) for name, pkg in pkgs.items())
+    previous = _read_json(out_file)
+    if previous:
+        diff = {"previous": previous["created"], "sources": {}}
+        for source in sorted(set(packages.keys()) | set(previous["packages"].keys())):
+            old, new = previous["packages"].get(source, {}), packages.get(source, {})
+            cur = {"added": dict((k, v) for k, v in new.items() if k not in old),
+                   "removed": dict((k, v) for k, v in old.items() if k not in new),
+                   "changed": dict((k, [old[k], v]) for k, v in new.items() if k in old and old[k] != v)}
+            if any(cur.values()):
+                diff["sources"][source] = cur
+        _write_json(os.path.join(out_dir, "manifest-diff.json"), diff)
+    _write_json(out_file, {"created": time.strftime("%Y-%m-%dT%H:%M:%S"), "packages": packages})
+    return out_file
 
 # ## Custom packages
 
@@ -5,21 +5,23 @@ https://github.com/Homebrew/linuxbrew
 from __future__ import print_function
 import contextlib
 from distutils.version import LooseVersion
+import json
 import os
 import sys
 
-import yaml
-
 from cloudbio.custom import system, shared
 from cloudbio.flavor.config import get_config_file
 from cloudbio.fabutils import quiet, find_cmd
 from cloudbio.package import cpan
-from cloudbio.package.shared import _yaml_to_packages
+from cloudbio.package.shared import _load_yaml, _yaml_to_packages
 
 from fabric.api import cd, settings
 
 BOTTLE_URL = "https://s3.amazonaws.com/cloudbiolinux/brew_bottles/{pkg}-{version}.x86_64-linux.bottle.tar.gz"
 BOTTLE_SUPPORTED = set(["isaac-aligner", "isaac-variant-caller", "cmake"])
+# Formulae built without their dependencies, or needing other packages unlinked while building
+IGNORE_DEPENDENCIES = set(["lumpy-sv", "bamtools", "freebayes", "git"])
+BUILD_UNLINKS = {"lumpy-sv": ["bamtools"]}
 
 def install_packages(env, to_install=None, packages=None):
     """Install packages using the home brew package manager.
@@ -50,14 +52,16 @@ def install_packages(env, to_install=None, packages=None):
     ipkgs = {"outdated": set([x.strip() for x in env.safe_run_output("%s outdated" % brew_cmd).split()]),
              "current": _get_current_pkgs(env, brew_cmd)}
     _install_brew_baseline(env, brew_cmd, ipkgs, packages)
-    ipkgs = {"outdated": set([x.strip() for x in env.safe_run_output("%s outdated" % brew_cmd).split()]),
-             "current": _get_current_pkgs(env, brew_cmd)}
-    for pkg_str in packages:
-        _install_pkg(env, pkg_str, brew_cmd, ipkgs)
+    _refresh_current_pkgs(env, brew_cmd, ipkgs)
+    workers = int(env.get("brew_workers", 1))
+    bottle_store = env.get("brew_bottle_store") if env.distribution != "macosx" else None
+    if not ((workers > 1 or bottle_store) and
+            _install_pkgs_by_deps(env, packages, brew_cmd, ipkgs, workers, bottle_store)):
+        for pkg_str in packages:
+            _install_pkg(env, pkg_str, brew_cmd, ipkgs)
     for pkg_str in ["pkg-config", "openssl", "cmake", "unzip"]:
         _safe_unlink_pkg(env, pkg_str, brew_cmd)
-    with open(config_file.base) as in_handle:
-        to_remove = yaml.safe_load(in_handle).get("to_remove", [])
+    to_remove = (_load_yaml(config_file.base) or {}).get("to_remove", [])
     for pkg_str in ["curl"] + to_remove:
         _safe_uninstall_pkg(env, pkg_str, brew_cmd)
 
@@ -67,8 +71,7 @@ def _remove_old(env, config_file):
     brew_cmd = os.path.join(env.system_install, "bin", "brew")
     if env.safe_exists(brew_cmd):
         baseline = ["pkg-config", "openssl", "cmake", "unzip", "curl"]
-        with open(config_file) as in_handle:
-            to_remove = yaml.safe_load(in_handle).get("to_remove", [])
+        to_remove = (_load_yaml(config_file) or {}).get("to_remove", [])
         for pkg_str in baseline + to_remove:
             _safe_uninstall_pkg(env, pkg_str, brew_cmd)
 
@@ -133,6 +136,17 @@ def _get_current_pkgs(env, brew_cmd):
                 out[pkg] = version
     return out
 
+def _refresh_current_pkgs(env, brew_cmd, ipkgs):
+    """Update installed versions after installs, avoiding a slow re-run of `brew outdated`.
+
+    Formulae with a changed or removed version are no longer outdated.
+    """
+    current = _get_current_pkgs(env, brew_cmd)
+    changed = set(x for x in set(current) | set(ipkgs["current"])
+                  if current.get(x) != ipkgs["current"].get(x))
+    ipkgs["outdated"] = set(x for x in ipkgs["outdated"] if x.split("/")[-1] not in changed)
+    ipkgs["current"] = current
+
 def _safe_unlink_pkg(env, pkg_str, brew_cmd):
     """Unlink packages which can cause issues with a Linux system.
     """
@@ -252,17 +266,22 @@ def _latest_pkg_version(env, brew_cmd, pkg, devel=False):
                 is_linked = git_line.strip().split()[-1] == "*"
     return version, is_linked
 
-def _get_brew_install_cmd(brew_cmd, env, pkg):
+def _get_brew_build_env(env):
     perl_setup = "export PERL5LIB=%s/lib/perl5:${PERL5LIB}" % env.system_install
     compiler_setup = "export CC=${CC:-`which gcc`} && export CXX=${CXX:-`which g++`}"
     shell_setup = "export SHELL=${SHELL:-/bin/bash}"
+    return "%s && %s && %s" % (compiler_setup, shell_setup, perl_setup)
+
+def _has_custom_install(pkg):
+    return pkg in ["cmake"] or pkg in IGNORE_DEPENDENCIES or pkg in BUILD_UNLINKS
+
+def _get_brew_install_cmd(brew_cmd, env, pkg):
     extra_args = ""
     if pkg in ["cmake"]:
         extra_args += " --without-docs"
-    if pkg in ["lumpy-sv", "bamtools", "freebayes", "git"]:
+    if pkg in IGNORE_DEPENDENCIES:
         extra_args += " --ignore-dependencies"
-    return "%s && %s && %s && %s install --env=inherit %s" % (compiler_setup, shell_setup, perl_setup,
-                                                              brew_cmd, extra_args)
+    return "%s && %s install --env=inherit %s" % (_get_brew_build_env(env), brew_cmd, extra_args)
 
 def _install_pkg_latest(env, pkg, args, brew_cmd, ipkgs):
     """Install the latest version of the given package.
@@ -304,13 +323,12 @@ def _custom_unlink(env, brew_cmd, pkg):
 
     Does a temporary unlink and relink of packages while building.
     """
-    unlinks = {"lumpy-sv": ["bamtools"]}
-    for upkg in unlinks.get(pkg, []):
+    for upkg in BUILD_UNLINKS.get(pkg, []):
         _safe_unlink_pkg(env, upkg, brew_cmd)
     try:
         yield None
     finally:
-        for upkg in unlinks.get(pkg, []):
+        for upkg in BUILD_UNLINKS.get(pkg, []):
             with settings(warn_only=True):
                 with quiet():
                     env.safe_run("%s link --overwrite %s" % (brew_cmd, upkg))
@@ -363,6 +381,199 @@ def _install_bottle(env, brew_cmd, pkg, ipkgs):
     else:
         return False
 
+# ## Dependency ordered installs with a shared bottle store
+
+def _install_pkgs_by_deps(env, packages, brew_cmd, ipkgs, workers, bottle_store):
+    """Install formulae and their dependencies level by level through the dependency graph.
+
+    Bottles from the bottle store, or BOTTLE_URL for BOTTLE_SUPPORTED formulae,
+    are poured directly. Everything else is fetched concurrently up front and
+    built `workers` at a time once all dependencies are installed. Kegs installed
+    here are added to the bottle store, so hosts sharing it pour instead of compiling.
+    Formulae with versions or build arguments install afterwards as usual.
+
+    Returns False if brew cannot report dependencies, for a serial install instead.
+    """
+    serial, full_names = [], {}
+    for pkg_str in packages:
+        pkg, version, args = _get_pkg_version_args(pkg_str)
+        if version or args:
+            serial.append(pkg_str)
+        else:
+            full_names[pkg.split("/")[-1]] = pkg
+    requested = set(full_names)
+    deps = _brew_deps(env, brew_cmd, requested, full_names)
+    if deps is None:
+        return False
+    nodes = set(requested)
+    for pkg in requested - IGNORE_DEPENDENCIES:
+        nodes |= deps.get(pkg, set())
+    deps.update(_brew_deps(env, brew_cmd, nodes - set(deps), full_names) or {})
+    info = _brew_formula_info(env, brew_cmd, [full_names.get(x, x) for x in sorted(nodes)])
+    todo, upgrade, unlinked = set(), set(), []
+    for pkg in nodes:
+        cur_version = ipkgs["current"].get(pkg)
+        version = info.get(pkg, {}).get("stable")
+        if pkg in ipkgs["outdated"] or full_names.get(pkg) in ipkgs["outdated"]:
+            todo.add(pkg)
+            upgrade.add(pkg)
+        elif cur_version is None:
+            todo.add(pkg)
+        elif version and cur_version != version and cur_version.split("_")[0] != version:
+            todo.add(pkg)
+            upgrade.add(pkg)
+        elif pkg in requested and not info.get(pkg, {}).get("linked"):
+            unlinked.append(pkg)
+    if unlinked:
+        env.safe_run("%s link --overwrite %s" % (brew_cmd, " ".join(sorted(unlinked))))
+    # a dependency's recursive dependencies are a subset of its dependents, so it sorts first
+    levels = {}
+    for pkg in sorted(todo, key=lambda x: (len(deps.get(x, [])), x)):
+        levels[pkg] = max([levels.get(d, 0) + 1 for d in deps.get(pkg, []) if d in todo] or [0])
+    bottles = _find_bottles(env, brew_cmd, todo, info, bottle_store, workers)
+    _fetch_pkgs(env, brew_cmd, [full_names.get(x, x) for x in sorted(todo) if x not in bottles], workers)
+    brew_cellar = os.path.join(env.safe_run_output("%s --prefix" % brew_cmd), "Cellar")
+    for level in sorted(set(levels.values())):
+        cur = sorted(x for x, l in levels.items() if l == level)
+        env.logger.info("Installing brew formulae: %s" % " ".join(cur))
+        custom = [x for x in cur if x not in bottles and _has_custom_install(x)]
+        batch = [x for x in cur if x not in custom]
+        if [x for x in batch if x in upgrade]:
+            env.safe_run("%s remove --force %s" % (brew_cmd, " ".join(x for x in batch if x in upgrade)))
+        _pour_bottles(env, brew_cellar, [bottles[x] for x in batch if x in bottles], workers)
+        _build_parallel(env, brew_cmd, [full_names.get(x, x) for x in batch if x not in bottles], workers)
+        _refresh_current_pkgs(env, brew_cmd, ipkgs)
+        # report failures, and build custom formulae, with the standard serial install
+        for pkg in cur:
+            if pkg in custom or pkg not in ipkgs["current"]:
+                _install_pkg_latest(env, full_names.get(pkg, pkg), [], brew_cmd, ipkgs)
+        if batch:
+            with settings(warn_only=True):
+                env.safe_run("%s link --overwrite %s" % (brew_cmd, " ".join(batch)))
+        _refresh_current_pkgs(env, brew_cmd, ipkgs)
+        if bottle_store:
+            _store_bottles(env, brew_cellar, bottle_store, [x for x in cur if x not in bottles], ipkgs)
+    for pkg_str in serial:
+        _install_pkg(env, pkg_str, brew_cmd, ipkgs)
+    return True
+
+def _brew_deps(env, brew_cmd, pkgs, full_names):
+    """Retrieve recursive dependencies of formulae, by short name.
+
+    Records tap qualified names of formulae in `full_names`.
+    """
+    if not pkgs:
+        return {}
+    with quiet():
+        with settings(warn_only=True):
+            deps_str = env.safe_run_output("%s deps --for-each %s" %
+                                           (brew_cmd, " ".join(full_names.get(x, x) for x in sorted(pkgs))))
+    if deps_str.failed:
+        return None
+    out = {}
+    for line in deps_str.split("\n"):
+        if line.find(":") > 0:
+            pkg, pkg_deps = line.split(":", 1)
+            out[pkg.strip().split("/")[-1]] = set()
+            for dep in pkg_deps.split():
+                if dep.find("/") > 0:
+                    full_names.setdefault(dep.split("/")[-1], dep)
+                out[pkg.strip().split("/")[-1]].add(dep.split("/")[-1])
+    return out
+
+def _brew_formula_info(env, brew_cmd, pkgs):
+    """Retrieve available version, with any revision, and linked state for formulae in one call.
+    """
+    out = {}
+    if pkgs:
+        with quiet():
+            with settings(warn_only=True):
+                info_str = env.safe_run_output("%s info --json=v1 %s" % (brew_cmd, " ".join(pkgs)))
+        if info_str.succeeded and info_str.find("[") >= 0:
+            for pkg in json.loads(info_str[info_str.find("["):]):
+                version = pkg["versions"]["stable"]
+                out[pkg["name"]] = {"stable": version, "linked": pkg.get("linked_keg"),
+                                    "version": "%s_%s" % (version, pkg["revision"]) if pkg.get("revision")
+                                               else version}
+    return out
+
+def _bottle_name(pkg, version):
+    return os.path.basename(BOTTLE_URL.format(pkg=pkg, version=version))
+
+def _find_bottles(env, brew_cmd, pkgs, info, bottle_store, workers):
+    """Find bottles for formulae in the bottle store, downloading BOTTLE_URL bottles concurrently.
+    """
+    out = {}
+    if env.distribution == "macosx":  # Only Linux bottles, build away on Mac
+        return out
+    if bottle_store:
+        with quiet():
+            with settings(warn_only=True):
+                stored = set(env.safe_run_output("ls -1 %s" % bottle_store).split())
+        for pkg in pkgs:
+            if pkg in info and _bottle_name(pkg, info[pkg]["version"]) in stored:
+                out[pkg] = os.path.join(bottle_store, _bottle_name(pkg, info[pkg]["version"]))
+    urls = dict((pkg, BOTTLE_URL.format(pkg=pkg, version=info[pkg]["stable"])) for pkg in pkgs
+                if pkg in BOTTLE_SUPPORTED and pkg in info and pkg not in out)
+    if urls:
+        brew_cachedir = env.safe_run_output("%s --cache" % brew_cmd)
+        with settings(warn_only=True):
+            env.safe_run("cd %s && echo %s | xargs -n 1 -P %s sh -c "
+                         "'f=`basename \"$0\"`; test -s \"$f\" || "
+                         "(wget -q -O \"$f.part\" \"$0\" && mv \"$f.part\" \"$f\") || rm -f \"$f.part\"'"
+                         % (brew_cachedir, " ".join(sorted(urls.values())), workers))
+        with quiet():
+            cached = set(env.safe_run_output("ls -1 %s" % brew_cachedir).split())
+        for pkg, url in urls.items():
+            if os.path.basename(url) in cached:
+                out[pkg] = os.path.join(brew_cachedir, os.path.basename(url))
+    return out
+
+def _fetch_pkgs(env, brew_cmd, pkgs, workers):
+    """Download upstream bottles, or source when unavailable, for formulae concurrently.
+    """
+    if pkgs:
+        with settings(warn_only=True):
+            env.safe_run("export HOMEBREW_NO_AUTO_UPDATE=1 && echo %s | xargs -n 1 -P %s %s fetch"
+                         % (" ".join(pkgs), workers, brew_cmd))
+
+def _pour_bottles(env, brew_cellar, bottle_files, workers):
+    """Unpack bottles into the Cellar, ready for linking.
+    """
+    if bottle_files:
+        with quiet():
+            env.safe_run("mkdir -p %s" % brew_cellar)
+        with cd(brew_cellar):
+            with settings(warn_only=True):
+                env.safe_run("echo %s | xargs -n 1 -P %s tar -xf" % (" ".join(bottle_files), workers))
+
+def _build_parallel(env, brew_cmd, pkgs, workers):
+    """Install independent formulae concurrently, with dependencies already in place.
+
+    Failures are left for the serial install to retry and report.
+    """
+    if pkgs:
+        with settings(warn_only=True):
+            env.safe_run("%s && export HOMEBREW_NO_AUTO_UPDATE=1 && echo %s | "
+                         "xargs -n 1 -P %s %s install --env=inherit --ignore-dependencies"
+                         % (_get_brew_build_env(env), " ".join(pkgs), workers, brew_cmd))
+
+def _store_bottles(env, brew_cellar, bottle_store, pkgs, ipkgs):
+    """Add installed kegs to the bottle store for pouring on other hosts.
+
+    Kegs are not relocated, so hosts sharing a store need the same install prefix.
+    """
+    pkgs = [x for x in pkgs if ipkgs["current"].get(x)]
+    if pkgs:
+        env.safe_run("mkdir -p %s" % bottle_store)
+    for pkg in pkgs:
+        version = ipkgs["current"][pkg]
+        out_file = os.path.join(bottle_store, _bottle_name(pkg, version))
+        with cd(brew_cellar):
+            with settings(warn_only=True):
+                env.safe_run("tar -czf {out_file}.$$.tmp {pkg}/{version} && mv {out_file}.$$.tmp {out_file}"
+                             .format(**locals()))
+
 def _install_brew_baseline(env, brew_cmd, ipkgs, packages):
     """Install baseline brew components not handled by dependency system.
 
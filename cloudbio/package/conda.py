@@ -6,9 +6,8 @@ import json
 import os
 import shutil
 import subprocess
-import yaml
 
-from cloudbio.package.shared import _yaml_to_packages
+from cloudbio.package.shared import _load_yaml, _yaml_to_packages
 
 ENV_PY_VERSIONS = collections.defaultdict(lambda: "python=3.6")
 ENV_PY_VERSIONS[None] = "python=3.6"
@@ -79,8 +78,7 @@ def install_in(conda_bin, system_installdir, config_file=None, packages=None):
         check_channels = []
     else:
         (packages, _) = _yaml_to_packages(config_file)
-        with open(config_file) as in_handle:
-            check_channels = yaml.safe_load(in_handle).get("channels", [])
+        check_channels = _load_yaml(config_file).get("channels", [])
     channels = " ".join(["-c %s" % x for x in check_channels])
     conda_envs = _create_environments(conda_bin, packages)
     for env_dir in conda_envs.values():
@@ -106,17 +104,17 @@ def install_in(conda_bin, system_installdir, config_file=None, packages=None):
             subprocess.check_call("{conda_bin} remove {channels} -y {problems}".format(**locals()), shell=True)
     _initial_base_install(conda_bin, [ps for (n, ps) in _split_by_condaenv(packages) if n is None][0],
                           check_channels)
+    linker = BinLinker(system_installdir, conda_info, conda_bin)
     # install our customized packages
     if len(packages) > 0:
         for env_name, env_packages in _split_by_condaenv(packages):
             print("# Installing into conda environment %s: %s" % (env_name or "default", ", ".join(env_packages)))
             conda_pkg_list = _install_env_pkgs(env_name, env_packages, conda_bin, conda_envs, channels)
-            for package in env_packages:
-                _link_bin(package, system_installdir, conda_info, conda_bin, conda_pkg_list,
-                            conda_envdir=conda_envs.get(env_name))
+            linker.add(env_packages, conda_pkg_list, conda_envdir=conda_envs.get(env_name))
     conda_pkg_list = json.loads(subprocess.check_output("{conda_bin} list --json".format(**locals()), shell=True))
     for pkg in ["python", "conda", "pip"]:
-        _link_bin(pkg, system_installdir, conda_info, conda_bin, conda_pkg_list, files=[pkg], prefix="bcbio_")
+        linker.add([pkg], conda_pkg_list, files=[pkg], prefix="bcbio_")
+    linker.link()
 
 def _initial_base_install(conda_bin, env_packages, check_channels):
     """Provide a faster initial installation of base packages, avoiding dependency issues.
@@ -156,43 +154,91 @@ def _initial_base_install(conda_bin, env_packages, check_channels):
                 # https://github.com/bcbio/bcbio-nextgen/issues/2871
                 pass
 
-def _link_bin(package, system_installdir, conda_info, conda_bin, conda_pkg_list, files=None,
-              prefix="", conda_env=None, conda_envdir=None):
-    """Link files installed in the bin directory into the install directory.
+class BinLinker(object):
+    """Link files installed in conda bin directories into the install directory.
 
     This is imperfect but we're trying not to require injecting everything in the anaconda
     directory into a user's path.
+
+    Packages from `conda list --json` are indexed by name, binaries for each
+    package found from the info/files manifest in the package cache, and all
+    links created or updated together by `link`.
     """
-    package = package.split("=")[0].split(">")[0]
-    final_bindir = os.path.join(system_installdir, "bin")
-    if conda_envdir:
-        base_bindir = os.path.join(conda_envdir, "bin")
-    else:
-        base_bindir = os.path.dirname(conda_bin)
-    # resolve any symlinks in the final and base heirarchies
-    final_bindir = subprocess.check_output("cd %s && pwd -P" % final_bindir, shell=True).decode().strip()
-    base_bindir = subprocess.check_output("cd %s && pwd -P" % base_bindir, shell=True).decode().strip()
-    for pkg_subdir in [x for x in conda_pkg_list if x["name"] == package]:
-        pkg_subdir = pkg_subdir["dist_name"].split("::")[-1]
-        for pkg_dir in conda_info["pkgs_dirs"]:
-            pkg_bindir = os.path.join(os.path.realpath(pkg_dir), pkg_subdir, "bin")
-            python_bindir = os.path.join(os.path.dirname(pkg_bindir), "python-scripts")
-            if (os.path.commonprefix([pkg_bindir, base_bindir]).find("anaconda") > 0 and
-                    (os.path.exists(python_bindir) or os.path.exists(pkg_bindir))):
-                if not files:
-                    if not os.path.exists(python_bindir):
-                        python_bindir = ""
-                    if not os.path.exists(pkg_bindir):
-                        pkg_bindir = ""
-                    files = subprocess.check_output("ls -1 {pkg_bindir} {python_bindir}"
-                                                    .format(**locals()), shell=True).decode().split()
-                for fname in files:
+    def __init__(self, system_installdir, conda_info, conda_bin):
+        self._final_bindir = os.path.realpath(os.path.join(system_installdir, "bin"))
+        self._base_bindir = os.path.realpath(os.path.dirname(conda_bin))
+        self._pkgs_dirs = [os.path.realpath(x) for x in conda_info["pkgs_dirs"]]
+        self._links = collections.OrderedDict()
+
+    def add(self, packages, conda_pkg_list, files=None, prefix="", conda_envdir=None):
+        """Add links for binaries from packages, installed in a base or named environment.
+        """
+        base_bindir = os.path.realpath(os.path.join(conda_envdir, "bin")) if conda_envdir else self._base_bindir
+        by_name = collections.defaultdict(list)
+        for pkg in conda_pkg_list:
+            by_name[pkg["name"]].append(pkg["dist_name"].split("::")[-1])
+        for package in packages:
+            package = package.split("=")[0].split(">")[0]
+            for dist_name in by_name.get(package, []):
+                for fname in (files or self._package_bin_files(dist_name, base_bindir)):
                     # symlink to the original file in the /anaconda/bin directory
                     # this could be a hard or soft link
                     base_fname = os.path.join(base_bindir, fname)
-                    if os.path.exists(base_fname) and os.path.lexists(base_fname):
-                        _do_link(base_fname,
-                                 os.path.join(final_bindir, "%s%s" % (prefix, fname)))
+                    if os.path.exists(base_fname):
+                        final_fname = os.path.join(self._final_bindir, "%s%s" % (prefix, fname))
+                        self._links.pop(final_fname, None)
+                        self._links[final_fname] = base_fname
+
+    def _package_bin_files(self, dist_name, base_bindir):
+        """Retrieve names of binaries in a package from its cached info/files manifest.
+        """
+        out = []
+        for pkg_dir in self._pkgs_dirs:
+            if os.path.commonprefix([pkg_dir, base_bindir]).find("anaconda") <= 0:
+                continue
+            manifest = os.path.join(pkg_dir, dist_name, "info", "files")
+            if os.path.exists(manifest):
+                with open(manifest) as in_handle:
+                    for line in in_handle:
+                        parts = line.strip().split("/")
+                        if len(parts) == 2 and parts[0] in ["bin", "python-scripts"] and parts[1] not in out:
+                            out.append(parts[1])
+        return out
+
+    def plan(self):
+        """Retrieve links needing changes, as (action, final_file, orig_file) tuples.
+        """
+        out = []
+        for final_file, orig_file in self._links.items():
+            if not os.path.lexists(final_file):
+                out.append(("create", final_file, orig_file))
+            elif not _is_link_to(final_file, orig_file):
+                out.append(("update", final_file, orig_file))
+        return out
+
+    def link(self, dry_run=False):
+        """Create and update all links, or only report the changes with dry_run.
+        """
+        changes = self.plan()
+        for action, final_file, orig_file in changes:
+            if dry_run:
+                print("%s %s -> %s" % ("+" if action == "create" else "~", final_file, orig_file))
+            else:
+                _do_link(orig_file, final_file)
+        return changes
+
+def _link_bin(package, system_installdir, conda_info, conda_bin, conda_pkg_list, files=None,
+              prefix="", conda_env=None, conda_envdir=None):
+    """Link files installed in the bin directory of a single package into the install directory.
+    """
+    linker = BinLinker(system_installdir, conda_info, conda_bin)
+    linker.add([package], conda_pkg_list, files, prefix, conda_envdir)
+    return linker.link()
+
+def _is_link_to(final_file, orig_file):
+    return (os.path.islink(final_file) and os.path.exists(final_file) and
+            os.path.realpath(final_file) == os.path.realpath(orig_file) and
+            orig_file == os.path.normpath(os.path.join(os.path.dirname(final_file), os.readlink(final_file))))
 
 def _do_link(orig_file, final_file):
     """Perform a soft link of the original file into the final location.
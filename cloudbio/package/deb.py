@@ -1,6 +1,10 @@
 """
 Automated installation on debian package systems with apt.
 """
+import os
+import re
+import tempfile
+
 from fabric.api import *
 from fabric.contrib.files import *
 
@@ -21,11 +25,17 @@ def _apt_packages(to_install=None, pkg_list=None):
     :type pkg_list:  list
     :param pkg_list: An explicit list of packages to install. No other files,
                      flavors are considered.
+
+    All packages install in a single transaction, after downloading the full
+    set of required .debs in parallel. Set ``apt_archive_dir`` to share
+    downloaded .debs between builds and ``apt_proxy`` to use a local caching
+    mirror.
     """
+    apt_opts = _apt_options()
     if "minimal" not in env.flavor.short_name:
         env.logger.info("Update the system")
         with settings(warn_only=True):
-            env.safe_sudo("apt-get update")
+            env.safe_sudo("apt-get %s update" % apt_opts)
     if to_install is not None:
         config_file = get_config_file(env, "packages.yaml")
         if "minimal" not in env.flavor.name and "minimal" not in env.flavor.short_name:
@@ -37,16 +47,78 @@ def _apt_packages(to_install=None, pkg_list=None):
         packages = pkg_list
     else:
         raise ValueError("Need a file with packages or a list of packages")
-    # A single line install is much faster - note that there is a max
-    # for the command line size, so we do 30 at a time
-    group_size = 30
-    i = 0
+    packages = _available_apt_packages(packages)
     env.logger.info("Installing %i packages" % len(packages))
-    while i < len(packages):
-        env.logger.info("Package install progress: {0}/{1}".format(i, len(packages)))
-        env.safe_sudo("apt-get -y --force-yes install %s" % " ".join(packages[i:i + group_size]))
-        i += group_size
-    env.safe_sudo("apt-get clean")
+    if packages:
+        _prefetch_apt_packages(packages, apt_opts)
+        env.safe_sudo("apt-get %s -y --force-yes install %s" % (apt_opts, " ".join(packages)))
+    # Keep shared archive directories for other builds
+    if not env.get("apt_archive_dir"):
+        env.safe_sudo("apt-get clean")
+
+def _apt_options():
+    """apt-get options for a shared .deb archive directory and caching proxy, if configured.
+    """
+    opts = []
+    if env.get("apt_archive_dir"):
+        env.safe_sudo("mkdir -p %s" % os.path.join(env.apt_archive_dir, "partial"))
+        opts.append("-o Dir::Cache::Archives=%s" % env.apt_archive_dir)
+    if env.get("apt_proxy"):
+        opts.append("-o Acquire::http::Proxy=%s" % env.apt_proxy)
+    return " ".join(opts)
+
+def _available_apt_packages(packages):
+    """Remove packages unknown to apt, which would fail the whole install transaction.
+    """
+    with settings(hide("stdout")):
+        # --all-names includes virtual packages, installable through their providers
+        available = set(env.safe_run_output("apt-cache pkgnames --all-names").split())
+    out = []
+    for p in packages:
+        if re.split("[=:]", p)[0] in available:
+            out.append(p)
+        else:
+            env.logger.warn("Skipping package not available from apt sources: %s" % p)
+    return out
+
+def _prefetch_apt_packages(packages, apt_opts, workers=8):
+    """Resolve the dependency closure of all packages once and download .debs in parallel.
+
+    apt uses the downloaded files in its archive directory, verifying them
+    and retrieving anything missed during the install.
+    """
+    # --print-uris only simulates the install, so does not need root
+    with settings(hide("stdout"), warn_only=True):
+        out = env.safe_run_output("apt-get %s -y --force-yes -qq --print-uris install %s"
+                                  % (apt_opts, " ".join(packages)))
+    if out.failed:
+        return
+    uris = []
+    for line in out.splitlines():
+        if line.startswith("'"):
+            url, fname = line.split()[:2]
+            uris.append("%s %s" % (url.strip("'"), fname))
+    if not uris:
+        return
+    env.logger.info("Downloading %i packages with %i connections" % (len(uris), workers))
+    archive_dir = env.get("apt_archive_dir") or "/var/cache/apt/archives"
+    # Download from a script, avoiding shell variables in the command itself,
+    # which the local sudo wrapper would expand too early
+    remote_files = {"/tmp/cloudbiolinux-apt-uris.txt": "\n".join(uris) + "\n",
+                    "/tmp/cloudbiolinux-apt-fetch.sh":
+                    'test -s "$2" || (wget -q -O "$2.part" "$1" && mv "$2.part" "$2") || rm -f "$2.part"\n'}
+    for remote_file, contents in remote_files.items():
+        with tempfile.NamedTemporaryFile("w", delete=False) as out_handle:
+            out_handle.write(contents)
+        try:
+            env.safe_put(out_handle.name, remote_file)
+        finally:
+            os.remove(out_handle.name)
+    proxy = "http_proxy=%s " % env.apt_proxy if env.get("apt_proxy") else ""
+    with settings(warn_only=True):
+        env.safe_sudo("cd %s && %sxargs -P %s -L 1 sh /tmp/cloudbiolinux-apt-fetch.sh "
+                      "< /tmp/cloudbiolinux-apt-uris.txt" % (archive_dir, proxy, workers))
+    env.safe_run("rm -f %s" % " ".join(sorted(remote_files)))
 
 def _add_apt_gpg_keys():
     """Adds GPG keys from all repositories
@@ -1,29 +1,77 @@
 """Shared functionality useful for multiple package managers.
 """
 from __future__ import print_function
+import copy
+import json
+import os
+
 import yaml
 
+# libyaml based loader when available, several times faster on large package lists
+YamlLoader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+# Parsed YAML files persist here between runs, keyed by path, modification time and size
+YAML_CACHE_FILE = os.path.join(os.path.expanduser("~"), ".cache", "cloudbiolinux", "yaml-cache.json")
+
+_yaml_cache = {}
+_disk_cache = {}
+_package_cache = {}
+
+def _load_yaml(yaml_file):
+    """Load a YAML configuration file, parsing each file once per process.
+
+    Returns a copy so callers can modify the configuration.
+    """
+    return copy.deepcopy(_read_yaml(yaml_file)[1])
+
+def _read_yaml(yaml_file):
+    """Retrieve the cache key and parsed contents of a YAML file.
+
+    Files are keyed by path, modification time and size, and parsed contents
+    persisted in YAML_CACHE_FILE so later runs skip parsing unchanged files.
+    """
+    stat = os.stat(yaml_file)
+    key = (os.path.abspath(yaml_file), stat.st_mtime, stat.st_size)
+    if key not in _yaml_cache:
+        if not _disk_cache:
+            _disk_cache.update(_read_yaml_cache())
+        cached = _disk_cache.get(key[0])
+        if cached and (cached["mtime"], cached["size"]) == key[1:]:
+            data = cached["data"]
+        else:
+            with open(yaml_file) as in_handle:
+                data = yaml.load(in_handle, Loader=YamlLoader)
+            _write_yaml_cache(key, data)
+        _yaml_cache[key] = data
+    return key, _yaml_cache[key]
+
 def _yaml_to_packages(yaml_file, to_install=None, subs_yaml_file=None, namesort=True, env=None):
     """Read a list of packages from a nested YAML configuration file.
+
+    Results are memoized by the configuration files, the sections to install
+    and the distribution.
     """
     print("Reading packages from %s" % yaml_file)
-    with open(yaml_file) as in_handle:
-        full_data = yaml.safe_load(in_handle)
-        if full_data is None:
-            full_data = {}
-    if subs_yaml_file is not None:
-        with open(subs_yaml_file) as in_handle:
-            subs = yaml.safe_load(in_handle)
-    else:
-        subs = {}
+    file_key, full_data = _read_yaml(yaml_file)
+    subs_key, subs = _read_yaml(subs_yaml_file) if subs_yaml_file is not None else (None, None)
+    env_key = (env.distribution, env.dist_name, env.is_64bit) if env else None
+    to_install_key = tuple(sorted(to_install)) if isinstance(to_install, (list, tuple, set)) else to_install
+    key = (file_key, subs_key, to_install_key, namesort, env_key)
+    if key not in _package_cache:
+        _package_cache[key] = _flatten_packages(full_data or {}, to_install, subs or {}, namesort, env)
+    packages, pkg_to_group = _package_cache[key]
+    return list(packages), dict(pkg_to_group)
+
+def _flatten_packages(full_data, to_install, subs, namesort, env):
     # filter the data based on what we have configured to install
     data = [(k, v) for (k, v) in full_data.items()
             if (to_install is None or k in to_install) and k not in ["channels"]]
     data.sort()
+    # process as a stack, with nested sections handled before later siblings
+    data.reverse()
     packages = []
     pkg_to_group = dict()
     while len(data) > 0:
-        cur_key, cur_info = data.pop(0)
+        cur_key, cur_info = data.pop()
         if cur_info:
             if isinstance(cur_info, (list, tuple)):
                 packages.extend(_filter_subs_packages(cur_info, subs, namesort))
@@ -34,16 +82,45 @@ def _yaml_to_packages(yaml_file, to_install=None, subs_yaml_file=None, namesort=
                     # if we are okay, propagate with the top level key
                     if env and key == 'needs_64bit':
                         if env.is_64bit:
-                            data.insert(0, (cur_key, val))
+                            data.append((cur_key, val))
                     elif env and key.startswith(env.distribution):
                         if key.endswith(env.dist_name):
-                            data.insert(0, (cur_key, val))
+                            data.append((cur_key, val))
                     else:
-                        data.insert(0, (cur_key, val))
+                        data.append((cur_key, val))
             else:
                 raise ValueError(cur_info)
     return packages, pkg_to_group
 
+def _read_yaml_cache():
+    if os.path.exists(YAML_CACHE_FILE):
+        try:
+            with open(YAML_CACHE_FILE) as in_handle:
+                return json.load(in_handle)
+        except ValueError:
+            pass
+    return {}
+
+def _write_yaml_cache(key, data):
+    """Persist parsed YAML, skipping contents JSON cannot represent exactly.
+    """
+    try:
+        if json.loads(json.dumps(data)) != data:
+            return
+    except (TypeError, ValueError):
+        return
+    _disk_cache[key[0]] = {"mtime": key[1], "size": key[2], "data": data}
+    try:
+        cache_dir = os.path.dirname(YAML_CACHE_FILE)
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        tx_cache_file = "%s.%s.tmp" % (YAML_CACHE_FILE, os.getpid())
+        with open(tx_cache_file, "w") as out_handle:
+            json.dump(_disk_cache, out_handle)
+        os.rename(tx_cache_file, YAML_CACHE_FILE)
+    except (IOError, OSError):
+        pass
+
 def _filter_subs_packages(initial, subs, namesort=True):
     """Rename and filter package list with subsitutions; for similar systems.
     """
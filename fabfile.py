@@ -16,12 +16,12 @@ Requires:
     PyYAML http://pyyaml.org/wiki/PyYAMLDocumentation
 """
 import os
+import re
 import sys
 from datetime import datetime
 
 from fabric.api import *
 from fabric.contrib.files import *
-import yaml
 
 # use local cloudbio directory
 for to_remove in [p for p in sys.path if p.find("cloudbiolinux-") > 0]:
@@ -34,7 +34,7 @@ from cloudbio.utils import _setup_logging, _configure_fabric_environment
 from cloudbio.cloudman import _cleanup_ec2, _configure_cloudman
 from cloudbio.cloudbiolinux import _cleanup_space, _freenx_scripts
 from cloudbio.custom import shared
-from cloudbio.package.shared import _yaml_to_packages
+from cloudbio.package.shared import _load_yaml, _yaml_to_packages
 from cloudbio.package import brew, conda
 from cloudbio.package import (_configure_and_install_native_packages,
                               _connect_native_packages, _print_shell_exports)
@@ -355,8 +355,7 @@ def _read_main_config():
     Reads 'main.yaml' and returns packages and libraries
     """
     yaml_file = get_config_file(env, "main.yaml").base
-    with open(yaml_file) as in_handle:
-        full_data = yaml.safe_load(in_handle)
+    full_data = _load_yaml(yaml_file)
     packages = full_data.get('packages', [])
     packages = env.flavor.rewrite_config_items("main_packages", packages)
     libraries = full_data.get('libraries', [])
@@ -371,9 +370,25 @@ def _read_main_config():
 
 # ### Library specific installation code
 
+def _library_cache_dir(name):
+    """Retrieve a directory for downloaded or built libraries, shared between hosts.
+
+    Uses a subdirectory of the optional `library_cache_dir` setting.
+    """
+    if env.get("library_cache_dir"):
+        cache_dir = os.path.join(env.library_cache_dir, name)
+        env.safe_run("mkdir -p %s" % cache_dir)
+        return cache_dir
+
+def _parallel_make():
+    return "export MAKEFLAGS=-j`getconf _NPROCESSORS_ONLN` && "
+
 def _python_library_installer(config):
     """Install python specific libraries using pip, conda and easy_install.
     Handles using isolated anaconda environments.
+
+    Missing and outdated packages install with a single pip command, building
+    wheels into the shared library cache when configured.
     """
     if shared._is_anaconda(env):
         conda_bin = shared._conda_cmd(env)
@@ -389,30 +404,82 @@ def _python_library_installer(config):
         with settings(warn_only=True):
             env.safe_sudo("%s -U distribute" % ei_bin)
         cmd = env.safe_sudo
-    for pname in env.flavor.rewrite_config_items("python", config['pypi']):
-        cmd("{0} install --upgrade {1} --allow-unverified {1} --allow-external {1}".format(shared._pip_cmd(env), pname)) # fixes problem with packages not being in pypi
+    pip_bin = shared._pip_cmd(env)
+    to_install = _pip_missing_or_outdated(pip_bin, env.flavor.rewrite_config_items("python", config['pypi']))
+    if to_install:
+        # fixes problem with packages not being in pypi
+        pkgs = " ".join("'%s'" % x for x in to_install)
+        allow = " ".join("--allow-unverified {0} --allow-external {0}".format(_pip_name(x)) for x in to_install)
+        find_links = ""
+        cache_dir = _library_cache_dir("wheels")
+        if cache_dir:
+            find_links = "--find-links %s" % cache_dir
+            with settings(warn_only=True):
+                cmd("{0} wheel --wheel-dir {1} {2} {3} {4}".format(pip_bin, cache_dir, find_links, allow, pkgs))
+        cmd("{0} install --upgrade {1} {2} {3}".format(pip_bin, find_links, allow, pkgs))
+
+def _pip_name(pname):
+    return re.split(r"[<>=!~;\[ ]", pname)[0].strip()
+
+def _pip_missing_or_outdated(pip_bin, pnames):
+    """Retrieve packages that are not installed, at a different pinned version or outdated.
+
+    Checks installed and outdated packages once, rather than per package.
+    """
+    norm = lambda x: _pip_name(x).lower().replace("_", "-")
+    with settings(hide('warnings', 'running', 'stdout', 'stderr'), warn_only=True):
+        freeze = env.safe_run_output("%s freeze" % pip_bin)
+        outdated = env.safe_run_output("%s list --outdated" % pip_bin)
+    if freeze.failed or outdated.failed:
+        return pnames
+    installed = dict((norm(l), l.split("==")[1].strip()) for l in freeze.split("\n") if l.find("==") > 0)
+    outdated = set(norm(l.split()[0].split("==")[0]) for l in outdated.split("\n")
+                   if l.strip() and not l.startswith(("Package", "---")))
+    out = []
+    for pname in pnames:
+        name = norm(pname)
+        pin = pname.split("==")[1].strip() if pname.find("==") > 0 else None
+        if name not in installed or name in outdated or (pin and installed[name] != pin):
+            out.append(pname)
+    return out
 
 def _ruby_library_installer(config):
     """Install ruby specific gems.
+
+    Installs missing gems and updates outdated ones with one command each,
+    sharing downloaded .gem files through the library cache when configured.
     """
     gem_ext = getattr(env, "ruby_version_ext", "")
-    def _cur_gems():
-        with settings(
-                hide('warnings', 'running', 'stdout', 'stderr')):
-            gem_info = env.safe_run_output("gem%s list --no-versions" % gem_ext)
-        return [l.rstrip("\r") for l in gem_info.split("\n") if l.rstrip("\r")]
-    installed = _cur_gems()
-    for gem in env.flavor.rewrite_config_items("ruby", config['gems']):
-        # update current gems only to check for new installs
-        if gem not in installed:
-            installed = _cur_gems()
-        if gem in installed:
-            env.safe_sudo("gem%s update %s" % (gem_ext, gem))
-        else:
-            env.safe_sudo("gem%s install %s" % (gem_ext, gem))
+    with settings(
+            hide('warnings', 'running', 'stdout', 'stderr')):
+        gem_info = env.safe_run_output("gem%s list --no-versions" % gem_ext)
+        with settings(warn_only=True):
+            outdated_info = env.safe_run_output("gem%s outdated" % gem_ext)
+    installed = set(l.rstrip("\r") for l in gem_info.split("\n") if l.rstrip("\r"))
+    outdated = set()
+    if outdated_info.succeeded:
+        outdated = set(l.split()[0] for l in outdated_info.split("\n") if l.strip())
+    gems = env.flavor.rewrite_config_items("ruby", config['gems'])
+    cache_dir = _library_cache_dir("gems")
+    if cache_dir:
+        gem_cache = os.path.join(env.safe_run_output("gem%s env gemdir" % gem_ext).strip(), "cache")
+        with settings(warn_only=True):
+            env.safe_sudo("mkdir -p %s && cp -n %s/*.gem %s" % (gem_cache, cache_dir, gem_cache))
+    to_update = [x for x in gems if x in installed and x in outdated]
+    if to_update:
+        env.safe_sudo("%sgem%s update %s" % (_parallel_make(), gem_ext, " ".join(to_update)))
+    to_install = [x for x in gems if x not in installed]
+    if to_install:
+        env.safe_sudo("%sgem%s install %s" % (_parallel_make(), gem_ext, " ".join(to_install)))
+    if cache_dir and (to_update or to_install):
+        with settings(warn_only=True):
+            env.safe_run("cp -n %s/*.gem %s" % (gem_cache, cache_dir))
 
 def _perl_library_installer(config):
     """Install perl libraries from CPAN with cpanminus.
+
+    All libraries install with a single cpanm command, saving and reusing
+    distribution tarballs from the library cache when configured.
     """
     with shared._make_tmp_dir() as tmp_dir:
         with cd(tmp_dir):
@@ -421,11 +488,16 @@ def _perl_library_installer(config):
             env.safe_run("chmod a+rwx cpanm")
             env.safe_sudo("mv cpanm %s/bin" % env.system_install)
     sudo_str = "--sudo" if env.use_sudo else ""
-    for lib in env.flavor.rewrite_config_items("perl", config['cpan']):
-        # Need to hack stdin because of some problem with cpanminus script that
-        # causes fabric to hang
-        # http://agiletesting.blogspot.com/2010/03/getting-past-hung-remote-processes-in.html
-        env.safe_run("cpanm %s --skip-installed --notest %s < /dev/null" % (sudo_str, lib))
+    cache_str = ""
+    cache_dir = _library_cache_dir("cpan")
+    if cache_dir:
+        cache_str = "--save-dists %s --mirror file://%s --mirror http://www.cpan.org" % (cache_dir, cache_dir)
+    libs = env.flavor.rewrite_config_items("perl", config['cpan'])
+    # Need to hack stdin because of some problem with cpanminus script that
+    # causes fabric to hang
+    # http://agiletesting.blogspot.com/2010/03/getting-past-hung-remote-processes-in.html
+    env.safe_run("%scpanm %s %s --skip-installed --notest %s < /dev/null" %
+                 (_parallel_make(), sudo_str, cache_str, " ".join(libs)))
 
 def _haskell_library_installer(config):
     """Install haskell libraries using cabal.
@@ -454,6 +526,5 @@ def install_libraries(language):
 def _do_library_installs(to_install):
     for iname in to_install:
         yaml_file = get_config_file(env, "%s.yaml" % iname).base
-        with open(yaml_file) as in_handle:
-            config = yaml.safe_load(in_handle)
+        config = _load_yaml(yaml_file)
         lib_installers[iname](config)
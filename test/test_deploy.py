@@ -0,0 +1,52 @@
+"""Unit tests for deploying instances, using fake VM launchers.
+
+Run with: python -m pytest test/
+"""
+import pytest
+
+pytest.importorskip("fabric.api")
+from cloudbio import deploy
+
+
+class FakeLauncher:
+    def __init__(self, options):
+        self.options = options
+
+    def boot_and_connect(self):
+        if self.options["hostname"].endswith("-2"):
+            raise IOError("no capacity")
+
+    def get_ip(self):
+        return self.options["hostname"]
+
+
+def _fake_setup_vm(options, vm_launcher, actions):
+    if options["hostname"].endswith("-3"):
+        raise SystemExit(1)
+
+
+def test_fleet_options():
+    fleet = deploy._fleet_options({"vm_provider": "aws", "hostname": "node", "fleet_size": 3})
+    assert [x["hostname"] for x in fleet] == ["node-1", "node-2", "node-3"]
+    assert deploy._fleet_options({"vm_provider": "aws", "hostname": "node"}) == []
+
+
+def test_fleet_rejects_existing_instance():
+    with pytest.raises(ValueError):
+        deploy._fleet_options({"vm_provider": "aws", "hostname": "node", "fleet_size": 2,
+                               "aws": {"use_existing_instance": "__auto__"}})
+    with pytest.raises(ValueError):
+        deploy._fleet_options({"vm_provider": "aws", "fleet_hostnames": ["a", "b"],
+                               "aws": {"use_existing_instance": "i-1234"}})
+
+
+def test_deploy_fleet_errors(monkeypatch):
+    monkeypatch.setattr(deploy, "_build_vm_launcher", FakeLauncher)
+    monkeypatch.setattr(deploy, "_setup_vm", _fake_setup_vm)
+    fleet = deploy._fleet_options({"vm_provider": "novm", "hostname": "node", "fleet_size": 4})
+    with pytest.raises(Exception) as excinfo:
+        deploy._deploy_fleet(fleet, ["install_custom"])
+    assert "failed for 2 of 4 instances: node-2, node-3" in str(excinfo.value)
+    monkeypatch.setattr(FakeLauncher, "boot_and_connect", lambda self: None)
+    monkeypatch.setattr(deploy, "_setup_vm", lambda *args: None)
+    assert deploy._deploy_fleet(fleet[:1] + fleet[3:], ["install_custom"]) == {"node-1": None, "node-4": None}
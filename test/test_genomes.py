@@ -0,0 +1,131 @@
+"""Unit tests for genome preparation and indexing helpers.
+
+Run with: python -m pytest test/
+"""
+import ftplib
+import gzip
+import io
+import os
+import stat
+import subprocess
+import types
+from urllib.error import URLError
+
+import pytest
+
+from cloudbio.biodata import genomes
+
+def _fake_tool(bin_dir, name, script):
+    path = os.path.join(str(bin_dir), name)
+    with open(path, "w") as out_handle:
+        out_handle.write("#!/bin/sh\n%s\n" % script)
+    os.chmod(path, os.stat(path).st_mode | stat.S_IEXEC)
+
+def _dangling_links(base_dir):
+    out = []
+    for d, dirs, files in os.walk(base_dir):
+        for name in dirs + files:
+            path = os.path.join(d, name)
+            if os.path.islink(path) and not os.path.exists(path):
+                out.append(path)
+    return out
+
+def test_staged_index_links_genome_dir(tmpdir, monkeypatch):
+    work_dir = tmpdir.mkdir("hg19")
+    seq_dir = work_dir.mkdir("seq")
+    seq_dir.join("hg19.fa").write(">chr1\nACGT\n")
+    seq_dir.join("hg19.fa.fai").write("chr1\t4\t6\t4\t5\n")
+    bin_dir = tmpdir.mkdir("bin")
+    _fake_tool(bin_dir, "bismark_genome_preparation",
+               "mkdir -p Bisulfite_Genome && cp hg19.fa Bisulfite_Genome/genome_mfa.CT_conversion.fa")
+    monkeypatch.setenv("PATH", "%s%s%s" % (bin_dir, os.pathsep, os.environ["PATH"]))
+    monkeypatch.setattr(genomes.galaxy, "prep_locs", lambda *args: None)
+    env = types.SimpleNamespace(index_scratch=str(tmpdir.join("scratch")), index_scratch_factor=None)
+    genomes._index_to_galaxy(env, str(work_dir), "seq/hg19.fa", "hg19", ["bismark"], {})
+    assert os.listdir(str(tmpdir.join("scratch"))) == []
+    assert os.path.exists(str(work_dir.join("bismark", "Bisulfite_Genome", "genome_mfa.CT_conversion.fa")))
+    assert os.path.islink(str(work_dir.join("bismark", "hg19.fa")))
+    assert not os.path.isabs(os.readlink(str(work_dir.join("bismark", "hg19.fa"))))
+    assert _dangling_links(str(work_dir)) == []
+
+def test_staged_index_keeps_finished_builds(tmpdir, monkeypatch):
+    work_dir = tmpdir.mkdir("hg19")
+    seq_dir = work_dir.mkdir("seq")
+    seq_dir.join("hg19.fa").write(">chr1\nACGT\n")
+    bin_dir = tmpdir.mkdir("bin")
+    _fake_tool(bin_dir, "bismark_genome_preparation", "mkdir -p Bisulfite_Genome")
+    monkeypatch.setenv("PATH", "%s%s%s" % (bin_dir, os.pathsep, os.environ["PATH"]))
+    def failed_build(env, ref_file):
+        os.mkdir("failed")
+        raise subprocess.CalledProcessError(1, "failed_build")
+    monkeypatch.setitem(genomes.INDEX_FNS, "failed", failed_build)
+    env = types.SimpleNamespace(index_scratch=str(tmpdir.join("scratch")), index_scratch_factor=None)
+    with pytest.raises(subprocess.CalledProcessError):
+        genomes._index_to_galaxy(env, str(work_dir), "seq/hg19.fa", "hg19", ["bismark", "failed"], {})
+    assert os.listdir(str(tmpdir.join("scratch"))) == []
+    assert os.path.isdir(str(work_dir.join("bismark", "Bisulfite_Genome")))
+    assert not os.path.exists(str(work_dir.join("failed")))
+    assert _dangling_links(str(work_dir)) == []
+
+class FakeFTP:
+    """Serve FTP requests for urllib, with only the liftOver directory present.
+    """
+    error = None
+
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def connect(self, host, port, timeout=None):
+        if self.error:
+            raise self.error
+
+    def login(self, user, passwd):
+        pass
+
+    def cwd(self, path):
+        if path not in ["", "/", "goldenPath/hg19/liftOver"]:
+            raise ftplib.error_perm("550 Failed to change directory.")
+
+    def pwd(self):
+        return "/"
+
+    def voidcmd(self, cmd):
+        pass
+
+    def ntransfercmd(self, cmd):
+        raise ftplib.error_perm("550 Failed to open file.")
+
+    def close(self):
+        pass
+
+@pytest.mark.parametrize("url", ["ftp://127.0.0.1/goldenPath/hg19/liftOver/hg19ToMissing.over.chain.gz",
+                                 "ftp://127.0.0.1/goldenPath/missing/liftOver/hg19ToHg38.over.chain.gz"])
+def test_fetch_chain_missing_ftp(tmpdir, monkeypatch, url):
+    monkeypatch.setattr(ftplib, "FTP", FakeFTP)
+    out_file = str(tmpdir.join("hg19ToHg38.over.chain"))
+    assert genomes._fetch_chain((url, out_file)) is False
+    assert os.listdir(str(tmpdir)) == []
+
+@pytest.mark.parametrize("error", [ftplib.error_temp("421 Too many users, 550 maximum"),
+                                   ftplib.error_perm("530 Login incorrect.")])
+def test_fetch_chain_retry_ftp_errors(tmpdir, monkeypatch, error):
+    monkeypatch.setattr(ftplib, "FTP", FakeFTP)
+    monkeypatch.setattr(FakeFTP, "error", error)
+    out_file = str(tmpdir.join("hg19ToHg38.over.chain"))
+    url = "ftp://127.0.0.1/goldenPath/hg19/liftOver/hg19ToHg38.over.chain.gz"
+    assert genomes._fetch_chain((url, out_file)) is None
+
+def test_fetch_chain_retry_other_errors(tmpdir, monkeypatch):
+    def timeout(url, timeout=None):
+        raise URLError("timed out after 550 seconds")
+    monkeypatch.setattr(genomes, "urlopen", timeout)
+    out_file = str(tmpdir.join("hg19ToHg38.over.chain"))
+    assert genomes._fetch_chain(("ftp://example.org/hg19ToHg38.over.chain.gz", out_file)) is None
+
+def test_fetch_chain(tmpdir, monkeypatch):
+    monkeypatch.setattr(genomes, "urlopen",
+                        lambda url, timeout=None: io.BytesIO(gzip.compress(b"chain 1000 chr1\n")))
+    out_file = str(tmpdir.join("hg19ToHg38.over.chain"))
+    assert genomes._fetch_chain(("ftp://example.org/hg19ToHg38.over.chain.gz", out_file)) is True
+    assert tmpdir.join("hg19ToHg38.over.chain").read() == "chain 1000 chr1\n"
+    assert os.listdir(str(tmpdir)) == ["hg19ToHg38.over.chain"]
@@ -0,0 +1,84 @@
+"""Unit tests for utils/query_conda_deps.py against a local mock anaconda.org API.
+
+Run with: python -m pytest test/
+"""
+import json
+import os
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import pytest
+
+pytest.importorskip("requests")
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "utils"))
+import query_conda_deps
+
+
+def _file(version, depends):
+    return {"version": version,
+            "dependencies": {"depends": [{"name": n, "specs": specs} for n, specs in depends]}}
+
+FILES = {"/package/bioconda/samtools/files": [_file("1.9", [("htslib", [[">=", "1.9"]])]),
+                                              _file("1.10", [("htslib", [[">=", "1.10"]])])],
+         "/package/bioconda/bcftools/files": [_file("1.9", [("htslib", [[">=", "1.9"]]),
+                                                            ("python", [])])]}
+
+
+class MockAPIHandler(BaseHTTPRequestHandler):
+    requests = []
+
+    def do_GET(self):
+        self.requests.append((self.path, self.headers.get("If-None-Match")))
+        etag = '"%s"' % self.path
+        if self.path not in FILES:
+            self._send(404, {"error": "Not Found"})
+        elif self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.end_headers()
+        else:
+            self._send(200, FILES[self.path], etag)
+
+    def _send(self, code, data, etag=None):
+        body = json.dumps(data).encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        if etag:
+            self.send_header("ETag", etag)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def api_url():
+    server = HTTPServer(("127.0.0.1", 0), MockAPIHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    MockAPIHandler.requests = []
+    yield "http://127.0.0.1:%s" % server.server_port
+    server.shutdown()
+    server.server_close()
+
+
+def test_files_revalidates_cache(tmpdir, api_url):
+    client = query_conda_deps.AnacondaClient(str(tmpdir), api_url, workers=2)
+    first = client.files("bioconda", "samtools")
+    assert first == FILES["/package/bioconda/samtools/files"]
+    assert client.files("bioconda", "samtools") == first
+    assert MockAPIHandler.requests == [("/package/bioconda/samtools/files", None),
+                                       ("/package/bioconda/samtools/files",
+                                        '"/package/bioconda/samtools/files"')]
+    assert client.files("bioconda", "missing") is None
+
+
+def test_differing_pins(tmpdir, api_url):
+    client = query_conda_deps.AnacondaClient(str(tmpdir), api_url, workers=2)
+    files = dict((p, client.files("bioconda", p)) for p in ["samtools", "bcftools", "missing"])
+    assert query_conda_deps.differing_pins(files) == {"htslib": {">=1.10": set(["samtools"]),
+                                                                 ">=1.9": set(["bcftools"])}}
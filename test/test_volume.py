@@ -0,0 +1,74 @@
+"""Unit tests for attaching EBS volumes, using a fake EC2 connection.
+
+Run with: python -m pytest test/
+"""
+import pytest
+
+pytest.importorskip("fabric.api")
+pytest.importorskip("boto.exception")
+from cloudbio.deploy import volume
+
+
+class FakeAttachData:
+    def __init__(self, instance_id, device, status):
+        self.instance_id = instance_id
+        self.device = device
+        self.status = status
+
+
+class FakeVolume:
+    def __init__(self, volume_id, instance_id=None, device=None, status=None):
+        self.id = volume_id
+        self.attach_data = FakeAttachData(instance_id, device, status)
+
+
+class FakeEC2Connection:
+    """Volumes finish attaching after a fixed number of polls of the volume list.
+    """
+    def __init__(self, volumes, polls_to_attach=2):
+        self.volumes = volumes
+        self.polls_to_attach = polls_to_attach
+        self.calls = []
+
+    def get_all_volumes(self, volume_ids=None, filters=None):
+        self.calls.append(("get_all_volumes", filters))
+        self.polls_to_attach -= 1
+        out = []
+        for vol in self.volumes:
+            if vol.attach_data.status == "attaching" and self.polls_to_attach < 0:
+                vol.attach_data.status = "attached"
+            if all(getattr(vol.attach_data, k.split(".")[-1].replace("-", "_")) == v
+                   for k, v in (filters or {}).items()):
+                out.append(vol)
+        return out
+
+    def attach_volume(self, volume_id, instance_id, device_id):
+        self.calls.append(("attach_volume", volume_id, device_id))
+        vol = [x for x in self.volumes if x.id == volume_id][0]
+        vol.attach_data = FakeAttachData(instance_id, device_id, "attaching")
+        return "attaching"
+
+
+def test_attach_all(monkeypatch):
+    monkeypatch.setattr(volume, "sleep", lambda delay: None)
+    conn = FakeEC2Connection([FakeVolume("vol-1", "i-1", "/dev/xvdf", "attached"),
+                              FakeVolume("vol-2"), FakeVolume("vol-3"),
+                              FakeVolume("vol-other", "i-2", "/dev/xvdf", "attached")])
+    attachments = [("vol-1", "/dev/xvdf"), ("vol-2", "/dev/xvdg"), ("vol-3", "/dev/xvdh")]
+    volume._attach_all(conn, "i-1", attachments)
+    assert [c for c in conn.calls if c[0] == "attach_volume"] == \
+        [("attach_volume", "vol-2", "/dev/xvdg"), ("attach_volume", "vol-3", "/dev/xvdh")]
+    volume._wait_for_attached(conn, "i-1", [d for _, d in attachments], timeout=10)
+    polls = [c for c in conn.calls if c[0] == "get_all_volumes"]
+    assert len(polls) == 3
+    assert all(filters == {"attachment.instance-id": "i-1"} for _, filters in polls)
+
+
+def test_wait_for_attached_timeout(monkeypatch):
+    delays = []
+    monkeypatch.setattr(volume, "sleep", delays.append)
+    conn = FakeEC2Connection([FakeVolume("vol-1", "i-1", "/dev/xvdf", "attaching")], polls_to_attach=100)
+    with pytest.raises(Exception) as excinfo:
+        volume._wait_for_attached(conn, "i-1", ["/dev/xvdf"], timeout=20, max_delay=8)
+    assert "/dev/xvdf" in str(excinfo.value)
+    assert delays == [1, 2, 4, 8, 8]
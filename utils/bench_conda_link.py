@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+"""Benchmark linking conda package binaries for a bcbio sized package set.
+
+Builds a mock anaconda installation with a package cache and compares the
+previous per-package linking, which shelled out to resolve directories and
+list binaries, with BinLinker. Both must produce the same links.
+
+Usage:
+  bench_conda_link.py [<number of packages>] [<binaries per package>]
+"""
+from __future__ import print_function
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from cloudbio.package import conda
+
+def _prep_anaconda(work_dir, n_packages, n_bins):
+    anaconda_dir = os.path.join(work_dir, "anaconda")
+    bin_dir = os.path.join(anaconda_dir, "bin")
+    os.makedirs(bin_dir)
+    pkg_list = []
+    for i in range(n_packages):
+        name = "package%04d" % i
+        dist_name = "%s-1.0-0" % name
+        pkg_list.append({"name": name, "dist_name": "bioconda::%s" % dist_name, "channel": "bioconda"})
+        pkg_dir = os.path.join(anaconda_dir, "pkgs", dist_name)
+        os.makedirs(os.path.join(pkg_dir, "bin"))
+        os.makedirs(os.path.join(pkg_dir, "info"))
+        with open(os.path.join(pkg_dir, "info", "files"), "w") as out_handle:
+            out_handle.write("lib/lib%s.so\nshare/%s/README\n" % (name, name))
+            for j in range(n_bins):
+                fname = "%s-tool%s" % (name, j)
+                for cur_dir in [os.path.join(pkg_dir, "bin"), bin_dir]:
+                    open(os.path.join(cur_dir, fname), "w").close()
+                out_handle.write("bin/%s\n" % fname)
+    conda_info = {"pkgs_dirs": [os.path.join(anaconda_dir, "pkgs")]}
+    return os.path.join(bin_dir, "conda"), conda_info, pkg_list
+
+def _legacy_link_bin(package, system_installdir, conda_info, conda_bin, conda_pkg_list):
+    """Per-package linking as previously done in cloudbio.package.conda._link_bin.
+    """
+    final_bindir = os.path.join(system_installdir, "bin")
+    base_bindir = os.path.dirname(conda_bin)
+    final_bindir = subprocess.check_output("cd %s && pwd -P" % final_bindir, shell=True).decode().strip()
+    base_bindir = subprocess.check_output("cd %s && pwd -P" % base_bindir, shell=True).decode().strip()
+    for pkg_subdir in [x for x in conda_pkg_list if x["name"] == package]:
+        pkg_subdir = pkg_subdir["dist_name"].split("::")[-1]
+        for pkg_dir in conda_info["pkgs_dirs"]:
+            pkg_bindir = os.path.join(os.path.realpath(pkg_dir), pkg_subdir, "bin")
+            if (os.path.commonprefix([pkg_bindir, base_bindir]).find("anaconda") > 0 and
+                    os.path.exists(pkg_bindir)):
+                files = subprocess.check_output("ls -1 {pkg_bindir}".format(**locals()),
+                                                shell=True).decode().split()
+                for fname in files:
+                    base_fname = os.path.join(base_bindir, fname)
+                    if os.path.exists(base_fname):
+                        conda._do_link(base_fname, os.path.join(final_bindir, fname))
+
+def _links(bin_dir):
+    return dict((x, os.readlink(os.path.join(bin_dir, x))) for x in os.listdir(bin_dir))
+
+def main(n_packages=600, n_bins=4):
+    work_dir = tempfile.mkdtemp()
+    try:
+        conda_bin, conda_info, pkg_list = _prep_anaconda(work_dir, n_packages, n_bins)
+        packages = [x["name"] for x in pkg_list]
+        results = {}
+        for name in ["legacy", "linker"]:
+            install_dir = os.path.join(work_dir, "install-%s" % name)
+            os.makedirs(os.path.join(install_dir, "bin"))
+            start = time.time()
+            if name == "legacy":
+                for package in packages:
+                    _legacy_link_bin(package, install_dir, conda_info, conda_bin, pkg_list)
+            else:
+                linker = conda.BinLinker(install_dir, conda_info, conda_bin)
+                linker.add(packages, pkg_list)
+                linker.link()
+            print("%-8s %s packages: %.2fs" % (name, n_packages, time.time() - start))
+            results[name] = _links(os.path.join(install_dir, "bin"))
+            if name == "linker":
+                start = time.time()
+                changes = linker.link(dry_run=True)
+                print("%-8s up to date check: %s changes in %.2fs" % (name, len(changes), time.time() - start))
+        assert results["legacy"] == results["linker"], "Created links differ"
+    finally:
+        shutil.rmtree(work_dir)
+
+if __name__ == "__main__":
+    main(*[int(x) for x in sys.argv[1:]])
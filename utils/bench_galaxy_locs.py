@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+"""Benchmark Galaxy .loc file updates for large multi-genome installs.
+
+Compares three ways of adding genomes to .loc files:
+
+  - original: the previous code path, reproduced here, which reparses
+    tool_data_table_conf.xml for every index and scans each .loc file
+    line by line before appending.
+  - per genome: prep_locs without a shared registry, writing .loc files
+    after each genome as done for single genome installs.
+  - registry: all genomes accumulated in a single LocRegistry and each
+    .loc file written once.
+
+Usage:
+  bench_galaxy_locs.py [<number of genomes>]
+"""
+from __future__ import print_function
+import collections
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from xml.etree import ElementTree
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from cloudbio.biodata import galaxy
+from cloudbio.custom import shared
+
+Env = collections.namedtuple("Env", "system_install, galaxy_home, tool_data_table_conf_file, cores")
+INDEXES = ["bismark", "bowtie", "bowtie2", "bwa", "novoalign", "seq", "ucsc"]
+
+def _genomes(n):
+    for i in range(n):
+        gid = "genome%04d" % i
+        yield gid, dict((idx, "/genomes/%s/%s/%s" % (gid, idx, gid)) for idx in INDEXES)
+
+# ## Original code path, before LocRegistry
+
+def _original_get_tool_conf(env, tool_name):
+    tool_conf = {}
+    tdtc = ElementTree.parse(env.tool_data_table_conf_file)
+    for t in tdtc.iter('table'):
+        if tool_name in t.attrib.get('name', ''):
+            tool_conf['columns'] = t.find('columns').text.replace(' ', '').split(',')
+            tool_conf['file'] = t.find('file').attrib.get('path', '')
+    return tool_conf
+
+def _original_build_loc_line(env, dbkey, file_path, config, prefix, tool_name):
+    if tool_name:
+        str_parts = []
+        tool_conf = _original_get_tool_conf(env, tool_name)
+        loc_cols = galaxy.LocCols(config, dbkey, file_path)
+        for col in tool_conf.get('columns', []):
+            str_parts.append(config.get(col, getattr(loc_cols, col)))
+    else:
+        str_parts = [dbkey, file_path]
+    if prefix:
+        str_parts.insert(0, prefix)
+    return str_parts
+
+def _original_update_loc_file(env, ref_file, line_parts):
+    tools_dir = os.path.join(env.galaxy_home, "tool-data")
+    if not os.path.exists(tools_dir):
+        subprocess.check_call("mkdir -p %s" % tools_dir, shell=True)
+    dt_file = os.path.join(env.galaxy_home, "tool_data_table_conf.xml")
+    if not os.path.exists(dt_file):
+        shutil.copy(env.tool_data_table_conf_file, dt_file)
+    add_str = "\t".join(line_parts)
+    with shared.chdir(tools_dir):
+        if not os.path.exists(ref_file):
+            subprocess.check_call("touch %s" % ref_file, shell=True)
+        has_line = False
+        with open(ref_file) as in_handle:
+            for line in in_handle:
+                if line.strip() == add_str.strip():
+                    has_line = True
+        if not has_line:
+            with open(ref_file, "a") as out_handle:
+                out_handle.write(add_str + "\n")
+
+def _original_prep_locs(env, gid, indexes, config):
+    for ref_index_file, cur_index, prefix, tool_name in [
+            ("alignseq.loc", indexes.get("ucsc", None), "seq", None),
+            ("bismark_indices.loc", indexes.get("bismark", None), "", 'bismark_indexes'),
+            ("bowtie2_indices.loc", indexes.get("bowtie2", None), "", 'bowtie2_indexes'),
+            ("bowtie_indices.loc", indexes.get("bowtie", None), "", 'bowtie_indexes'),
+            ("bwa_index.loc", indexes.get("bwa", None), "", 'bwa_indexes'),
+            ("gatk_sorted_picard_index.loc", indexes.get("seq", None), "", "gatk_picard_indexes"),
+            ("mosaik_index.loc", indexes.get("mosaik", None), "", "mosaik_indexes"),
+            ("novoalign_indices.loc", indexes.get("novoalign", None), "", "novoalign_indexes"),
+            ("picard_index.loc", indexes.get("seq", None), "", "picard_indexes"),
+            ("sam_fa_indices.loc", indexes.get("seq", None), "", 'sam_fa_indexes'),
+            ("twobit.loc", indexes.get("ucsc", None), "", None)]:
+        if cur_index:
+            str_parts = _original_build_loc_line(env, gid, cur_index, config, prefix, tool_name)
+            _original_update_loc_file(env, ref_index_file, str_parts)
+
+def _run(env, n, method):
+    registry = galaxy.LocRegistry(env) if method == "registry" else None
+    start = time.time()
+    for gid, indexes in _genomes(n):
+        if method == "original":
+            _original_prep_locs(env, gid, indexes, {})
+        else:
+            galaxy.prep_locs(env, gid, indexes, {}, registry)
+    if registry:
+        registry.write()
+    return time.time() - start
+
+def _loc_contents(env):
+    tools_dir = os.path.join(env.galaxy_home, "tool-data")
+    out = {}
+    for fname in sorted(os.listdir(tools_dir)):
+        with open(os.path.join(tools_dir, fname)) as in_handle:
+            out[fname] = in_handle.read()
+    return out
+
+def main(n=150):
+    conf_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir,
+                             "installed_files", "tool_data_table_conf.xml")
+    results = {}
+    for name in ["original", "per genome", "registry"]:
+        work_dir = tempfile.mkdtemp()
+        try:
+            env = Env(work_dir, work_dir, conf_file, 1)
+            elapsed = _run(env, n, name)
+            results[name] = _loc_contents(env)
+            print("%-12s %s genomes: %.2fs" % (name, n, elapsed))
+        finally:
+            shutil.rmtree(work_dir)
+    assert results["original"] == results["per genome"] == results["registry"], "Output .loc files differ"
+
+if __name__ == "__main__":
+    main(*[int(x) for x in sys.argv[1:]])
@@ -4,47 +4,119 @@
 http://evs.gs.washington.edu/EVS/
 
 The Download is a tarball of individual VCF files with hg38 coordinates in
-an INFO key. Extract these into a full VCF, then sort, normalize and bgzip.
+an INFO key. Each source chromosome is lifted over in a separate worker which
+buckets records by target chromosome. Buckets are then sorted in memory and
+normalized in parallel per target chromosome, and the bgzipped shards are
+concatenated in reference order.
 """
 import glob
+import multiprocessing
+import os
+import shutil
 import subprocess
+from argparse import ArgumentParser
 
 from bcbio.bam import ref
 from bcbio.variation import vcfutils
 from bcbio.heterogeneity import chromhacks
+from cloudbio.biodata import bgzf
 
-def main():
+SOURCE_CHROMS = [str(x) for x in range(1, 23)] + ["X", "Y"]
+
+def main(cores=1):
     url = "http://evs.gs.washington.edu/evs_bulk_data/ESP6500SI-V2-SSA137.GRCh38-liftover.snps_indels.vcf.tar.gz"
     ref_file = "../seq/hg38.fa"
+    work_dir = "esp-shards"
     subprocess.check_call("wget -c -O esp-orig.tar.gz {url}".format(**locals()), shell=True)
     subprocess.check_call("tar -xzvpf esp-orig.tar.gz", shell=True)
-    raw_file = "esp-raw.vcf"
-    with open(raw_file, "w") as out_handle:
-        for i, chrom in enumerate(list(range(1, 23)) + ["X", "Y"]):
-            fnames = glob.glob("*chr%s.snps_indels.vcf" % chrom)
-            assert len(fnames) == 1, (chrom, fnames)
-            with open(fnames[0]) as in_handle:
-                for line in in_handle:
-                    if line.startswith("#"):
-                        if i == 0:
-                            if line.startswith("#CHROM"):
-                                _add_contigs(out_handle, ref_file)
-                            out_handle.write(line)
-                    else:
-                        parts = line.strip().split("\t")
-                        key, val = parts[-1].split(";")[-1].split("=")
-                        assert key == "GRCh38_POSITION"
-                        if val != "-1":
-                            new_chrom, new_pos = val.split(":")
-                            if chromhacks.is_autosomal_or_sex(new_chrom):
-                                parts[0] = "chr%s" % new_chrom
-                                parts[1] = new_pos
-                                out_handle.write("\t".join(parts) + "\n")
+    if not os.path.exists(work_dir):
+        os.makedirs(work_dir)
+    header_file = os.path.join(work_dir, "header.vcf")
+    _write_header(_source_file(SOURCE_CHROMS[0]), header_file, ref_file)
+    pool = multiprocessing.Pool(max(1, cores))
+    try:
+        pool.map(_liftover_chrom, [(c, work_dir) for c in SOURCE_CHROMS])
+        target_chroms = [c.name for c in ref.file_contigs(ref_file)
+                         if glob.glob(os.path.join(work_dir, "*", "%s.txt" % c.name))]
+        shards = pool.map(_normalize_shard, [(c, i == 0, work_dir, header_file, ref_file)
+                                             for i, c in enumerate(target_chroms)])
+    finally:
+        pool.close()
     out_file = "ESP6500SI-V2-hg38.vcf.gz"
-    subprocess.check_call(("vt sort {raw_file} | vt decompose -s - | "
-                           "vt normalize -n -r {ref_file} - | bgzip -c > {out_file}").format(**locals()),
-                          shell=True)
+    bgzf.concat_bgzf(shards, out_file)
     vcfutils.bgzip_and_index(out_file)
+    shutil.rmtree(work_dir)
+
+def _source_file(chrom):
+    fnames = glob.glob("*chr%s.snps_indels.vcf" % chrom)
+    assert len(fnames) == 1, (chrom, fnames)
+    return fnames[0]
+
+def _write_header(in_file, out_file, ref_file):
+    with open(in_file) as in_handle, open(out_file, "w") as out_handle:
+        for line in in_handle:
+            if not line.startswith("#"):
+                break
+            if line.startswith("#CHROM"):
+                _add_contigs(out_handle, ref_file)
+            out_handle.write(line)
+
+def _liftover_chrom(args):
+    """Move records from a source chromosome to hg38 positions, bucketed by target chromosome.
+    """
+    chrom, work_dir = args
+    out_dir = os.path.join(work_dir, chrom)
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+    handles = {}
+    try:
+        with open(_source_file(chrom)) as in_handle:
+            for line in in_handle:
+                if line.startswith("#"):
+                    continue
+                rest, info = line.rstrip("\n").rsplit("\t", 1)
+                key, val = info.rsplit(";", 1)[-1].split("=")
+                assert key == "GRCh38_POSITION"
+                if val != "-1":
+                    new_chrom, new_pos = val.split(":")
+                    if chromhacks.is_autosomal_or_sex(new_chrom):
+                        new_chrom = "chr%s" % new_chrom
+                        _, _, rest = rest.split("\t", 2)
+                        if new_chrom not in handles:
+                            handles[new_chrom] = open(os.path.join(out_dir, "%s.txt" % new_chrom), "w")
+                        handles[new_chrom].write("%s\t%s\t%s\t%s\n" % (new_chrom, new_pos, rest, info))
+    finally:
+        for handle in handles.values():
+            handle.close()
+    return chrom
+
+def _normalize_shard(args):
+    """Sort all records lifted to a target chromosome, then decompose and normalize.
+
+    Only the first shard retains the VCF header so shards can be concatenated.
+    """
+    chrom, with_header, work_dir, header_file, ref_file = args
+    records = []
+    for bucket in glob.glob(os.path.join(work_dir, "*", "%s.txt" % chrom)):
+        with open(bucket) as in_handle:
+            records.extend(in_handle)
+    records.sort(key=lambda x: int(x.split("\t", 2)[1]))
+    raw_file = os.path.join(work_dir, "%s-raw.vcf" % chrom)
+    with open(raw_file, "w") as out_handle:
+        with open(header_file) as in_handle:
+            shutil.copyfileobj(in_handle, out_handle)
+        out_handle.writelines(records)
+    del records
+    out_file = os.path.join(work_dir, "%s-norm.vcf.bgz" % chrom)
+    cmd = "vt decompose -s {raw_file} | vt normalize -n -r {ref_file} -".format(**locals())
+    proc = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE)
+    with bgzf.BgzfWriter(out_file, eof=False) as out_handle:
+        for line in proc.stdout:
+            if with_header or not line.startswith(b"#"):
+                out_handle.write(line)
+    if proc.wait() != 0:
+        raise subprocess.CalledProcessError(proc.returncode, cmd)
+    return out_file
 
 def _add_contigs(out_handle, ref_file):
     for contig in ref.file_contigs(ref_file):
@@ -52,4 +124,8 @@ def _add_contigs(out_handle, ref_file):
             out_handle.write("##contig=<ID=%s,length=%s>\n" % (contig.name, contig.size))
 
 if __name__ == "__main__":
-    main()
+    parser = ArgumentParser(description="Prepare hg38 ESP variants from the GRCh38 liftover download.")
+    parser.add_argument("-c", "--cores", type=int, default=multiprocessing.cpu_count(),
+                        help="Number of chromosome workers")
+    args = parser.parse_args()
+    main(args.cores)
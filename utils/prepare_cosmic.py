@@ -27,73 +27,101 @@ import sys
 import tempfile
 import shutil
 from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
 
 from bcbio import utils
 from bcbio.variation import vcfutils
+from cloudbio.biodata import bgzf
 
 logging.basicConfig(format='%(asctime)s [%(levelname).1s] %(message)s', level=logging.INFO)
 
+COSMIC_TYPES = ["CosmicCodingMuts", "CosmicNonCodingVariants"]
+
 
 def main(cosmic_version, bcbio_genome_dir, overwrite=False, clean=False):
     work_dir = utils.safe_makedir(os.path.join(os.getcwd(), "cosmic-prep"))
     os.chdir(work_dir)
 
-    for genome_build, bcbio_build, add_chr in [("GRCh37", "GRCh37", False), ("GRCh38", "hg38", True)]:
-        bcbio_base = os.path.join(bcbio_genome_dir, "genomes", "Hsapiens", bcbio_build)
+    builds = [("GRCh37", "GRCh37", False), ("GRCh38", "hg38", True)]
+    with ThreadPoolExecutor(max_workers=len(builds)) as executor:
+        jobs = [executor.submit(prep_build, genome_build, bcbio_build, add_chr, cosmic_version,
+                                bcbio_genome_dir, overwrite, clean)
+                for genome_build, bcbio_build, add_chr in builds]
+        for job in jobs:
+            job.result()
+
+
+def prep_build(genome_build, bcbio_build, add_chr, cosmic_version, bcbio_genome_dir, overwrite, clean):
+    """Prepare COSMIC for a single genome build, deriving hg19 from GRCh37.
+
+    Builds run concurrently from `main`, with downloads and sort/normalisation
+    of the coding and non-coding files also done in parallel.
+    """
+    bcbio_base = os.path.join(bcbio_genome_dir, "genomes", "Hsapiens", bcbio_build)
+    installed_file = os.path.join(bcbio_base, "variation", f"cosmic-v{cosmic_version}.vcf.gz")
+    installed_link = os.path.join(bcbio_base, "variation", "cosmic.vcf.gz")
+    bcbio_ref = os.path.join(bcbio_base, "seq", f"{bcbio_build}.fa")
+    out_dir = os.path.join(f"v{cosmic_version}", "bcbio_ready", bcbio_build)
+    ready_cosmic = os.path.join(out_dir, "cosmic.vcf.gz")
+    logging.info(f"Beginning COSMIC v{cosmic_version} prep for {genome_build}.")
+    if not os.path.exists(bcbio_base):
+        return
+    if _ready_to_install(installed_file, installed_link, overwrite):
+        vdir = os.path.join("v%s" % cosmic_version, genome_build)
+        if os.path.exists(vdir):
+            if not clean:
+                logging.info(f"{vdir} files exist, please use the --clean flag to overwrite the existing files if you want to reinstall.")
+            else:
+                logging.info(f"{vdir} exists, removing.")
+                remove_cosmic_directory(vdir)
+        with ThreadPoolExecutor(max_workers=len(COSMIC_TYPES)) as executor:
+            sorted_inputs = list(executor.map(
+                lambda ctype: sort_to_ref(get_cosmic_vcf_file(genome_build, cosmic_version, ctype),
+                                          bcbio_ref, add_chr=add_chr),
+                COSMIC_TYPES))
+        utils.safe_makedir(out_dir)
+        ready_cosmic = combine_cosmic(sorted_inputs, bcbio_ref, ready_cosmic)
+        install_cosmic(ready_cosmic, bcbio_base, installed_file, installed_link, cosmic_version)
+        logging.info(f"Finished COSMIC v{cosmic_version} prep for {genome_build}.")
+    # prepare hg19 from the GRCh37 file
+    if bcbio_build == "GRCh37" and os.path.exists(ready_cosmic):
+        genome_build = "hg19"
+        logging.info(f"Prepping COSMIC v{cosmic_version} for {genome_build} from the GRCh37 preparation.")
+        bcbio_base = os.path.join(bcbio_genome_dir, "genomes", "Hsapiens", genome_build)
+        if not os.path.exists(bcbio_base):
+            return
         installed_file = os.path.join(bcbio_base, "variation", f"cosmic-v{cosmic_version}.vcf.gz")
         installed_link = os.path.join(bcbio_base, "variation", "cosmic.vcf.gz")
-        logging.info(f"Beginning COSMIC v{cosmic_version} prep for {genome_build}.")
-        if not os.path.exists(bcbio_base):
-            continue
-        if os.path.exists(installed_file):
-            if not overwrite:
-                logging.info(f"{installed_file} exists, please use the --overwrite flag to overwrite the existing files if you want to reinstall.")
-                continue
-            else:
-                logging.info(f"{installed_file} exists, removing.")
-                remove_installed(installed_file, installed_link)
-        bcbio_ref = os.path.join(bcbio_base, "seq", f"{bcbio_build}.fa")
-        cosmic_vcf_files = get_cosmic_vcf_files(genome_build, cosmic_version, clean)
-        sorted_inputs = []
-        for fname in cosmic_vcf_files:
-            sorted_inputs.append(sort_to_ref(fname, bcbio_ref, add_chr=add_chr))
-        out_dir = utils.safe_makedir(os.path.join(f"v{cosmic_version}", "bcbio_ready", bcbio_build))
-        out_file = os.path.join(out_dir, "cosmic.vcf.gz")
-        ready_cosmic = combine_cosmic(sorted_inputs, bcbio_ref, out_file)
-        variation_dir = utils.safe_makedir(os.path.join(bcbio_base, "variation"))
-        utils.copy_plus(ready_cosmic, installed_file)
-        logging.info(f"Created COSMIC v{cosmic_version} resource in {installed_file}.")
-        logging.info(f"Linking {installed_file} as {installed_link}.")
-        make_links(installed_file, installed_link)
-        update_version_file(bcbio_base, cosmic_version)
+        if not _ready_to_install(installed_file, installed_link, overwrite):
+            return
+        out_dir = utils.safe_makedir(os.path.join(f"v{cosmic_version}", "bcbio_ready", genome_build))
+        out_file = os.path.join(out_dir, f"cosmic-v{cosmic_version}.vcf.gz")
+        logging.info(f"Translating GRCh37 chromosome names to hg19 chromosome names.")
+        hg19_cosmic = map_coords_to_ucsc(ready_cosmic, bcbio_ref, out_file)
+        install_cosmic(hg19_cosmic, bcbio_base, installed_file, installed_link, cosmic_version)
         logging.info(f"Finished COSMIC v{cosmic_version} prep for {genome_build}.")
-        # prepare hg19 from the GRCh37 file
-        if bcbio_build == "GRCh37":
-            genome_build = "hg19"
-            logging.info(f"Prepping COSMIC v{cosmic_version} for {genome_build} from the GRCh37 preparation.")
-            bcbio_base = os.path.join(bcbio_genome_dir, "genomes", "Hsapiens", genome_build)
-            if not os.path.exists(bcbio_base):
-                continue
-            if os.path.exists(installed_file):
-                installed_file = os.path.join(bcbio_base, "variation", f"cosmic-v{cosmic_version}.vcf.gz")
-                installed_link = os.path.join(bcbio_base, "variation", "cosmic.vcf.gz")
-                if not overwrite:
-                    logging.info(f"{installed_file} exists, please use the --overwrite flag to overwrite the existing files if you want to reinstall.")
-                    continue
-                else:
-                    logging.info(f"{installed_file} exists, removing.")
-                    remove_installed(installed_file, installed_link)
-            out_dir = utils.safe_makedir(os.path.join(f"v{cosmic_version}", "bcbio_ready", genome_build))
-            out_file = os.path.join(out_dir, f"cosmic-v{cosmic_version}.vcf.gz")
-            logging.info(f"Translating GRCh37 chromosome names to hg19 chromosome names.")
-            hg19_cosmic = map_coords_to_ucsc(ready_cosmic, bcbio_ref, out_file)
-            variation_dir = utils.safe_makedir(os.path.join(bcbio_base, "variation"))
-            utils.copy_plus(hg19_cosmic, installed_file)
-            logging.info(f"Created COSMIC v{cosmic_version} resource in {installed_file}.")
-            logging.info(f"Linking {installed_file} as {installed_link}.")
-            make_links(installed_file, installed_link)
-            update_version_file(bcbio_base, cosmic_version)
-            logging.info(f"Finished COSMIC v{cosmic_version} prep for {genome_build}.")
+
+
+def _ready_to_install(installed_file, installed_link, overwrite):
+    """Check for a previous installation, removing it if we should overwrite.
+    """
+    if os.path.exists(installed_file):
+        if not overwrite:
+            logging.info(f"{installed_file} exists, please use the --overwrite flag to overwrite the existing files if you want to reinstall.")
+            return False
+        else:
+            logging.info(f"{installed_file} exists, removing.")
+            remove_installed(installed_file, installed_link)
+    return True
+
+
+def install_cosmic(ready_cosmic, bcbio_base, installed_file, installed_link, cosmic_version):
+    utils.safe_makedir(os.path.join(bcbio_base, "variation"))
+    utils.copy_plus(ready_cosmic, installed_file)
+    logging.info(f"Created COSMIC v{cosmic_version} resource in {installed_file}.")
+    logging.info(f"Linking {installed_file} as {installed_link}.")
+    make_links(installed_file, installed_link)
+    update_version_file(bcbio_base, cosmic_version)
 
 
 def remove_installed(installed_file, installed_link):
@@ -124,14 +152,8 @@ def make_links(installed_file, installed_link):
 def map_coords_to_ucsc(grc_cosmic, ref_file, out_file):
     hg19_ref_file = ref_file.replace("GRCh37", "hg19")
     if not os.path.exists(out_file):
-        contig_cl = vcfutils.add_contig_to_header_cl(hg19_ref_file, out_file)
-        cmd = ("zcat {grc_cosmic} | "
-               r'sed "s/^\([0-9]\+\)\t/chr\1\t/g" | sed "s/^MT/chrM/g" | sed "s/^X/chrX/g" | sed "s/^Y/chrY/g" '
-               "| {contig_cl} "
-               "| bgzip -c > {out_file}")
-        subprocess.check_call(cmd.format(**locals()), shell=True)
-    if os.path.exists("%s-header.txt" % utils.splitext_plus(out_file)[0]):
-        os.remove("%s-header.txt" % utils.splitext_plus(out_file)[0])
+        bgzf.transform_vcf(grc_cosmic, out_file, chrom_map=bgzf.ucsc_chrom_map(),
+                           contigs=bgzf.fai_contigs(hg19_ref_file), threads=4)
     return vcfutils.bgzip_and_index(out_file, {})
 
 
@@ -164,50 +186,59 @@ def sort_to_ref(fname, ref_file, add_chr):
             fix_chrom = r'| sed "s/^\([0-9]\+\)\t/chr\1\t/g" | sed "s/^MT/chrM/g" | sed "s/^X/chrX/g" | sed "s/^Y/chrY/g" '
         else:
             fix_chrom = ''
-        contig_cl = vcfutils.add_contig_to_header_cl(ref_file, out_file)
+        python = sys.executable
         cmd = ("gunzip -c {fname} {fix_chrom} | "
                "bcftools norm --check-ref s --do-not-normalize -f {ref_file} |"
                "bcftools view -e 'SNP=1' |"
-               "gsort /dev/stdin {ref_file}.fai | {contig_cl} | "
-               "bgzip -c > {out_file}")
+               "gsort /dev/stdin {ref_file}.fai | "
+               "{python} -m cloudbio.biodata.bgzf --ref {ref_file} --threads 4 - {out_file}")
         subprocess.check_call(cmd.format(**locals()), shell=True)
     logging.info(f"bgzipping and indexing {out_file}.")
     return vcfutils.bgzip_and_index(out_file, {})
 
 
-def get_cosmic_vcf_files(genome_build, cosmic_version, clean):
+def get_cosmic_vcf_file(genome_build, cosmic_version, ctype):
     """Retrieve using new authentication based download approach.
 
     GRCh38/cosmic/v85/VCF/CosmicCodingMuts.vcf.gz
     GRCh38/cosmic/v85/VCF/CosmicNonCodingVariants.vcf.gz
     """
-    vdir = os.path.join("v%s" % cosmic_version, genome_build)
-    if os.path.exists(vdir):
-        if not clean:
-            logging.info(f"{vdir} files exist, please use the --clean flag to overwrite the existing files if you want to reinstall.")
-        else:
-            logging.info(f"{vdir} exists, removing.")
-            remove_cosmic_directory(vdir)
-    logging.info("Downloading COSMIC VCF files.")
     url = "https://cancer.sanger.ac.uk/cosmic/file_download/"
     out_dir = utils.safe_makedir(os.path.join("v%s" % cosmic_version, genome_build))
-    fnames = []
-    for ctype in ["CosmicCodingMuts", "CosmicNonCodingVariants"]:
-        filename = os.path.join(out_dir, "%s.vcf.gz" % ctype)
-        if not os.path.exists(filename):
-            filepath = "%s/cosmic/v%s/VCF/%s.vcf.gz" % (genome_build, cosmic_version, ctype)
-            logging.info("Downloading %s" % (url + filepath))
-            try:
-                r = requests.get(url + filepath, auth=(os.environ["COSMIC_USER"], os.environ["COSMIC_PASS"]))
-            except KeyError as e:
-                print("KeyError: {} not found. Be sure to export your COSMIC_USER and COSMIC_PASS before running in order to download the files".format(e))
-                raise e
-            download_url = r.json()["url"]
-            r = requests.get(download_url)
-            with open(filename, "wb") as f:
-                f.write(r.content)
-        fnames.append(filename)
-    return fnames
+    filename = os.path.join(out_dir, "%s.vcf.gz" % ctype)
+    if not os.path.exists(filename):
+        filepath = "%s/cosmic/v%s/VCF/%s.vcf.gz" % (genome_build, cosmic_version, ctype)
+        logging.info("Downloading %s" % (url + filepath))
+        try:
+            r = requests.get(url + filepath, auth=(os.environ["COSMIC_USER"], os.environ["COSMIC_PASS"]))
+        except KeyError as e:
+            print("KeyError: {} not found. Be sure to export your COSMIC_USER and COSMIC_PASS before running in order to download the files".format(e))
+            raise e
+        r.raise_for_status()
+        download_file(r.json()["url"], filename)
+    return filename
+
+
+def download_file(download_url, filename, chunk_size=8 * 1024 * 1024):
+    """Stream a download to disk in chunks, resuming a previous partial download.
+    """
+    part_file = filename + ".part"
+    headers = {}
+    if os.path.exists(part_file):
+        headers["Range"] = "bytes=%s-" % os.path.getsize(part_file)
+        logging.info(f"Resuming download of {filename} from byte {os.path.getsize(part_file)}.")
+    with requests.get(download_url, headers=headers, stream=True) as r:
+        if r.status_code == 416:
+            # partial file already complete
+            pass
+        else:
+            r.raise_for_status()
+            mode = "ab" if r.status_code == 206 else "wb"
+            with open(part_file, mode) as out_handle:
+                for chunk in r.iter_content(chunk_size=chunk_size):
+                    out_handle.write(chunk)
+    shutil.move(part_file, filename)
+    return filename
 
 
 def remove_cosmic_directory(installed_directory):
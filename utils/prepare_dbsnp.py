@@ -1,20 +1,28 @@
 """Prepare sorted and consolidated dbSNP resources for mouse mm10/GRCh38 in VCF format.
+
+Per-chromosome VCFs are downloaded concurrently, each one is transformed in a
+separate worker that writes BGZF blocks directly, and the resulting BGZF files
+are concatenated in karyotype order without recompressing.
 """
 import datetime
 import ftplib
 import gzip
+import multiprocessing
 import os
 import subprocess
 from argparse import ArgumentParser
+from multiprocessing.pool import ThreadPool
 import re
 import shutil
 
+from cloudbio.biodata import bgzf
+
 FTP = "ftp.ncbi.nih.gov"
 
 REMOTES = {"mm10": "snp/organisms/mouse_10090/VCF",
            "canFam3": "snp/organisms/dog_9615/VCF/"}
 
-def main(org):
+def main(org, cores=1):
     work_dir = "tmp-dbsnp-%s" % org
     if not os.path.exists(work_dir):
         os.makedirs(work_dir)
@@ -22,53 +30,73 @@ def main(org):
     conn.cwd(REMOTES[org])
 
     os.chdir(work_dir)
-    files = []
+    remotes = []
     def add_files(x):
         if x.endswith("vcf.gz"):
-            files.append(get_file(x, REMOTES[org], conn))
+            remotes.append(x)
     conn.retrlines("NLST", add_files)
-    out_file = "%s-dbSNP-%s.vcf" % (org, datetime.datetime.now().strftime("%Y-%m-%d"))
-    with open(out_file, "w") as out_handle:
-        for i, f in enumerate(karyotype_sort(files)):
-            with gzip.open(f) as in_handle:
-                for line in in_handle:
-                    if line.startswith("#"):
-                        if i == 0:
-                            out_handle.write(line)
-                    else:
-                        out_handle.write("\t".join(fix_info(fix_chrom(line.rstrip().split("\t")))) + "\n")
-    subprocess.check_call(["bgzip", out_file])
-    shutil.move(out_file + ".gz", os.path.join(os.pardir, out_file + ".gz"))
+    conn.quit()
+    pool = ThreadPool(max(1, min(cores, len(remotes))))
+    try:
+        files = pool.map(lambda x: get_file(x, REMOTES[org]), remotes)
+    finally:
+        pool.close()
+    files = karyotype_sort(files)
+    pool = multiprocessing.Pool(max(1, min(cores, len(files))))
+    try:
+        bgzf_files = pool.map(prep_chrom, [(f, i == 0) for i, f in enumerate(files)])
+    finally:
+        pool.close()
+    out_file = "%s-dbSNP-%s.vcf.gz" % (org, datetime.datetime.now().strftime("%Y-%m-%d"))
+    bgzf.concat_bgzf(bgzf_files, out_file)
+    shutil.move(out_file, os.path.join(os.pardir, out_file))
     os.chdir(os.pardir)
-    subprocess.check_call(["tabix", "-p", "vcf", out_file + ".gz"])
+    subprocess.check_call(["tabix", "-p", "vcf", out_file])
     shutil.rmtree(work_dir)
 
-multi_whitespace = re.compile(r"\s+")
+multi_whitespace = re.compile(br"\s+")
 
-def fix_info(parts):
-    """Fix the INFO file to remove whitespace.
-    """
-    parts[7] = multi_whitespace.sub("_", parts[7])
-    return parts
+CHROM_MAP = bgzf.ucsc_chrom_map()
 
-def fix_chrom(parts):
-    MAX_CHROMOSOMES = 50
-    if parts[0] in [str(x) for x in range(1, MAX_CHROMOSOMES)] + ["X", "Y"]:
-        new_chrom = "chr%s" % parts[0]
-    elif parts[0] == "MT":
-        new_chrom = "chrM"
-    else:
+def fix_line(line):
+    """Rename chromosomes to UCSC style and remove whitespace from INFO fields.
+    """
+    parts = line.rstrip().split(b"\t", 8)
+    try:
+        parts[0] = CHROM_MAP[parts[0]]
+    except KeyError:
         raise NotImplementedError(parts)
-    parts[0] = new_chrom
-    return parts
+    parts[7] = multi_whitespace.sub(b"_", parts[7])
+    return b"\t".join(parts) + b"\n"
+
+def prep_chrom(args):
+    """Transform a single chromosome VCF into a BGZF file, optionally with header.
+    """
+    in_file, with_header = args
+    out_file = "%s-prep.vcf.bgz" % in_file.replace(".vcf.gz", "")
+    tx_out_file = out_file + ".tmp"
+    if not os.path.exists(out_file):
+        with gzip.open(in_file) as in_handle:
+            with bgzf.BgzfWriter(tx_out_file, eof=False) as out_handle:
+                for line in in_handle:
+                    if line.startswith(b"#"):
+                        if with_header:
+                            out_handle.write(line)
+                    else:
+                        out_handle.write(fix_line(line))
+        os.rename(tx_out_file, out_file)
+    return out_file
 
-def get_file(x, ftp_dir, conn):
+def get_file(x, ftp_dir):
     if not os.path.exists(x):
-        print "Retrieving %s" % x
-        with open(x, "wb") as out_handle:
+        print("Retrieving %s" % x)
+        tx_file = x + ".tmp"
+        with open(tx_file, "wb") as out_handle:
             conn = ftplib.FTP(FTP, "anonymous", "me@example.com")
             conn.cwd(ftp_dir)
             conn.retrbinary("RETR %s" % x, out_handle.write)
+            conn.quit()
+        os.rename(tx_file, x)
     return x
 
 def karyotype_sort(xs):
@@ -88,7 +116,7 @@ def karyotype_sort(xs):
         except ValueError:
             pass
         # unplaced at the very end
-        if isinstance(parts[0], basestring) and parts[0].startswith(("Un", "Alt", "Multi", "NotOn")):
+        if isinstance(parts[0], str) and parts[0].startswith(("Un", "Alt", "Multi", "NotOn")):
             parts.insert(0, "z")
         # mitochondrial special case -- after X/Y
         elif parts[0] in ["M", "MT"]:
@@ -103,5 +131,7 @@ if __name__ == "__main__":
     parser = ArgumentParser(description="Prepare a dbSNP file from NCBI.")
     parser.add_argument("org_build", choices=REMOTES.keys(),
                         help="genome build")
+    parser.add_argument("-c", "--cores", type=int, default=multiprocessing.cpu_count(),
+                        help="Number of concurrent downloads and chromosome workers")
     args = parser.parse_args()
-    main(args.org_build)
+    main(args.org_build, args.cores)
@@ -8,14 +8,41 @@ This requires a 3 pass approach to get gene names to coordinates:
 - it then remaps the name with gene.info to alternative symbols and tries to
   find those in the transcript file.
 - Finally, it uses coordinates from gene.info if those exist.
+
+Transcript files are read once into a gene symbol index, cached next to the
+BED file, and gene.info is queried in batches with responses cached on disk.
+
+Usage:
+  az300_to_bed.py <gene list> [<reference directory>]
 """
+import json
 import os
 import sys
 
 import requests
 
-ref_dir = "/human"
-in_file = sys.argv[1]
+GENOMES = ["hg19", "GRCh37", "hg38"]
+MYGENE_URL = "http://mygene.info/v3/query"
+MYGENE_BATCH = 1000
+
+def main(in_file, ref_dir="/human"):
+    targets = read_targets(in_file)
+    gene_info = GeneInfo("%s-mygene.json" % os.path.splitext(in_file)[0])
+    indexes = dict((genome, load_symbol_index(_transcript_file(ref_dir, genome))) for genome in GENOMES)
+    missing = dict((genome, targets - set(indexes[genome].keys())) for genome in GENOMES)
+    gene_info.prefetch(set.union(*missing.values()))
+    remapped = dict((genome, remap_targets(missing[genome], gene_info)) for genome in GENOMES)
+    gene_info.prefetch(set.union(*[set(x) - set(indexes[g].keys()) for g, x in remapped.items()]))
+    for genome in GENOMES:
+        out_file = "%s-%s.bed" % (os.path.splitext(in_file)[0], genome)
+        with open(out_file, "w") as out_handle:
+            print("total", len(targets))
+            cur_targets = write_from_index(targets, indexes[genome], out_handle)
+            print("after first name pass", len(cur_targets))
+            cur_targets = write_from_index(remapped[genome], indexes[genome], out_handle)
+            print("after rename name pass", len(cur_targets))
+            cur_targets = write_from_gene_info(cur_targets, genome, out_handle, gene_info)
+            print("after coordinate retrieval", cur_targets)
 
 def read_targets(in_file):
     targets = set([])
@@ -25,13 +52,75 @@ def read_targets(in_file):
             targets.add(cur_symbol)
     return targets
 
-def get_gene_info(cur_symbol):
+def _transcript_file(ref_dir, genome):
+    return os.path.join(ref_dir, genome, "rnaseq", "ref-transcripts.bed")
+
+def load_symbol_index(bed_file):
+    """Retrieve gene symbol to BED lines, in file order, for a transcript file.
+
+    The index is built in a single pass over the BED file and cached alongside
+    it, being rebuilt when the BED file is newer than the cache.
+    """
+    cache_file = "%s-symbols.json" % os.path.splitext(bed_file)[0]
+    if os.path.exists(cache_file) and os.path.getmtime(cache_file) >= os.path.getmtime(bed_file):
+        with open(cache_file) as in_handle:
+            return json.load(in_handle)
+    index = {}
+    with open(bed_file) as in_handle:
+        for i, line in enumerate(in_handle):
+            index.setdefault(line.split()[3], []).append([i, line])
+    try:
+        tx_cache_file = cache_file + ".tmp"
+        with open(tx_cache_file, "w") as out_handle:
+            json.dump(index, out_handle)
+        os.rename(tx_cache_file, cache_file)
+    except (IOError, OSError):
+        # read-only reference directory, use the index without caching
+        pass
+    return index
+
+class GeneInfo:
+    """Batched gene.info symbol lookups with an on-disk response cache.
+    """
+    def __init__(self, cache_file):
+        self._cache_file = cache_file
+        self._cache = {}
+        if os.path.exists(cache_file):
+            with open(cache_file) as in_handle:
+                self._cache = json.load(in_handle)
+
+    def prefetch(self, cur_symbols, batch_size=MYGENE_BATCH):
+        """Retrieve all uncached symbols with one POST request per batch.
+        """
+        to_fetch = sorted(x for x in cur_symbols if x not in self._cache)
+        for i in range(0, len(to_fetch), batch_size):
+            batch = to_fetch[i:i + batch_size]
+            r = requests.post(MYGENE_URL, data={"q": ",".join(batch), "scopes": "symbol,alias",
+                                                "fields": "symbol,genomic_pos_hg19",
+                                                "species": "human"})
+            r.raise_for_status()
+            hits = dict((x, []) for x in batch)
+            for hit in r.json():
+                if not hit.get("notfound") and hit["query"] in hits:
+                    hits[hit["query"]].append(hit)
+            for cur_symbol, cur_hits in hits.items():
+                self._cache[cur_symbol] = _parse_hits(cur_hits)
+        if to_fetch:
+            tx_cache_file = self._cache_file + ".tmp"
+            with open(tx_cache_file, "w") as out_handle:
+                json.dump(self._cache, out_handle)
+            os.rename(tx_cache_file, self._cache_file)
+
+    def get(self, cur_symbol):
+        """Retrieve alternative symbols and hg19 positions for a gene symbol.
+        """
+        if cur_symbol not in self._cache:
+            self.prefetch([cur_symbol])
+        return self._cache[cur_symbol]
+
+def _parse_hits(hits):
     chroms = [str(x) for x in range(1, 23)] + ["X", "Y"]
-    fields = "symbol,genomic_pos_hg19"
-    url = "http://mygene.info/v2/query?q=%s&species=human&fields=%s" % (cur_symbol, fields)
-    info = requests.get(url).json()
-    hits = info["hits"]
-    symbols = [x["symbol"] for x in hits]
+    symbols = [x["symbol"] for x in hits if "symbol" in x]
     pos = []
     for ps in [x["genomic_pos_hg19"] for x in hits if "genomic_pos_hg19" in x]:
         if not isinstance(ps, (list, tuple)):
@@ -41,50 +130,26 @@ def get_gene_info(cur_symbol):
                 pos.append(p)
     return symbols, pos
 
-def find_missing_targets(missing, in_file, genome):
-    missing_file = "%s-%s-missingsymbols.txt" % (os.path.splitext(in_file)[0], genome)
+def remap_targets(missing, gene_info):
     out = set([])
-    if os.path.exists(missing_file):
-        with open(missing_file) as in_handle:
-            for line in in_handle:
-                out.add(line.strip())
-    else:
-        with open(missing_file, "w") as out_handle:
-            for cur_symbol in missing:
-                symbols, pos = get_gene_info(cur_symbol)
-                if cur_symbol not in symbols and len(symbols) > 0:
-                    cur_symbol = symbols[0]
-                out_handle.write("%s\n" % cur_symbol)
-                out.add(cur_symbol)
+    for cur_symbol in missing:
+        symbols, pos = gene_info.get(cur_symbol)
+        if cur_symbol not in symbols and len(symbols) > 0:
+            cur_symbol = symbols[0]
+        out.add(cur_symbol)
     return out
 
-def write_from_transcript_file(targets, ref_dir, genome, out_handle):
-    ref_file = os.path.join(ref_dir, genome, "rnaseq", "ref-transcripts.bed")
-    found = set([])
-    with open(ref_file) as in_handle:
-        for line in in_handle:
-            name = line.split()[3]
-            if name in targets:
-                found.add(name)
-                out_handle.write(line)
-    return targets - found
-
-def write_from_remap_names(targets, ref_dir, genome, out_handle, in_file):
-    ref_file = os.path.join(ref_dir, genome, "rnaseq", "ref-transcripts.bed")
-    targets = find_missing_targets(targets, in_file, genome)
-    found = set([])
-    with open(ref_file) as in_handle:
-        for line in in_handle:
-            name = line.split()[3]
-            if name in targets:
-                found.add(name)
-                out_handle.write(line)
+def write_from_index(targets, index, out_handle):
+    found = targets & set(index.keys())
+    lines = sorted(x for name in found for x in index[name])
+    for _, line in lines:
+        out_handle.write(line)
     return targets - found
 
-def write_from_gene_info(targets, genome, out_handle):
+def write_from_gene_info(targets, genome, out_handle, gene_info):
     missing = []
     for target in sorted(targets):
-        symbols, pos = get_gene_info(target)
+        symbols, pos = gene_info.get(target)
         if pos:
             assert isinstance(pos, (list, tuple))
             if symbols:
@@ -96,14 +161,5 @@ def write_from_gene_info(targets, genome, out_handle):
             missing.append(target)
     return missing
 
-for genome in ["hg19", "GRCh37", "hg38"]:
-    out_file = "%s-%s.bed" % (os.path.splitext(in_file)[0], genome)
-    with open(out_file, "w") as out_handle:
-        targets = read_targets(in_file)
-        print "total", len(targets)
-        targets = write_from_transcript_file(targets, ref_dir, genome, out_handle)
-        print("after first name pass", len(targets))
-        targets = write_from_remap_names(targets, ref_dir, genome, out_handle, in_file)
-        print("after rename name pass", len(targets))
-        targets = write_from_gene_info(targets, genome, out_handle)
-        print("after coordinate retrieval", targets)
+if __name__ == "__main__":
+    main(*sys.argv[1:])
@@ -2,37 +2,109 @@
 """Query conda dependencies, summarizing for environment stratification.
 
 Helps identify grouping of packages for different sub-environments.
+
+Package file listings from api.anaconda.org are retrieved concurrently and
+cached on disk, revalidated with ETags on later runs. Along with the
+environment each package needs, reports dependencies pinned to different
+versions by the latest releases of packages.
+
+Usage:
+  query_conda_deps.py <packages-conda.yaml> [--workers 16] [--cache <dir>]
 """
-import sys
+import argparse
+import collections
+import hashlib
+import json
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor
 
 import requests
 import yaml
 
-def main(config_file):
+API_URL = "https://api.anaconda.org"
+
+def main(config_file, cache_dir, workers=16, api_url=API_URL):
     with open(config_file) as in_handle:
         config = yaml.safe_load(in_handle)
     channels = config["channels"]
     channels.reverse()
-    for p in sorted(config["bio_nextgen"]):
-        p = p.split(";")[0]
+    client = AnacondaClient(cache_dir, api_url, workers)
+    packages = sorted(set(p.split(";")[0] for p in config["bio_nextgen"]))
+    with ThreadPoolExecutor(workers) as executor:
+        files = dict(zip(packages, executor.map(lambda p: _first_channel_files(client, channels, p),
+                                                packages)))
+    for p in packages:
         env = "default"
-        for c in channels:
-            deps = get_dependencies(c, p)
-            if deps is not None:
-                if "python" in deps and deps.get("python"):
-                    if not any([s[1].startswith("3.") for s in deps["python"]]):
-                        env = "python2"
-                break
+        deps = get_dependencies(files[p])
+        if deps is not None:
+            if "python" in deps and deps.get("python"):
+                if not any([s[1].startswith("3.") for s in deps["python"]]):
+                    env = "python2"
         print(p, env)
+    pins = differing_pins(files)
+    if pins:
+        print("\n# Dependencies pinned differently by latest package versions")
+        for dep, specs in sorted(pins.items()):
+            print(dep)
+            for spec, pkgs in sorted(specs.items()):
+                print("  %s: %s" % (spec, ", ".join(sorted(pkgs))))
+
+def _first_channel_files(client, channels, package):
+    for c in channels:
+        out = client.files(c, package)
+        if out is not None:
+            return out
+    return None
+
+class AnacondaClient:
+    """Retrieve package file listings from the anaconda.org API with an ETag validated disk cache.
+    """
+    def __init__(self, cache_dir, api_url=API_URL, workers=16):
+        self._cache_dir = cache_dir
+        self._api_url = api_url.rstrip("/")
+        self._session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=workers, pool_maxsize=workers)
+        self._session.mount("http://", adapter)
+        self._session.mount("https://", adapter)
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+
+    def _cache_file(self, url):
+        return os.path.join(self._cache_dir, "%s.json" % hashlib.sha1(url.encode("utf-8")).hexdigest())
 
-def get_dependencies(channel, package):
-    url = "https://api.anaconda.org/package/%s/%s/files" % (channel, package)
-    out = requests.get(url).json()
-    if isinstance(out, dict) and out.get("error"):
+    def files(self, channel, package):
+        """Retrieve all files for a package in a channel, or None if not present.
+        """
+        url = "%s/package/%s/%s/files" % (self._api_url, channel, package)
+        cache_file = self._cache_file(url)
+        cached = None
+        headers = {}
+        if os.path.exists(cache_file):
+            with open(cache_file) as in_handle:
+                cached = json.load(in_handle)
+            if cached.get("etag"):
+                headers["If-None-Match"] = cached["etag"]
+        r = self._session.get(url, headers=headers)
+        if r.status_code == 304 and cached:
+            out = cached["data"]
+        else:
+            out = r.json()
+            if r.headers.get("ETag"):
+                tx_cache_file = "%s.%s.tmp" % (cache_file, os.getpid())
+                with open(tx_cache_file, "w") as out_handle:
+                    json.dump({"url": url, "etag": r.headers["ETag"], "data": out}, out_handle)
+                os.rename(tx_cache_file, cache_file)
+        if isinstance(out, dict) and out.get("error"):
+            return None
+        return out
+
+def get_dependencies(files):
+    if files is None:
         return None
     else:
         deps = {"python": set([])}
-        for f in out:
+        for f in files:
             for d in f["dependencies"]["depends"]:
                 for k in deps.keys():
                     if d["name"] == k:
@@ -40,5 +112,33 @@ def get_dependencies(channel, package):
                             deps[k].add(tuple(s))
         return deps
 
+def _version_key(version):
+    return [(0, int(x)) if x.isdigit() else (-1, x) for x in re.split(r"[.\-_]", str(version))]
+
+def differing_pins(files_by_package):
+    """Find dependencies pinned to different versions by the latest release of each package.
+
+    Returns {dependency: {spec: set(packages)}} for dependencies with more than
+    one distinct versioned spec.
+    """
+    pins = collections.defaultdict(lambda: collections.defaultdict(set))
+    for package, files in files_by_package.items():
+        if not files:
+            continue
+        latest = max((f["version"] for f in files), key=_version_key)
+        for f in (x for x in files if x["version"] == latest):
+            for d in f["dependencies"]["depends"]:
+                if d["specs"]:
+                    spec = ",".join("%s%s" % (op, v) for op, v in sorted(tuple(s) for s in d["specs"]))
+                    pins[d["name"]][spec].add(package)
+    return dict((dep, dict(specs)) for dep, specs in pins.items() if len(specs) > 1)
+
 if __name__ == "__main__":
-    main(sys.argv[1])
+    parser = argparse.ArgumentParser(description="Summarize conda dependencies for environment stratification.")
+    parser.add_argument("config_file", help="Conda packages YAML with channels and bio_nextgen sections")
+    parser.add_argument("--cache", default=os.path.expanduser(os.path.join("~", ".cache", "query_conda_deps")),
+                        help="Directory for cached API responses")
+    parser.add_argument("-w", "--workers", type=int, default=16, help="Concurrent API requests")
+    parser.add_argument("--api", default=API_URL, help="Anaconda API base URL, such as a local mock")
+    args = parser.parse_args()
+    main(args.config_file, args.cache, args.workers, args.api)